@@ -8,7 +8,7 @@ import sys
 # additional
 import numpy as np
 import subprocess
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 # Try to import sketchlib
 try:
@@ -107,11 +107,18 @@ def get_options():
 
     # model fitting
     modelGroup = parser.add_argument_group('Model fit options')
-    modelGroup.add_argument('--K', help='Maximum number of mixture components [default = 2]', type=int, default=2)
+    modelGroup.add_argument('--K', help='Maximum number of mixture components [default = 2]', type=int, default=None)
+    modelGroup.add_argument('--K-sweep', help='Comma separated list of maximum mixture components to fit and '
+                                              'compare, keeping the best by network score (overrides --K)',
+                                              type=str, default=None)
     modelGroup.add_argument('--D', help='Maximum number of clusters in DBSCAN fitting [default = 100]', type=int, default=100)
     modelGroup.add_argument('--min-cluster-prop', help='Minimum proportion of points in a cluster '
                                                         'in DBSCAN fitting [default = 0.0001]', type=float, default=0.0001)
     modelGroup.add_argument('--threshold', help='Cutoff if using --fit-model threshold', type=float)
+    modelGroup.add_argument('--update-fit', help='Start the fit from the previous model in --model-dir '
+                                                 '(or --ref-db), for a database with more samples added. '
+                                                 'Used with --fit-model bgmm or refine',
+                                                 default=False, action='store_true')
 
     # model refinement
     refinementGroup = parser.add_argument_group('Refine model options')
@@ -123,11 +130,23 @@ def get_options():
             'See documentation for help.', default=None)
     refinementGroup.add_argument('--no-local', help='Do not perform the local optimization step (speed up on very large datasets)',
             default=False, action='store_true')
+    refinementGroup.add_argument('--adaptive-refine', help='Search offsets placed by the number of distances they add, '
+                                                           'refining around the best, rather than a fixed grid. '
+                                                           'Saves the score curve, and resumes from it if present',
+            default=False, action='store_true')
+    refinementGroup.add_argument('--refine-subsample', help='Search for the boundary using distances between this many '
+                                                            'samples, stratified by their starting clusters, then '
+                                                            'score it with all samples [default = use all samples]',
+            type=int, default=None)
     refinementGroup.add_argument('--model-dir', help='Directory containing model to use for assigning queries '
                                                    'to clusters [default = reference database directory]', type = str)
     refinementGroup.add_argument('--score-idx',
             help='Index of score to use [default = 0]',
             type=int, default = 0, choices=[0, 1, 2])
+    refinementGroup.add_argument('--betweenness-sample', help='Estimate betweenness for --score-idx 1 and 2 from a '
+                                                              'sample of pivots, with this maximum error '
+                                                              '[default = exact]',
+            type=float, default=None)
     refineMode = refinementGroup.add_mutually_exclusive_group()
     refineMode.add_argument('--unconstrained',
             help='Optimise both boundary gradient and intercept',
@@ -190,6 +209,7 @@ def main():
     from .network import constructNetwork
     from .network import extractReferences
     from .network import printClusters
+    from .network import boundaryNetwork
 
     from .plot import writeClusterCsv
     from .plot import plot_scatter
@@ -259,6 +279,17 @@ def main():
         if max(rank_list) > 100:
             sys.stderr.write("WARNING: Ranks should be small non-zero integers for sensible lineage results\n")
 
+    # check if comparing numbers of mixture components
+    if args.K_sweep is not None:
+        K_list = sorted(set([int(x) for x in args.K_sweep.split(',')]))
+        if min(K_list) < 2:
+            sys.stderr.write("Values in --K-sweep must be >= 2\n")
+            sys.exit(1)
+    elif args.K is not None:
+        K_list = args.K
+    else:
+        K_list = 2
+
     # run according to mode
     sys.stderr.write("PopPUNK (POPulation Partitioning Using Nucleotide Kmers)\n")
     sys.stderr.write("\t(with backend: " + dbFuncs['backend'] + " v" + dbFuncs['backend_version'] + "\n")
@@ -339,7 +370,22 @@ def main():
             output = args.output
 
         # Set up variables for using previous models
-        if args.fit_model == "refine" or args.use_model:
+        if args.update_fit and args.fit_model not in ["bgmm", "refine"]:
+            sys.stderr.write("--update-fit can only be used with --fit-model bgmm or refine\n")
+            sys.exit(1)
+        if args.update_fit and (args.K is not None or args.K_sweep is not None):
+            sys.stderr.write("WARNING: --K and --K-sweep are ignored with --update-fit; "
+                             "the number of components is taken from the previous model\n")
+        if args.refine_subsample is not None and args.refine_subsample < 3:
+            sys.stderr.write("--refine-subsample must be at least 3\n")
+            sys.exit(1)
+        if args.betweenness_sample is not None and not 0 < args.betweenness_sample < 1:
+            sys.stderr.write("--betweenness-sample must be between 0 and 1\n")
+            sys.exit(1)
+        if args.adaptive_refine and args.unconstrained:
+            sys.stderr.write("--adaptive-refine cannot be used with --unconstrained\n")
+            sys.exit(1)
+        if args.fit_model == "refine" or args.use_model or args.update_fit:
             model_prefix = args.ref_db
             if args.model_dir is not None:
                 model_prefix = args.model_dir
@@ -347,13 +393,16 @@ def main():
                                    model_prefix + "/" + os.path.basename(model_prefix) + '_fit.npz',
                                    output)
             sys.stderr.write("Loaded previous model of type: " + model.type + "\n")
-            if args.fit_model == "refine" and args.manual_start == None \
-                and model.type != 'bgmm' and model.type != 'dbscan':
+            if args.update_fit and model.type != args.fit_model:
+                sys.stderr.write("Model needs to be of type " + args.fit_model + " to update it\n")
+                sys.exit(1)
+            elif args.fit_model == "refine" and args.manual_start == None \
+                and not args.update_fit and model.type != 'bgmm' and model.type != 'dbscan':
                 sys.stderr.write("Model needs to be from BGMM or DBSCAN to refine\n")
                 sys.exit(1)
 
         # Load the distances
-        refList, queryList, self, distMat = readPickle(distances, enforce_self=True)
+        refList, queryList, self, distMat = readPickle(distances, enforce_self=True, mmap=True)
         if qcDistMat(distMat, refList, queryList, args.max_a_dist) == False \
                 and args.qc_filter == "stop":
             sys.stderr.write("Distances failed quality control (change QC options to run anyway)\n")
@@ -373,8 +422,10 @@ def main():
                 model.plot()
             # Run Gaussian model
             elif args.fit_model == "bgmm":
+                start_model = model if args.update_fit else None
                 model = BGMMFit(output)
-                assignments = model.fit(distMat, args.K)
+                assignments = model.fit(distMat, K_list, refList, args.threads,
+                                        start_model = start_model)
                 model.plot(distMat, assignments)
             elif args.fit_model == "refine":
                 new_model = RefineFit(output)
@@ -385,7 +436,10 @@ def main():
                                             args.unconstrained,
                                             args.score_idx,
                                             args.no_local,
-                                            args.threads)
+                                            args.threads,
+                                            args.adaptive_refine,
+                                            args.refine_subsample,
+                                            args.betweenness_sample)
                 new_model.plot(distMat)
                 model = new_model
             elif args.fit_model == "threshold":
@@ -401,11 +455,6 @@ def main():
                 model.fit(distMat, args.use_accessory, args.threads)
                 model.plot(distMat)
 
-                assignments = {}
-                for rank in rank_list:
-                    assignments[rank] = \
-                        model.assign(int(rank))
-
             # save model
             model.save()
 
@@ -418,6 +467,15 @@ def main():
         #* network construction       *#
         #*                            *#
         #******************************#
+        # Core and accessory networks are made alongside the combined network
+        if model.indiv_fitted:
+            indiv_executor = ThreadPoolExecutor(max_workers = 2)
+            indiv_futures = {dist_type: indiv_executor.submit(boundaryNetwork, model, distMat,
+                                                              refList, queryList, slope,
+                                                              output + "/" + os.path.basename(output) + "_" + dist_type,
+                                                              args.external_clustering)
+                             for dist_type, slope in zip(['core', 'accessory'], [0, 1])}
+
         if model.type != "lineage":
             if args.graph_weights:
                 weights = distMat
@@ -430,27 +488,10 @@ def main():
                                  model.within_label,
                                  weights=weights)
         else:
-            # Lineage fit requires some iteration
-            indivNetworks = {}
-            lineage_clusters = defaultdict(dict)
-            for rank in sorted(rank_list):
-                sys.stderr.write("Network for rank " + str(rank) + "\n")
-                if args.graph_weights:
-                    weights = model.edge_weights(rank)
-                else:
-                    weights = None
-                indivNetworks[rank] = constructNetwork(
-                                        refList,
-                                        refList,
-                                        assignments[rank],
-                                        0,
-                                        edge_list=True,
-                                        weights=weights
-                                       )
-                lineage_clusters[rank] = \
-                    printClusters(indivNetworks[rank],
-                                  refList,
-                                  printCSV = False)
+            # Clusters at every rank from the neighbour lists
+            rank_clusters = model.clusters(rank_list)
+            lineage_clusters = {rank: dict(zip(refList, rank_clusters[rank].tolist()))
+                                for rank in rank_list}
 
             # print output of each rank as CSV
             overall_lineage = createOverallLineage(rank_list, lineage_clusters)
@@ -462,7 +503,19 @@ def main():
                 output_format = 'phandango',
                 epiCsv = None,
                 suffix = '_Lineage')
-            genomeNetwork = indivNetworks[min(rank_list)]
+
+            # Only the lowest rank network is kept
+            min_rank = min(rank_list)
+            if args.graph_weights:
+                weights = model.edge_weights(min_rank)
+            else:
+                weights = None
+            genomeNetwork = constructNetwork(refList,
+                                             refList,
+                                             model.assign(min_rank),
+                                             0,
+                                             edge_list=True,
+                                             weights=weights)
 
         # Ensure all in dists are in final network
         networkMissing = set(map(str,set(range(len(refList))).difference(list(genomeNetwork.vertices()))))
@@ -479,21 +532,9 @@ def main():
         # Write core and accessory based clusters, if they worked
         if model.indiv_fitted:
             indivNetworks = {}
-            for dist_type, slope in zip(['core', 'accessory'], [0, 1]):
-                indivAssignments = model.assign(distMat, slope)
-                indivNetworks[dist_type] = \
-                    constructNetwork(refList,
-                                     queryList,
-                                     indivAssignments,
-                                     model.within_label)
-                isolateClustering[dist_type] = \
-                    printClusters(indivNetworks[dist_type],
-                                  refList,
-                                  output + "/" + os.path.basename(output) + "_" + dist_type,
-                                  externalClusterCSV = args.external_clustering)
-                indivNetworks[dist_type].save(
-                    output + "/" + os.path.basename(output) + \
-                    "_" + dist_type + '_graph.gt', fmt = 'gt')
+            for dist_type, indiv_future in indiv_futures.items():
+                indivNetworks[dist_type], isolateClustering[dist_type] = indiv_future.result()
+            indiv_executor.shutdown()
 
             if args.indiv_refine == 'core':
                 fit_type = 'core'
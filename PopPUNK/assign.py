@@ -8,7 +8,6 @@ import sys
 # additional
 import numpy as np
 import subprocess
-from collections import defaultdict
 
 # required from v2.1.1 onwards (no mash support)
 import pp_sketchlib
@@ -40,7 +39,8 @@ def assign_query(dbFuncs,
                  core_only,
                  accessory_only,
                  web,
-                 json_sketch):
+                 json_sketch,
+                 prune_query_pairs = False):
     """Code for assign query mode. Written as a separate function so it can be called
     by web APIs"""
 
@@ -74,6 +74,7 @@ def assign_query(dbFuncs,
     constructDatabase = dbFuncs['constructDatabase']
     joinDBs = dbFuncs['joinDBs']
     queryDatabase = dbFuncs['queryDatabase']
+    queryPairs = dbFuncs['queryPairs']
     readDBParams = dbFuncs['readDBParams']
     getSeqsInDb = dbFuncs['getSeqsInDb']
 
@@ -153,36 +154,42 @@ def assign_query(dbFuncs,
     if model.type == 'lineage':
         # Assign lineages by calculating query-query information
         addRandom(output, qNames, kmers, strand_preserved, overwrite, threads)
-        qlist1, qlist2, qqDistMat = queryDatabase(rNames = qNames,
-                                                  qNames = qNames,
-                                                  dbPrefix = output,
-                                                  queryPrefix = output,
-                                                  klist = kmers,
-                                                  self = True,
-                                                  number_plot_fits = 0,
-                                                  threads = threads)
-        model.extend(qqDistMat, qrDistMat)
-
-        genomeNetwork = {}
-        isolateClustering = defaultdict(dict)
-        for rank in model.ranks:
-            assignment = model.assign(rank)
-            # Overwrite the network loaded above
+        if update_db or not prune_query_pairs:
+            # All distances are needed to update the database
+            qlist1, qlist2, qqDistMat = queryDatabase(rNames = qNames,
+                                                      qNames = qNames,
+                                                      dbPrefix = output,
+                                                      queryPrefix = output,
+                                                      klist = kmers,
+                                                      self = True,
+                                                      number_plot_fits = 0,
+                                                      threads = threads)
+            model.extend(qqDistMat, qrDistMat)
+        else:
+            # Only distances between queries which may be neighbours
+            # (triangle inequality, which is approximate for these distances)
+            qq_pairs = model.query_pairs(qrDistMat)
+            qqPairDists = queryPairs(qNames, qq_pairs[0], qq_pairs[1],
+                                     output, kmers, threads = threads)
+            model.extend(qqPairDists, qrDistMat, qq_pairs)
+
+        rank_clusters = model.clusters()
+        isolateClustering = {rank: dict(zip(refList + queryList, rank_clusters[rank].tolist()))
+                             for rank in model.ranks}
+
+        # Overwrite the network loaded above, only needed to update the database
+        if update_db:
+            min_rank = min(model.ranks)
             if graph_weights:
-                weights = model.edge_weights(rank)
+                weights = model.edge_weights(min_rank)
             else:
                 weights = None
-            genomeNetwork[rank] = constructNetwork(rNames + qNames,
-                                                   rNames + qNames,
-                                                   assignment,
-                                                   0,
-                                                   edge_list = True,
-                                                   weights=weights)
-
-            isolateClustering[rank] = \
-                printClusters(genomeNetwork[rank],
-                              refList + queryList,
-                              printCSV = False)
+            genomeNetwork = constructNetwork(rNames + qNames,
+                                             rNames + qNames,
+                                             model.assign(min_rank),
+                                             0,
+                                             edge_list = True,
+                                             weights=weights)
 
         overall_lineage = createOverallLineage(model.ranks, isolateClustering)
         writeClusterCsv(
@@ -230,10 +237,7 @@ def assign_query(dbFuncs,
 
         # Update the network + ref list (everything)
         joinDBs(ref_db, output, output)
-        if model.type == 'lineage':
-            genomeNetwork[min(model.ranks)].save(output + "/" + os.path.basename(output) + '_graph.gt', fmt = 'gt')
-        else:
-            genomeNetwork.save(output + "/" + os.path.basename(output) + '_graph.gt', fmt = 'gt')
+        genomeNetwork.save(output + "/" + os.path.basename(output) + '_graph.gt', fmt = 'gt')
 
         # Update distance matrices with all calculated distances
         if distances == None:
@@ -346,6 +350,12 @@ def get_options():
     queryingGroup.add_argument('--accessory-only', help='(with a \'refine\' or \'lineage\' model) '
                                                         'Use an accessory-distance only model for assigning queries '
                                                         '[default = False]', default=False, action='store_true')
+    queryingGroup.add_argument('--prune-query-pairs', help='(with a \'lineage\' model, without --update-db) '
+                                                           'Only calculate distances between queries which may be '
+                                                           'neighbours, using the triangle inequality through the '
+                                                           'references. Distances are only approximately metric, so '
+                                                           'neighbours may occasionally be missed [default = False]',
+                               default=False, action='store_true')
 
     # processing
     other = parser.add_argument_group('Other options')
@@ -426,7 +436,8 @@ def main():
                  args.core_only,
                  args.accessory_only,
                  web = False,
-                 json_sketch = None)
+                 json_sketch = None,
+                 prune_query_pairs = args.prune_query_pairs)
 
     sys.stderr.write("\nDone\n")
 
@@ -8,6 +8,8 @@ import os
 import sys
 # additional
 import operator
+import collections
+from functools import partial
 import numpy as np
 
 from scipy import linalg
@@ -15,10 +17,69 @@ try:  # SciPy >= 0.19
     from scipy.special import logsumexp as sp_logsumexp
 except ImportError:
     from scipy.misc import logsumexp as sp_logsumexp # noqa
-from sklearn import mixture
+from multiprocessing import Pool, shared_memory
+from multiprocessing.managers import SharedMemoryManager
 
+from .utils import NumpyShared
 
-def fit2dMultiGaussian(X, dpgmm_max_K = 2):
+
+# Parameters of a fitted mixture, named as in sklearn
+MixtureFit = collections.namedtuple('MixtureFit', ('weights_', 'means_', 'covariances_', 'lower_bound_'))
+
+def weightedMixture():
+    """Makes a :class:`sklearn.mixture.BayesianGaussianMixture` which accepts
+    sample weights, so it can be fitted to the weighted points from
+    :func:`~PopPUNK.utils.distanceCoreset`.
+
+    The responsibilities in the initialisation and each M-step are multiplied
+    by the sample weights, so a point with weight w contributes the same
+    sufficient statistics as w copies of that point. The entropy of the
+    responsibilities in the lower bound is weighted in the same way, so
+    convergence and the choice between initialisations use the weighted
+    objective. Initial responsibilities
+    may also be given to fit, to start from a previous model.
+
+    sklearn is imported here, so that it is only needed to fit models.
+
+    Returns:
+        WeightedBayesianGaussianMixture (class)
+            The weighted mixture model
+    """
+    from sklearn import mixture
+
+    class WeightedBayesianGaussianMixture(mixture.BayesianGaussianMixture):
+        def fit(self, X, y = None, sample_weight = None, init_resp = None):
+            if sample_weight is None:
+                self.sample_weight_ = np.ones(X.shape[0])
+            else:
+                self.sample_weight_ = np.asarray(sample_weight, dtype = np.float64)
+            self.init_resp_ = init_resp
+            return super().fit(X, y)
+
+        def _initialize_parameters(self, X, random_state, *args, **kwargs):
+            if self.init_resp_ is None:
+                super()._initialize_parameters(X, random_state, *args, **kwargs)
+            else:
+                self._initialize(X, self.init_resp_)
+
+        def _initialize(self, X, resp):
+            super()._initialize(X, resp * self.sample_weight_[:, np.newaxis])
+
+        def _m_step(self, X, log_resp, *args, **kwargs):
+            super()._m_step(X, log_resp + np.log(self.sample_weight_)[:, np.newaxis],
+                            *args, **kwargs)
+
+        def _compute_lower_bound(self, log_resp, log_prob_norm):
+            # Only the entropy term -sum(resp * log_resp) depends on the samples
+            entropy = np.sum(np.exp(log_resp) * log_resp, axis = 1)
+            return super()._compute_lower_bound(log_resp, log_prob_norm) + \
+                np.sum(entropy) - np.dot(self.sample_weight_, entropy)
+
+    return WeightedBayesianGaussianMixture
+
+
+def fit2dMultiGaussian(X, dpgmm_max_K = 2, sample_weight = None,
+                       n_init = 5, num_processes = 1):
     """Main function to fit BGMM model, called from :func:`~PopPUNK.models.BGMMFit.fit`
 
     Fits the mixture model specified, saves model parameters to a file, and assigns the samples to
@@ -31,21 +92,139 @@ def fit2dMultiGaussian(X, dpgmm_max_K = 2):
         dpgmm_max_K (int)
             Maximum number of components to use with the EM fit.
             (default = 2)
+        sample_weight (np.array)
+            Weight of each sample in X, e.g. from :func:`~PopPUNK.utils.distanceCoreset`.
+            (default = None, all samples weighted equally)
+        n_init (int)
+            Number of initialisations to run, keeping the best
+            (default = 5)
+        num_processes (int)
+            Number of processes to run the initialisations in
+            (default = 1)
     Returns:
-        dpgmm (sklearn.mixture.BayesianGaussianMixture)
-            Fitted bgmm model
+        dpgmm (MixtureFit)
+            Parameters of the fitted bgmm model
     """
-    # fit bgmm model
-    dpgmm = mixture.BayesianGaussianMixture(n_components = dpgmm_max_K,
-                                                n_init = 5,
-                                                covariance_type = 'full',
-                                                weight_concentration_prior = 0.1,
-                                                mean_precision_prior = 0.1,
-                                                mean_prior = np.array([0,0])).fit(X)
-
+    dpgmm = fitMultiK(X, [dpgmm_max_K], sample_weight, n_init, num_processes)[dpgmm_max_K]
     return dpgmm
 
 
+def fitMultiK(X, K_list, sample_weight = None, n_init = 5, num_processes = 1):
+    """Fit BGMMs with each maximum number of components in K_list.
+
+    Every (K, initialisation) pair is run as a separate single
+    initialisation fit in a process pool, reading X from shared memory.
+    For each K the fit with the highest lower bound is kept, as
+    :class:`sklearn.mixture.BayesianGaussianMixture` does with ``n_init``.
+
+    Args:
+        X (np.array)
+            n x 2 array of scaled core and accessory distances
+        K_list (list)
+            Maximum numbers of components to fit
+        sample_weight (np.array)
+            Weight of each sample in X.
+            (default = None, all samples weighted equally)
+        n_init (int)
+            Number of initialisations for each K
+            (default = 5)
+        num_processes (int)
+            Number of processes to use
+            (default = 1)
+    Returns:
+        fits (dict)
+            Parameters of the best fitted model (MixtureFit) for each K
+    """
+    if sample_weight is None:
+        sample_weight = np.ones(X.shape[0])
+    sample_weight = np.asarray(sample_weight, dtype = np.float64)
+    jobs = [(K, seed) for K in K_list for seed in range(n_init)]
+
+    if num_processes > 1 and len(jobs) > 1:
+        with SharedMemoryManager() as smm:
+            shared = []
+            for array in (X, sample_weight):
+                shm_array = smm.SharedMemory(size = array.nbytes)
+                shared_array = np.ndarray(array.shape, dtype = array.dtype, buffer = shm_array.buf)
+                shared_array[:] = array[:]
+                shared.append(NumpyShared(name = shm_array.name, shape = array.shape, dtype = array.dtype))
+
+            with Pool(processes = min(num_processes, len(jobs))) as pool:
+                results = pool.map(partial(fitSingleInit,
+                                           X = shared[0],
+                                           sample_weight = shared[1]),
+                                   jobs)
+    else:
+        results = [fitSingleInit(job, X, sample_weight) for job in jobs]
+
+    fits = {}
+    for (K, seed), dpgmm in zip(jobs, results):
+        if K not in fits or dpgmm.lower_bound_ > fits[K].lower_bound_:
+            fits[K] = dpgmm
+
+    return fits
+
+
+def fitWarmStart(X, init_resp, sample_weight = None):
+    """Fit a BGMM from the responsibilities of a previous model, rather than
+    from random initialisations. Used to update a fit when more data is added,
+    where the previous model should already be close to the optimum.
+
+    Args:
+        X (np.array)
+            n x 2 array of scaled core and accessory distances
+        init_resp (np.array)
+            n x K responsibilities of each component for each sample in X,
+            from :func:`~assign_samples` with the previous model
+        sample_weight (np.array)
+            Weight of each sample in X.
+            (default = None, all samples weighted equally)
+    Returns:
+        dpgmm (MixtureFit)
+            Parameters of the fitted bgmm model
+    """
+    if sample_weight is None:
+        sample_weight = np.ones(X.shape[0])
+    return fitSingleInit((init_resp.shape[1], 0), X, sample_weight, init_resp)
+
+
+def fitSingleInit(job, X, sample_weight, init_resp = None):
+    """Run a single initialisation of the BGMM. Called by :func:`~fitMultiK`
+
+    Args:
+        job (tuple)
+            Maximum number of components and random seed
+        X (np.array or NumpyShared)
+            n x 2 array of scaled core and accessory distances, or
+            NumpyShared describing these in sharedmem
+        sample_weight (np.array or NumpyShared)
+            Weight of each sample in X
+        init_resp (np.array)
+            Initial responsibilities, rather than a random initialisation
+            (default = None)
+    Returns:
+        dpgmm (MixtureFit)
+            Parameters of the fitted bgmm model
+    """
+    if isinstance(X, NumpyShared):
+        X_shm = shared_memory.SharedMemory(name = X.name)
+        X = np.ndarray(X.shape, dtype = X.dtype, buffer = X_shm.buf)
+        weights_shm = shared_memory.SharedMemory(name = sample_weight.name)
+        sample_weight = np.ndarray(sample_weight.shape, dtype = sample_weight.dtype, buffer = weights_shm.buf)
+
+    K, seed = job
+    dpgmm = weightedMixture()(n_components = K,
+                              n_init = 1,
+                              random_state = seed,
+                              covariance_type = 'full',
+                              weight_concentration_prior = 0.1,
+                              mean_precision_prior = 0.1,
+                              mean_prior = np.array([0,0])).fit(X, sample_weight = sample_weight,
+                                                                init_resp = init_resp)
+
+    return MixtureFit(dpgmm.weights_, dpgmm.means_, dpgmm.covariances_, dpgmm.lower_bound_)
+
+
 def assign_samples(X, weights, means, covars, scale, values = False):
     """Given distances and a fit will calculate responsibilities and return most
     likely cluster assignment
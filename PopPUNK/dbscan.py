@@ -6,8 +6,8 @@
 # universal
 import os
 import sys
-# hdbscan
-import hdbscan
+# additional
+import numpy as np
 
 def fitDbScan(X, min_samples, min_cluster_size, cache_out):
     """Function to fit DBSCAN model as an alternative to the Gaussian
@@ -32,6 +32,8 @@ def fitDbScan(X, min_samples, min_cluster_size, cache_out):
         n_clusters (int)
             Number of clusters used
     """
+    import hdbscan
+
     # set DBSCAN clustering parameters
     hdb = hdbscan.HDBSCAN(algorithm='boruvka_balltree',
                      min_samples = min_samples,
@@ -48,6 +50,42 @@ def fitDbScan(X, min_samples, min_cluster_size, cache_out):
     return hdb, labels, n_clusters
 
 
+def expandCoreset(X, weights, widths, n_samples, seed = 1):
+    """Turns weighted points into an unweighted sample for HDBSCAN,
+    which does not support sample weights.
+
+    Each point is repeated in proportion to its weight (and at least once,
+    so sparse bins in the tails are kept), with the repeats spread uniformly
+    across the bin the point summarises.
+
+    Args:
+        X (np.array)
+            k x 2 array of points from :func:`~PopPUNK.utils.distanceCoreset`
+        weights (np.array)
+            Weight of each point
+        widths (np.array)
+            k x 2 array of bin widths for each point
+        n_samples (int)
+            Approximate number of points to return
+        seed (int)
+            Seed for the positions of repeated points
+
+            (default = 1)
+
+    Returns:
+        expanded_X (np.array)
+            Unweighted points, approximately n_samples x 2
+    """
+    repeats = np.maximum(np.rint(weights * n_samples / np.sum(weights)), 1).astype(int)
+    expanded_X = np.repeat(X, repeats, axis = 0)
+    jitter = np.random.default_rng(seed).random(expanded_X.shape) - 0.5
+    jitter[np.cumsum(repeats) - repeats, :] = 0 # keep each centroid
+    expanded_X += (jitter * np.repeat(widths, repeats, axis = 0)).astype(X.dtype)
+    np.clip(expanded_X, 0, None, out = expanded_X)
+
+    return expanded_X
+
+
 def evaluate_dbscan_clusters(model):
     """Evaluate whether fitted dbscan model contains non-overlapping clusters
 
@@ -92,6 +130,7 @@ def assign_samples_dbscan(X, hdb, scale):
         y (numpy.array)
             Cluster assignments by sample
     """
+    import hdbscan
     y = hdbscan.approximate_predict(hdb, X/scale)[0]
     return y
 
@@ -0,0 +1,454 @@
+# vim: set fileencoding=<utf-8> :
+# Copyright 2018-2020 John Lees and Nick Croucher
+
+'''Nearest neighbour lists and clusters used by lineage fits'''
+
+# universal
+import sys
+# additional
+from functools import partial
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from scipy.sparse import coo_matrix, issparse
+from scipy.sparse.csgraph import connected_components
+from scipy.stats import rankdata
+
+# Distances are clamped to this, and distances closer than it are ties
+epsilon = 1e-10
+
+def selectNeighbours(rows, cols, dists, max_rank):
+    """Keep the nearest neighbours of each row, with ties.
+
+    Within each row distances are sorted, and grouped so that a distance
+    within epsilon of the previous one is a tie. The first max_rank groups
+    are kept, so the rank r neighbours of a row are those with rank <= r.
+    This matches ``sparsify_dists`` in pp-sketchlib.
+
+    Args:
+        rows (numpy.array)
+            Row index of each candidate neighbour
+        cols (numpy.array)
+            Column index of each candidate neighbour (not equal to its row)
+        dists (numpy.array)
+            Distance of each candidate neighbour
+        max_rank (int)
+            Number of groups of neighbours to keep in each row
+    Returns:
+        rows (numpy.array)
+            Row index of each neighbour, sorted
+        cols (numpy.array)
+            Column index of each neighbour
+        dists (numpy.array)
+            Distance of each neighbour (at least epsilon), sorted within rows
+        ranks (numpy.array)
+            Rank of each neighbour within its row, from 1
+    """
+    dists = np.maximum(dists, epsilon)
+    order = np.lexsort((dists, rows))
+    rows = rows[order]
+    cols = cols[order]
+    dists = dists[order]
+
+    if rows.size == 0:
+        return rows, cols, dists, np.zeros(0, dtype = np.int64)
+
+    # Number groups of tied distances, restarting at each row
+    row_start = np.ones(rows.size, dtype = bool)
+    row_start[1:] = rows[1:] != rows[:-1]
+    new_group = row_start.copy()
+    new_group[1:] |= (dists[1:] - dists[:-1]) >= epsilon
+    group = np.cumsum(new_group)
+    ranks = group - np.maximum.accumulate(np.where(row_start, group, 0)) + 1
+
+    keep = ranks <= max_rank
+    return rows[keep], cols[keep], dists[keep], ranks[keep]
+
+
+def denseNeighbours(block, max_rank):
+    """Nearest neighbours of each row of a dense block of distances, with
+    ties grouped as in :func:`~selectNeighbours`.
+
+    The smallest few distances in each row are found with a partial sort,
+    which is enough if they contain more than max_rank groups. Other rows
+    are fully sorted.
+
+    Args:
+        block (numpy.array)
+            Distances, with self-distances set to infinity
+        max_rank (int)
+            Number of groups of neighbours to keep in each row
+    Returns:
+        rows (numpy.array)
+            Row index (in block) of each neighbour, sorted
+        cols (numpy.array)
+            Column index of each neighbour
+        dists (numpy.array)
+            Distance of each neighbour (at least epsilon), sorted within rows
+        ranks (numpy.array)
+            Rank of each neighbour within its row, from 1
+    """
+    block = np.maximum(block, epsilon)
+    n_rows, n_cols = block.shape
+    n_candidates = min(2 * max_rank + 8, n_cols)
+    if n_candidates < n_cols:
+        candidates = np.argpartition(block, n_candidates - 1, axis = 1)[:, :n_candidates]
+    else:
+        candidates = np.tile(np.arange(n_cols), (n_rows, 1))
+    rows, cols, dists, ranks, complete = _sortCandidates(block, candidates, max_rank)
+
+    # Rows where the ties of the last group may not all be in the candidates
+    if n_candidates < n_cols and not np.all(complete):
+        retry_rows = np.nonzero(~complete)[0]
+        in_complete = complete[rows]
+        retry = _sortCandidates(block[retry_rows, :],
+                                np.tile(np.arange(n_cols), (retry_rows.size, 1)),
+                                max_rank)
+        rows = np.concatenate((rows[in_complete], retry_rows[retry[0]]))
+        cols = np.concatenate((cols[in_complete], retry[1]))
+        dists = np.concatenate((dists[in_complete], retry[2]))
+        ranks = np.concatenate((ranks[in_complete], retry[3]))
+        order = np.argsort(rows, kind = 'stable')
+        rows, cols, dists, ranks = rows[order], cols[order], dists[order], ranks[order]
+
+    return rows, cols, dists, ranks
+
+
+def _sortCandidates(block, candidates, max_rank):
+    """Sorts candidate columns of each row and keeps the first max_rank groups.
+
+    Returns:
+        rows, cols, dists, ranks (numpy.array)
+            As :func:`~denseNeighbours`
+        complete (numpy.array)
+            Whether each row's candidates included the start of the next group
+    """
+    candidate_dists = np.take_along_axis(block, candidates, axis = 1)
+    order = np.argsort(candidate_dists, axis = 1, kind = 'stable')
+    candidates = np.take_along_axis(candidates, order, axis = 1)
+    candidate_dists = np.take_along_axis(candidate_dists, order, axis = 1)
+
+    new_group = np.ones(candidate_dists.shape, dtype = bool)
+    new_group[:, 1:] = np.diff(candidate_dists, axis = 1) >= epsilon
+    group = np.cumsum(new_group, axis = 1)
+    complete = group[:, -1] > max_rank
+
+    keep_rows, keep_pos = np.nonzero((group <= max_rank) & np.isfinite(candidate_dists))
+    return keep_rows, candidates[keep_rows, keep_pos], \
+           candidate_dists[keep_rows, keep_pos], group[keep_rows, keep_pos], complete
+
+
+def condensedNeighbours(distVec, n_samples, max_rank, threads = 1, chunk_size = 10000000):
+    """Nearest neighbours of every sample, read from condensed (long form)
+    distances in blocks of rows, without making a square matrix.
+
+    Args:
+        distVec (numpy.array)
+            Distances between all pairs of samples, in the order of
+            :func:`~PopPUNK.utils.listDistInts`
+        n_samples (int)
+            Number of samples
+        max_rank (int)
+            Number of groups of neighbours to keep in each row
+        threads (int)
+            Number of threads to process blocks with
+
+            [default = 1]
+        chunk_size (int)
+            Approximate number of distances in each block
+
+            [default = 10000000]
+    Returns:
+        rows (numpy.array)
+            Row index of each neighbour, sorted
+        cols (numpy.array)
+            Column index of each neighbour
+        dists (numpy.array)
+            Distance of each neighbour, sorted within rows
+        ranks (numpy.array)
+            Rank of each neighbour within its row, from 1
+    """
+    rows_per_chunk = max(chunk_size // n_samples, 1)
+    blocks = [(start, min(start + rows_per_chunk, n_samples))
+              for start in range(0, n_samples, rows_per_chunk)]
+    block_fn = partial(_condensedBlock, distVec = distVec, n_samples = n_samples,
+                       max_rank = max_rank)
+    if threads > 1:
+        with ThreadPool(threads) as pool:
+            results = pool.map(block_fn, blocks)
+    else:
+        results = [block_fn(block) for block in blocks]
+
+    return tuple(np.concatenate(part) for part in zip(*results))
+
+
+def _condensedBlock(block_range, distVec, n_samples, max_rank):
+    """Neighbours of a block of rows, for :func:`~condensedNeighbours`"""
+    start, end = block_range
+    row_idx = np.arange(start, end)[:, np.newaxis]
+    col_idx = np.arange(n_samples)[np.newaxis, :]
+    low = np.minimum(row_idx, col_idx)
+    high = np.maximum(row_idx, col_idx)
+    condensed_idx = n_samples * low - (low * (low + 1)) // 2 + high - low - 1
+    condensed_idx[row_idx[:, 0] - start, row_idx[:, 0]] = 0
+
+    block = np.take(distVec, condensed_idx)
+    block[row_idx[:, 0] - start, row_idx[:, 0]] = np.inf
+    rows, cols, dists, ranks = denseNeighbours(block, max_rank)
+    return rows + start, cols, dists, ranks
+
+
+def queryNeighbours(qrRect, qqSquare, max_rank, chunk_size = 10000000):
+    """Nearest neighbours of new query rows, from their distances to the
+    references and to each other.
+
+    Args:
+        qrRect (numpy.array)
+            n_query x n_ref distances from queries to references
+        qqSquare (numpy.array or scipy.sparse.spmatrix)
+            n_query x n_query distances between queries. If sparse, only
+            the pairs given (in either direction) are used, such as those
+            from :func:`~queryCandidatePairs`
+        max_rank (int)
+            Number of groups of neighbours to keep in each row
+        chunk_size (int)
+            Approximate number of distances to sort at once
+
+            [default = 10000000]
+    Returns:
+        rows (numpy.array)
+            Row index of each neighbour, with queries numbered after references
+        cols (numpy.array)
+            Column index of each neighbour
+        dists (numpy.array)
+            Distance of each neighbour
+    """
+    n_query, n_ref = qrRect.shape
+    if issparse(qqSquare):
+        qqSquare = qqSquare.tocoo()
+        qqSquare = coo_matrix((np.concatenate((qqSquare.data, qqSquare.data)),
+                               (np.concatenate((qqSquare.row, qqSquare.col)),
+                                np.concatenate((qqSquare.col, qqSquare.row)))),
+                              shape = (n_query, n_query)).tocsr()
+    rows = []
+    cols = []
+    dists = []
+    rows_per_chunk = max(chunk_size // (n_ref + n_query), 1)
+    for start in range(0, n_query, rows_per_chunk):
+        end = min(start + rows_per_chunk, n_query)
+        if issparse(qqSquare):
+            qqBlock = np.full((end - start, n_query), np.inf)
+            qqRows = qqSquare[start:end, :].tocoo()
+            qqBlock[qqRows.row, qqRows.col] = qqRows.data
+        else:
+            qqBlock = qqSquare[start:end, :]
+        block = np.hstack((qrRect[start:end, :], qqBlock))
+        # exclude self-distances
+        block[np.arange(end - start), n_ref + np.arange(start, end)] = np.inf
+
+        block_rows, block_cols, block_dists, block_ranks = denseNeighbours(block, max_rank)
+        rows.append(n_ref + start + block_rows)
+        cols.append(block_cols)
+        dists.append(block_dists)
+
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(dists)
+
+
+def queryCandidatePairs(qrRect, max_rank, n_pivots = 8, slack = 0.05, chunk_size = 10000000):
+    """Pairs of queries which may be in each other's nearest neighbours, so
+    that distances between all queries are not needed.
+
+    Each query's furthest neighbour among the references is an upper bound
+    on its distance to its furthest neighbour once queries are added. The
+    triangle inequality, through the query's nearest references (pivots),
+    gives a lower bound on its distance to each other query. Pairs where
+    the bound from either query is beyond the furthest neighbour of both
+    cannot be neighbours. This assumes the distances are a metric, which
+    core and accessory distances are only approximately, so pairs are only
+    excluded if the bound is beyond the threshold by a factor of 1 + slack.
+    The bounds still cost O(Q^2) arithmetic, but only the remaining pairs
+    need sketch comparisons.
+
+    Args:
+        qrRect (numpy.array)
+            n_query x n_ref distances from queries to references
+        max_rank (int)
+            Number of groups of neighbours which will be kept in each row
+        n_pivots (int)
+            Number of nearest references to bound distances through
+
+            [default = 8]
+        slack (float)
+            Relative margin allowed for violations of the triangle inequality
+
+            [default = 0.05]
+        chunk_size (int)
+            Approximate number of distances to process at once
+
+            [default = 10000000]
+    Returns:
+        pair_i (numpy.array)
+            Index of the first query of each pair
+        pair_j (numpy.array)
+            Index of the second query of each pair (greater than pair_i)
+    """
+    n_query, n_ref = qrRect.shape
+    qrRect = np.maximum(qrRect, epsilon)
+    n_pivots = min(n_pivots, n_ref)
+
+    # Furthest neighbour among references, and nearest references, of each query
+    threshold = np.empty(n_query)
+    pivots = np.empty((n_query, n_pivots), dtype = np.int64)
+    rows_per_chunk = max(chunk_size // n_ref, 1)
+    for start in range(0, n_query, rows_per_chunk):
+        end = min(start + rows_per_chunk, n_query)
+        block = qrRect[start:end, :]
+        rows, cols, dists, ranks = denseNeighbours(block, max_rank)
+        furthest = np.full(end - start, -np.inf)
+        np.maximum.at(furthest, rows, dists)
+        n_groups = np.zeros(end - start, dtype = np.int64)
+        np.maximum.at(n_groups, rows, ranks)
+        threshold[start:end] = np.where(n_groups < max_rank, np.inf, furthest + epsilon)
+        if n_pivots < n_ref:
+            pivots[start:end, :] = np.argpartition(block, n_pivots - 1, axis = 1)[:, :n_pivots]
+        else:
+            pivots[start:end, :] = np.arange(n_ref)
+
+    # Lower bound between each query and all others, through its pivots
+    pair_codes = []
+    rows_per_chunk = max(chunk_size // (n_query * n_pivots), 1)
+    for start in range(0, n_query, rows_per_chunk):
+        end = min(start + rows_per_chunk, n_query)
+        block_pivots = pivots[start:end, :]
+        own_dists = np.take_along_axis(qrRect[start:end, :], block_pivots, axis = 1)
+        lower_bound = np.max(np.abs(qrRect[:, block_pivots] - own_dists[np.newaxis, :, :]),
+                             axis = 2).T
+        possible = lower_bound < (1 + slack) * np.maximum(threshold[start:end, np.newaxis],
+                                                          threshold[np.newaxis, :])
+        query_i, query_j = np.nonzero(possible)
+        query_i += start
+        not_self = query_i != query_j
+        query_i, query_j = query_i[not_self], query_j[not_self]
+        pair_codes.append(np.minimum(query_i, query_j) * n_query + np.maximum(query_i, query_j))
+
+    # Keep pairs which neither query's bound excludes
+    pair_codes, counts = np.unique(np.concatenate(pair_codes), return_counts = True)
+    pair_codes = pair_codes[counts == 2]
+    sys.stderr.write("Calculating " + str(pair_codes.size) + " of " +
+                     str(n_query * (n_query - 1) // 2) + " query-query distances\n")
+
+    return pair_codes // n_query, pair_codes % n_query
+
+
+def extendNeighbours(rows, cols, dists, qrRect, qqSquare, max_rank):
+    """Add queries to the nearest neighbours of references.
+
+    Full neighbour lists are found for the queries. Reference rows are only
+    updated where a query is closer than (or tied with) their furthest
+    neighbour, or where they have fewer than max_rank groups of neighbours.
+
+    Args:
+        rows (numpy.array)
+            Row index of each existing reference neighbour
+        cols (numpy.array)
+            Column index of each existing reference neighbour
+        dists (numpy.array)
+            Distance of each existing reference neighbour
+        qrRect (numpy.array)
+            n_query x n_ref distances from queries to references
+        qqSquare (numpy.array or scipy.sparse.spmatrix)
+            n_query x n_query distances between queries, which may be
+            sparse (see :func:`~queryNeighbours`)
+        max_rank (int)
+            Number of groups of neighbours to keep in each row
+    Returns:
+        rows (numpy.array)
+            Row index of each neighbour, sorted
+        cols (numpy.array)
+            Column index of each neighbour
+        dists (numpy.array)
+            Distance of each neighbour, sorted within rows
+        ranks (numpy.array)
+            Rank of each neighbour within its row, from 1
+    """
+    n_query, n_ref = qrRect.shape
+    qrRect = np.maximum(qrRect, epsilon)
+
+    # Furthest neighbour and number of groups in each reference row
+    rows, cols, dists, ranks = selectNeighbours(rows, cols, dists, max_rank)
+    furthest = np.full(n_ref, -np.inf)
+    np.maximum.at(furthest, rows, dists)
+    n_groups = np.zeros(n_ref, dtype = np.int64)
+    np.maximum.at(n_groups, rows, ranks)
+    threshold = np.where(n_groups < max_rank, np.inf, furthest + epsilon)
+
+    # Query distances which enter reference rows
+    query_idx, ref_idx = np.nonzero(qrRect < threshold[np.newaxis, :])
+    sys.stderr.write("Updating neighbours of " + str(np.unique(ref_idx).size) +
+                     " of " + str(n_ref) + " references\n")
+
+    query_rows, query_cols, query_dists = queryNeighbours(qrRect, qqSquare, max_rank)
+
+    return selectNeighbours(np.concatenate((rows, ref_idx, query_rows)),
+                            np.concatenate((cols, n_ref + query_idx, query_cols)),
+                            np.concatenate((dists, qrRect[query_idx, ref_idx], query_dists)),
+                            max_rank)
+
+
+def lineageClusters(rows, cols, ranks, n_samples, rank_list):
+    """Clusters of the nearest neighbour network at each rank, in one pass.
+
+    Edges are added in order of rank. At each rank the edges which are new
+    at that rank are merged into the components of the previous rank,
+    working on the (smaller) graph of those components, so each edge is only
+    used once. Clusters are numbered from 1 in decreasing order of size,
+    as :func:`~PopPUNK.network.printClusters` does.
+
+    Args:
+        rows (numpy.array)
+            Row index of each neighbour
+        cols (numpy.array)
+            Column index of each neighbour
+        ranks (numpy.array)
+            Rank of each neighbour within its row
+        n_samples (int)
+            Number of samples
+        rank_list (list)
+            Ranks to return clusters at
+    Returns:
+        clusters (dict)
+            Cluster of each sample (numpy.array), keyed by rank
+    """
+    order = np.argsort(ranks, kind = 'stable')
+    sorted_ranks = ranks[order]
+
+    labels = np.arange(n_samples)
+    n_components = n_samples
+    start = 0
+    clusters = {}
+    for rank in sorted(rank_list):
+        end = np.searchsorted(sorted_ranks, rank, side = 'right')
+        new_edges = order[start:end]
+        if new_edges.size > 0:
+            merges = coo_matrix((np.ones(new_edges.size, dtype = np.int8),
+                                 (labels[rows[new_edges]], labels[cols[new_edges]])),
+                                shape = (n_components, n_components))
+            n_components, merged_labels = connected_components(merges, directed = False)
+            labels = merged_labels[labels]
+        clusters[rank] = _sizeOrderedLabels(labels, n_components)
+        start = end
+
+    return clusters
+
+
+def _sizeOrderedLabels(labels, n_components):
+    """Number components from 1 in decreasing order of size. Components are
+    first ordered by their lowest sample, and ties broken as
+    :func:`~PopPUNK.network.printClusters`"""
+    first_seen = np.unique(labels, return_index = True)[1]
+    component_order = np.empty(n_components, dtype = np.int64)
+    component_order[np.argsort(first_seen)] = np.arange(n_components)
+    component_labels = component_order[labels]
+
+    component_frequencies = np.bincount(component_labels, minlength = n_components)
+    component_frequency_ranks = n_components - rankdata(component_frequencies, method = 'ordinal').astype(int)
+    return component_frequency_ranks[component_labels] + 1
@@ -8,43 +8,74 @@ import os
 import sys
 # additional
 import numpy as np
-import random
 import operator
 import pickle
 import shutil
 import re
-from sklearn import utils
+import json
 import scipy.optimize
+from concurrent.futures import ThreadPoolExecutor
 from scipy.spatial.distance import euclidean
 from scipy import stats
-from scipy.sparse import coo_matrix, bmat, find
+from scipy.sparse import coo_matrix
 
 import pp_sketchlib
 import poppunk_refine
 
 # BGMM
 from .bgmm import fit2dMultiGaussian
+from .bgmm import fitMultiK
+from .bgmm import fitWarmStart
 from .bgmm import assign_samples
+from .bgmm import log_likelihood
 from .bgmm import findWithinLabel
 from .plot import plot_results
 from .plot import plot_contours
 
 # DBSCAN
 from .dbscan import fitDbScan
+from .dbscan import expandCoreset
 from .dbscan import assign_samples_dbscan
 from .dbscan import findBetweenLabel
 from .dbscan import evaluate_dbscan_clusters
 from .plot import plot_dbscan_results
 
+# network
+from .network import constructNetwork
+from .network import networkSummary
+
 # refine
 from .refine import refineFit
 from .refine import likelihoodBoundary
 from .refine import readManualStart
+from .refine import boundaryScore
+from .refine import stratifiedSubsample
+from .refine import RefineTrace
+from .refine import writeRefineTrace
 from .plot import plot_refined_results
 
 # lineage
 from .plot import distHistogram
-epsilon = 1e-10
+from .lineage import condensedNeighbours
+from .lineage import extendNeighbours
+from .lineage import lineageClusters
+from .lineage import queryCandidatePairs
+from .lineage import selectNeighbours
+
+# subsampling
+from .utils import distanceCoreset
+from .utils import transformLine
+from .utils import shuffleRows
+
+# assignment
+from .raster import DecisionRaster
+
+# Version of the model format saved in _fit.npz
+fit_format_version = 1
+
+# Proportion of the distance between the within and between-strain means
+# searched either side of a previous boundary when updating a refined fit
+refine_update_window = 0.1
 
 # Format for rank fits
 def rankFile(rank):
@@ -53,9 +84,13 @@ def rankFile(rank):
 def loadClusterFit(pkl_file, npz_file, outPrefix = "", max_samples = 100000):
     '''Call this to load a fitted model
 
+    Models are read from the npz, which has a JSON header with the model
+    type and parameters (see :func:`~ClusterFit.save_fit`). Models saved
+    by earlier versions of PopPUNK have this information in a pickle instead.
+
     Args:
         pkl_file (str)
-            Location of saved .pkl file on disk
+            Location of saved .pkl file on disk (only used for older models)
         npz_file (str)
             Location of saved .npz file on disk
         outPrefix (str)
@@ -65,17 +100,26 @@ def loadClusterFit(pkl_file, npz_file, outPrefix = "", max_samples = 100000):
 
             [default = 100000]
     '''
-    with open(pkl_file, 'rb') as pickle_obj:
-        fit_object, fit_type = pickle.load(pickle_obj)
+    header = readFitHeader(npz_file)
+    if header is not None:
+        if header['version'] > fit_format_version:
+            raise RuntimeError("Model in " + npz_file + " was saved by a newer version of PopPUNK")
+        fit_type = header['type']
+        fit_object = header
+    else:
+        with open(pkl_file, 'rb') as pickle_obj:
+            fit_object, fit_type = pickle.load(pickle_obj)
+        if fit_type == 'lineage':
+            fit_object = {'ranks': fit_object[0], 'dist_col': fit_object[1]}
 
-    if fit_type == 'lineage':
-        # Can't save multiple sparse matrices to the same file, so do some
+    if fit_type == 'lineage' and 'n_samples' not in fit_object:
+        # Older models have a sparse matrix for each rank, so do some
         # file name processing
         fit_data = {}
-        for rank in fit_object[0]:
-            fit_file = os.path.basename(pkl_file)
-            prefix = re.match(r"^(.+)_fit\.pkl$", fit_file)
-            rank_file = os.path.dirname(pkl_file) + "/" + \
+        for rank in fit_object['ranks']:
+            fit_file = os.path.basename(npz_file)
+            prefix = re.match(r"^(.+)_fit\.npz$", fit_file)
+            rank_file = os.path.dirname(npz_file) + "/" + \
                         prefix.group(1) + rankFile(rank)
             fit_data[rank] = scipy.sparse.load_npz(rank_file)
     else:
@@ -92,14 +136,34 @@ def loadClusterFit(pkl_file, npz_file, outPrefix = "", max_samples = 100000):
         load_obj = RefineFit(outPrefix)
     elif fit_type == "lineage":
         sys.stderr.write("Loading lineage cluster model\n")
-        load_obj = LineageFit(outPrefix, fit_object[0])
+        load_obj = LineageFit(outPrefix, fit_object['ranks'])
     else:
         raise RuntimeError("Undefined model type: " + str(fit_type))
 
     load_obj.load(fit_data, fit_object)
+    if fit_type == "bgmm" or fit_type == "dbscan":
+        load_obj.load_raster(fit_data)
     sys.stderr.write("Completed model loading\n")
     return load_obj
 
+def readFitHeader(npz_file):
+    '''Read the JSON header of a saved model
+
+    Args:
+        npz_file (str)
+            Location of saved .npz file on disk
+    Returns:
+        header (dict)
+            The model type, format version and parameters. None if the
+            file does not exist or is from an older version without a header
+    '''
+    header = None
+    if os.path.isfile(npz_file):
+        with np.load(npz_file) as fit_npz:
+            if 'header' in fit_npz:
+                header = json.loads(str(fit_npz['header']))
+    return header
+
 class ClusterFit:
     '''Parent class for all models used to cluster distances
 
@@ -120,12 +184,14 @@ class ClusterFit:
         self.fitted = False
         self.indiv_fitted = False
         self.default_dtype = default_dtype
+        self.raster = None
 
 
     def fit(self, X = None):
         '''Initial steps for all fit functions.
 
-        Creates output directory. If preprocess is set then subsamples passed X
+        Creates output directory. If preprocess is set then summarises passed X
+        as weighted points with :func:`~PopPUNK.utils.distanceCoreset`
 
         Args:
             X (numpy.array)
@@ -150,12 +216,19 @@ class ClusterFit:
         # preprocess subsampling
         if self.preprocess:
             if X.shape[0] > self.max_samples:
-                self.subsampled_X = utils.shuffle(X, random_state=random.randint(1,10000))[0:self.max_samples,]
+                # weighted summary of all the distances, with weights normalised
+                # so the fit sees the same total as a max_samples subsample
+                self.subsampled_X, self.sample_weight, self.bin_widths, self.scale = \
+                    distanceCoreset(X, self.max_samples)
+                self.sample_weight *= self.max_samples / X.shape[0]
+                self.bin_widths /= self.scale
             else:
                 self.subsampled_X = np.copy(X)
+                self.sample_weight = np.ones(X.shape[0])
+                self.bin_widths = None
+                self.scale = np.amax(self.subsampled_X, axis = 0)
 
             # perform scaling
-            self.scale = np.amax(self.subsampled_X, axis = 0)
             self.subsampled_X /= self.scale
 
     def plot(self, X=None):
@@ -178,6 +251,58 @@ class ClusterFit:
         '''
         self.scale = np.array([1, 1], dtype = self.default_dtype)
 
+    def compile(self, assign_fn, resolution = 1024, points = None):
+        '''Compile the fit into a :class:`~PopPUNK.raster.DecisionRaster`
+        over the scaled distances, which is then used for assignment.
+
+        Args:
+            assign_fn (function)
+                Exact assignment function of the model, taking scaled
+                distances
+            resolution (int)
+                Number of cells along each axis of the raster
+
+                (default = 1024)
+            points (numpy.array)
+                Scaled distances the model was fitted to, so clusters
+                smaller than a cell are not missed
+
+                (default = None)
+        '''
+        self.raster = DecisionRaster(resolution)
+        self.raster.compile(assign_fn, np.ones(2), points = points)
+
+    def save_fit(self, header = None, **arrays):
+        '''Save the model to disk as an npz (using outPrefix), with a JSON
+        header giving the model type and any other parameters. The compiled
+        raster, if any, is included.
+
+        Args:
+            header (dict)
+                Parameters to save in the header. Must be JSON serialisable
+            arrays (numpy.array)
+                Named arrays to save
+        '''
+        fit_header = {'type': self.type, 'version': fit_format_version}
+        if header is not None:
+            fit_header.update(header)
+        if self.raster is not None:
+            arrays.update(self.raster.arrays('raster_'))
+        np.savez(self.outPrefix + "/" + os.path.basename(self.outPrefix) + '_fit.npz',
+                 header = np.array(json.dumps(fit_header)),
+                 **arrays)
+
+    def load_raster(self, fit_npz):
+        '''Load the raster saved with the model, if there is one.
+
+        Args:
+            fit_npz (dict)
+                Fit npz opened with :func:`numpy.load`
+        '''
+        if 'raster_labels' in fit_npz:
+            self.raster = DecisionRaster()
+            self.raster.load(fit_npz, 'raster_')
+
 
 class BGMMFit(ClusterFit):
     '''Class for fits using the Gaussian mixture model. Inherits from :class:`ClusterFit`.
@@ -201,31 +326,74 @@ class BGMMFit(ClusterFit):
         self.max_samples = max_samples
 
 
-    def fit(self, X, max_components):
+    def fit(self, X, max_components, sample_names = None, num_processes = 1,
+            start_model = None):
         '''Extends :func:`~ClusterFit.fit`
 
         Fits the BGMM and returns assignments by calling
         :func:`~PopPUNK.bgmm.fit2dMultiGaussian`.
 
+        If a list of maximum components is given, a model is fitted for each
+        with :func:`~PopPUNK.bgmm.fitMultiK`, and each is scored by its likelihood
+        and the network score from :func:`~PopPUNK.network.networkSummary`.
+        The model with the best network score is kept, and the comparison is
+        written to ``_K_sweep.csv``.
+
+        If a previous model is given, a single fit is started from it with
+        :func:`~PopPUNK.bgmm.fitWarmStart`, keeping its number of components.
+
         Fitted parameters are stored in the object.
 
         Args:
             X (numpy.array)
                 The core and accessory distances to cluster. Must be set if
                 preprocess is set.
-            max_components (int)
-                Maximum number of mixture components to use.
+            max_components (int or list)
+                Maximum number of mixture components to use, or a list of
+                these to compare.
+            sample_names (list)
+                Sample names corresponding to X, needed to score networks
+                when comparing more than one max_components.
+            num_processes (int)
+                Number of processes to fit the initialisations with
+
+                (default = 1)
+            start_model (BGMMFit)
+                A previous fit to start from, rather than random initialisations
+
+                (default = None)
 
         Returns:
             y (numpy.array)
                 Cluster assignments of samples in X
         '''
         ClusterFit.fit(self, X)
-        self.dpgmm = fit2dMultiGaussian(self.subsampled_X, max_components)
+        if isinstance(max_components, int):
+            max_components = [max_components]
+        if start_model is not None:
+            sys.stderr.write("Starting fit from previous model with K = " +
+                             str(start_model.means.shape[0]) + "\n")
+            init_resp = assign_samples(self.subsampled_X * self.scale, start_model.weights,
+                                       start_model.means, start_model.covariances,
+                                       start_model.scale, values = True)
+            self.dpgmm = fitWarmStart(self.subsampled_X, init_resp,
+                                      sample_weight = self.sample_weight)
+        elif len(max_components) == 1:
+            self.dpgmm = fit2dMultiGaussian(self.subsampled_X, max_components[0],
+                                            sample_weight = self.sample_weight,
+                                            num_processes = num_processes)
+        else:
+            if sample_names is None:
+                raise RuntimeError("Sample names needed to compare numbers of components")
+            fits = fitMultiK(self.subsampled_X, max_components,
+                             sample_weight = self.sample_weight,
+                             num_processes = num_processes)
+            self.dpgmm = self.compareK(X, fits, sample_names)
         self.weights = self.dpgmm.weights_
         self.means = self.dpgmm.means_
         self.covariances = self.dpgmm.covariances_
         self.fitted = True
+        self.compile(self.exact_assign, points = self.subsampled_X)
 
         y = self.assign(X)
         self.within_label = findWithinLabel(self.means, y)
@@ -233,20 +401,63 @@ class BGMMFit(ClusterFit):
         return y
 
 
+    def compareK(self, X, fits, sample_names):
+        '''Score BGMMs with different numbers of components, and write
+        the comparison to ``_K_sweep.csv``
+
+        Args:
+            X (numpy.array)
+                The core and accessory distances
+            fits (dict)
+                Fitted models for each maximum number of components, from
+                :func:`~PopPUNK.bgmm.fitMultiK`
+            sample_names (list)
+                Sample names corresponding to X
+
+        Returns:
+            dpgmm (MixtureFit)
+                Parameters of the model with the highest network score
+        '''
+        sys.stderr.write("Comparing fits with K = " + ",".join([str(K) for K in fits]) + "\n")
+        best_K = None
+        scores = {}
+        for K, dpgmm in fits.items():
+            mean_log_likelihood = np.average(log_likelihood(self.subsampled_X, dpgmm.weights_,
+                                                            dpgmm.means_, dpgmm.covariances_,
+                                                            np.ones(2))[0],
+                                             weights = self.sample_weight)
+            y = assign_samples(X, dpgmm.weights_, dpgmm.means_, dpgmm.covariances_, self.scale)
+            within_label = findWithinLabel(dpgmm.means_, y)
+            G = constructNetwork(sample_names, sample_names, y, within_label, summarise = False)
+            (components, density, transitivity, mean_bt, weighted_mean_bt), network_scores = \
+                networkSummary(G, calc_betweenness = False)
+            scores[K] = [np.unique(y).size, dpgmm.lower_bound_, mean_log_likelihood,
+                         components, density, transitivity, network_scores[0]]
+            if best_K is None or scores[K][-1] > scores[best_K][-1]:
+                best_K = K
+
+        with open(self.outPrefix + "/" + os.path.basename(self.outPrefix) + '_K_sweep.csv', 'w') as sweep_file:
+            sweep_file.write("K,components_used,lower_bound,log_likelihood,network_components,"
+                             "density,transitivity,score,selected\n")
+            for K, K_scores in scores.items():
+                sweep_file.write(",".join([str(K)] + [str(x) for x in K_scores] + [str(K == best_K)]) + "\n")
+
+        sys.stderr.write("Selected K = " + str(best_K) + " with network score " +
+                         "{:.4f}".format(scores[best_K][-1]) + "\n")
+        return fits[best_K]
+
+
     def save(self):
-        '''Save the model to disk, as an npz and pkl (using outPrefix).'''
+        '''Save the model to disk, as an npz (using outPrefix).'''
         if not self.fitted:
             raise RuntimeError("Trying to save unfitted model")
         else:
-            np.savez(self.outPrefix + "/" + os.path.basename(self.outPrefix) + '_fit.npz',
-             weights=self.weights,
-             means=self.means,
-             covariances=self.covariances,
-             within=self.within_label,
-             between=self.between_label,
-             scale=self.scale)
-            with open(self.outPrefix + "/" + os.path.basename(self.outPrefix) + '_fit.pkl', 'wb') as pickle_file:
-                pickle.dump([self.dpgmm, self.type], pickle_file)
+            self.save_fit(weights=self.weights,
+                          means=self.means,
+                          covariances=self.covariances,
+                          within=self.within_label,
+                          between=self.between_label,
+                          scale=self.scale)
 
 
     def load(self, fit_npz, fit_obj):
@@ -255,16 +466,16 @@ class BGMMFit(ClusterFit):
         Args:
             fit_npz (dict)
                 Fit npz opened with :func:`numpy.load`
-            fit_obj (sklearn.mixture.BayesianGaussianMixture)
-                The saved fit object
+            fit_obj (dict or sklearn.mixture.BayesianGaussianMixture)
+                The header of the saved model, or the pickled fit object
+                from older versions (not used)
         '''
-        self.dpgmm = fit_obj
         self.weights = fit_npz['weights']
         self.means = fit_npz['means']
         self.covariances = fit_npz['covariances']
         self.scale = fit_npz['scale']
-        self.within_label = np.asscalar(fit_npz['within'])
-        self.between_label = np.asscalar(fit_npz['between'])
+        self.within_label = int(fit_npz['within'])
+        self.between_label = int(fit_npz['between'])
         self.fitted = True
 
 
@@ -283,9 +494,12 @@ class BGMMFit(ClusterFit):
         ClusterFit.plot(self, X)
         # Generate a subsampling if one was not used in the fit
         if not hasattr(self, 'subsampled_X'):
-            self.subsampled_X = utils.shuffle(X, random_state=random.randint(1,10000))[0:self.max_samples,]
-
-        avg_entropy = np.mean(np.apply_along_axis(stats.entropy, 1, self.assign(self.subsampled_X, values = True)))
+            self.subsampled_X = shuffleRows(X, self.max_samples)
+            self.sample_weight = None
+        elif not hasattr(self, 'sample_weight'):
+            self.sample_weight = None
+        avg_entropy = np.average(np.apply_along_axis(stats.entropy, 1, self.assign(self.subsampled_X, values = True)),
+                                 weights = self.sample_weight)
         used_components = np.unique(y).size
         sys.stderr.write("Fit summary:\n" + "\n".join(["\tAvg. entropy of assignment\t" +  "{:.4f}".format(avg_entropy),
                                                         "\tNumber of components used\t" + str(used_components)]) + "\n\n")
@@ -302,7 +516,8 @@ class BGMMFit(ClusterFit):
 
 
     def assign(self, X, values = False):
-        '''Assign the clustering of new samples using :func:`~PopPUNK.bgmm.assign_samples`
+        '''Assign the clustering of new samples using the compiled raster, with
+        :func:`~PopPUNK.bgmm.assign_samples` near the boundary and for responsibilities
 
         Args:
             X (numpy.array)
@@ -315,12 +530,29 @@ class BGMMFit(ClusterFit):
         '''
         if not self.fitted:
             raise RuntimeError("Trying to assign using an unfitted model")
+        elif self.raster is not None and not values:
+            y = self.raster.assign(X, self.scale, self.exact_assign)
         else:
             y = assign_samples(X, self.weights, self.means, self.covariances, self.scale, values)
 
         return y
 
 
+    def exact_assign(self, X):
+        '''Assign scaled distances with the mixture model, rather than the
+        raster
+
+        Args:
+            X (numpy.array)
+                Scaled core and accessory distances
+        Returns:
+            y (numpy.array)
+                Cluster assignments by samples
+        '''
+        return assign_samples(X, self.weights, self.means, self.covariances,
+                              np.array([1, 1], dtype = X.dtype))
+
+
 class DBSCANFit(ClusterFit):
     '''Class for fits using HDBSCAN. Inherits from :class:`ClusterFit`.
 
@@ -365,6 +597,12 @@ class DBSCANFit(ClusterFit):
                 Cluster assignments of samples in X
         '''
         ClusterFit.fit(self, X)
+        self.raster = None
+        # hdbscan does not take weights, so expand the summarised points
+        if self.bin_widths is not None:
+            self.subsampled_X = expandCoreset(self.subsampled_X, self.sample_weight,
+                                              self.bin_widths, self.max_samples)
+            self.sample_weight = np.ones(self.subsampled_X.shape[0])
 
         # DBSCAN parameters
         cache_out = "./" + self.outPrefix + "_cache"
@@ -408,25 +646,26 @@ class DBSCANFit(ClusterFit):
         else:
             shutil.rmtree(cache_out)
 
+        self.compile(self.exact_assign, points = self.subsampled_X)
         y = self.assign(X)
         return y
 
 
     def save(self):
-        '''Save the model to disk, as an npz and pkl (using outPrefix).'''
+        '''Save the model to disk, as an npz (using outPrefix).
+
+        The compiled raster is saved for assignment, rather than the
+        hdbscan object.'''
         if not self.fitted:
             raise RuntimeError("Trying to save unfitted model")
         else:
-            np.savez(self.outPrefix + "/" + os.path.basename(self.outPrefix) + '_fit.npz',
-             n_clusters=self.n_clusters,
-             within=self.within_label,
-             between=self.between_label,
-             means=self.cluster_means,
-             maxs=self.cluster_maxs,
-             mins=self.cluster_mins,
-             scale=self.scale)
-            with open(self.outPrefix + "/" + os.path.basename(self.outPrefix) + '_fit.pkl', 'wb') as pickle_file:
-                pickle.dump([self.hdb, self.type], pickle_file)
+            self.save_fit(n_clusters=self.n_clusters,
+                          within=self.within_label,
+                          between=self.between_label,
+                          means=self.cluster_means,
+                          maxs=self.cluster_maxs,
+                          mins=self.cluster_mins,
+                          scale=self.scale)
 
 
     def load(self, fit_npz, fit_obj):
@@ -435,15 +674,19 @@ class DBSCANFit(ClusterFit):
         Args:
             fit_npz (dict)
                 Fit npz opened with :func:`numpy.load`
-            fit_obj (hdbscan.HDBSCAN)
-                The saved fit object
+            fit_obj (dict or hdbscan.HDBSCAN)
+                The header of the saved model, or the pickled fit object
+                from older versions (used for assignment if there is no raster)
         '''
-        self.hdb = fit_obj
-        self.labels = self.hdb.labels_
-        self.n_clusters = fit_npz['n_clusters']
+        if isinstance(fit_obj, dict):
+            self.hdb = None
+        else:
+            self.hdb = fit_obj
+            self.labels = self.hdb.labels_
+        self.n_clusters = int(fit_npz['n_clusters'])
         self.scale = fit_npz['scale']
-        self.within_label = np.asscalar(fit_npz['within'])
-        self.between_label = np.asscalar(fit_npz['between'])
+        self.within_label = int(fit_npz['within'])
+        self.between_label = int(fit_npz['between'])
         self.cluster_means = fit_npz['means']
         self.cluster_maxs = fit_npz['maxs']
         self.cluster_mins = fit_npz['mins']
@@ -464,10 +707,12 @@ class DBSCANFit(ClusterFit):
         '''
         ClusterFit.plot(self, X)
         # Generate a subsampling if one was not used in the fit
+        # (loaded models do not have the hdbscan labels either)
         if not hasattr(self, 'subsampled_X'):
-            self.subsampled_X = utils.shuffle(X, random_state=random.randint(1,10000))[0:self.max_samples,]
+            self.subsampled_X = shuffleRows(X, self.max_samples) / self.scale
+        subsampled_y = self.assign(self.subsampled_X, no_scale=True)
 
-        non_noise = np.sum(self.labels != -1)
+        non_noise = np.sum(subsampled_y != -1)
         sys.stderr.write("Fit summary:\n" + "\n".join(["\tNumber of clusters\t" + str(self.n_clusters),
                                                         "\tNumber of datapoints\t" + str(self.subsampled_X.shape[0]),
                                                         "\tNumber of assignments\t" + str(non_noise)]) + "\n\n")
@@ -478,13 +723,16 @@ class DBSCANFit(ClusterFit):
         sys.stderr.write("\n")
 
         plot_dbscan_results(self.subsampled_X * self.scale,
-                            self.assign(self.subsampled_X, no_scale=True),
+                            subsampled_y,
                             self.n_clusters,
                             self.outPrefix + "/" + os.path.basename(self.outPrefix) + "_dbscan")
 
 
     def assign(self, X, no_scale = False):
-        '''Assign the clustering of new samples using :func:`~PopPUNK.dbscan.assign_samples_dbscan`
+        '''Assign the clustering of new samples using the compiled raster, falling back
+        to :func:`~PopPUNK.dbscan.assign_samples_dbscan` near the boundary and
+        outside of the fitted distances if the hdbscan model is available.
+        Otherwise, distances outside of the fitted range are assigned as noise
 
         Args:
             X (numpy.array)
@@ -504,11 +752,31 @@ class DBSCANFit(ClusterFit):
                 scale = np.array([1, 1], dtype = X.dtype)
             else:
                 scale = self.scale
-            y = assign_samples_dbscan(X, self.hdb, scale)
+            if self.raster is not None:
+                if self.hdb is not None:
+                    y = self.raster.assign(X, scale, self.exact_assign)
+                else:
+                    # Without hdbscan, distances beyond the fit are noise
+                    y = self.raster.assign(X, scale, outside_label = -1)
+            else:
+                y = assign_samples_dbscan(X, self.hdb, scale)
 
         return y
 
 
+    def exact_assign(self, X):
+        '''Assign scaled distances with hdbscan, rather than the raster
+
+        Args:
+            X (numpy.array)
+                Scaled core and accessory distances
+        Returns:
+            y (numpy.array)
+                Cluster assignments by samples
+        '''
+        return assign_samples_dbscan(X, self.hdb, np.array([1, 1], dtype = X.dtype))
+
+
 class RefineFit(ClusterFit):
     '''Class for fits using a triangular boundary and network properties. Inherits from :class:`ClusterFit`.
 
@@ -530,7 +798,8 @@ class RefineFit(ClusterFit):
         self.unconstrained = False
 
     def fit(self, X, sample_names, model, max_move, min_move, startFile = None, indiv_refine = False,
-            unconstrained = False, score_idx = 0, no_local = False, threads = 1):
+            unconstrained = False, score_idx = 0, no_local = False, threads = 1,
+            adaptive = False, subsample = None, betweenness_sample = None):
         '''Extends :func:`~ClusterFit.fit`
 
         Fits the distances by optimising network score, by calling
@@ -545,7 +814,8 @@ class RefineFit(ClusterFit):
             sample_names (list)
                 Sample names in X (accessed by :func:`~PopPUNK.utils.iterDistRows`)
             model (ClusterFit)
-                The model fit to refine
+                The model fit to refine. If this is a previous refined fit,
+                the search starts from its boundary, within a narrower window
             max_move (float)
                 Maximum distance to move away from start point
             min_move (float)
@@ -571,6 +841,23 @@ class RefineFit(ClusterFit):
                 Number of threads to use in the global optimisation step.
 
                 (default = 1)
+            adaptive (bool)
+                Search with :func:`~PopPUNK.refine.adaptiveSearch`, saving
+                the score curves to ``<outPrefix>_refine_search.csv`` (and
+                ``_core`` and ``_accessory`` versions with indiv_refine)
+
+                (default = False)
+            subsample (int)
+                Search for the boundary using the distances between this many
+                samples, chosen by :func:`~PopPUNK.refine.stratifiedSubsample`,
+                then score it using all of the samples
+
+                (default = None)
+            betweenness_sample (float)
+                Estimate betweenness for score_idx 1 and 2 from a sample of
+                pivots, with this maximum error
+
+                (default = None)
         Returns:
             y (numpy.array)
                 Cluster assignments of samples in X
@@ -610,37 +897,137 @@ class RefineFit(ClusterFit):
                 sys.stderr.write("Could not find start point for refinement; intial model fit likely bad\n"
                                  "Try using --manual-start\n")
                 sys.exit(1)
+        elif model.type == 'refine':
+            if model.mean0 is None or model.mean1 is None:
+                sys.stderr.write("Previous refined model does not have a search line to start from; "
+                                 "refine from a BGMM or DBSCAN fit instead\n")
+                sys.exit(1)
+            sys.stderr.write("Initial network construction based on previous refined boundary\n")
+
+            # Start where the previous boundary crosses the line between the means
+            self.mean0 = model.mean0
+            self.mean1 = model.mean1
+            direction = transformLine(1, self.mean0, self.mean1) - self.mean0
+            self.start_s = None
+            if model.optimal_x > 0 and model.optimal_y > 0:
+                self.start_s = (1 - self.mean0[0] / model.optimal_x - self.mean0[1] / model.optimal_y) / \
+                               (direction[0] / model.optimal_x + direction[1] / model.optimal_y)
+            if self.start_s is None or not np.isfinite(self.start_s):
+                # Boundary does not cross the line, so start halfway between the means
+                sys.stderr.write("WARNING: Previous boundary has a zero intercept; "
+                                 "starting from the midpoint between the means\n")
+                self.start_s = 0.5 * (self.mean1[0] - self.mean0[0]) / direction[0]
+
+            # Search a narrower window around it
+            window = refine_update_window * euclidean(self.mean0, self.mean1)
+            if self.max_move is None:
+                self.max_move = window
+            if self.min_move is None:
+                self.min_move = window
         else:
             raise RuntimeError("Unrecognised model type")
 
-        # Main refinement in 2D
-        self.start_point, self.optimal_x, self.optimal_y, self.min_move, self.max_move = \
-          refineFit(X/self.scale,
-                    sample_names, self.start_s, self.mean0, self.mean1, self.max_move, self.min_move,
-                    slope = 2, score_idx = score_idx, unconstrained = unconstrained,
-                    no_local = no_local, num_processes = threads)
-        self.fitted = True
-
-        # Try and do a 1D refinement for both core and accessory
-        self.core_boundary = self.optimal_x
-        self.accessory_boundary = self.optimal_y
+        # Score curves of adaptive searches, by slope
+        search_files = {0: None, 1: None, 2: None}
+        if adaptive:
+            search_prefix = self.outPrefix + "/" + os.path.basename(self.outPrefix) + "_refine_search"
+            search_files = {0: search_prefix + "_core.csv",
+                            1: search_prefix + "_accessory.csv",
+                            2: search_prefix + ".csv"}
+
+        # Scale once, rather than for each search
+        scaled_X = X / self.scale
+
+        # Search using only the distances between a subsample, if requested
+        search_X = scaled_X
+        search_names = sample_names
+        if subsample is not None and subsample < len(sample_names):
+            sub_idx, dist_idx = stratifiedSubsample(scaled_X, len(sample_names), subsample,
+                                                    transformLine(self.start_s, self.mean0, self.mean1),
+                                                    self.mean1, threads)
+            search_X = scaled_X[dist_idx, :]
+            search_names = [sample_names[i] for i in sub_idx]
+
+        # Main refinement in 2D. If core and accessory are also refined, these
+        # are run at the same time, sharing the distances and the threads.
+        # The unconstrained search forks worker processes, which is not safe
+        # while other threads are running OpenMP, so it finishes first
+        if indiv_refine and not unconstrained:
+            indiv_threads = max(1, threads // 3)
+            combined_threads = max(1, threads - 2 * indiv_threads)
+        else:
+            indiv_threads = max(1, threads // 2)
+            combined_threads = threads
+        traces = {2: RefineTrace('combined')}
         if indiv_refine:
-            try:
+            traces[0] = RefineTrace('core')
+            traces[1] = RefineTrace('accessory')
+        with ThreadPoolExecutor(max_workers = 3 if indiv_refine else 1) as executor:
+            combined_search = executor.submit(refineFit, search_X,
+                    search_names, self.start_s, self.mean0, self.mean1, self.max_move, self.min_move,
+                    slope = 2, score_idx = score_idx, unconstrained = unconstrained,
+                    no_local = no_local, num_processes = combined_threads,
+                    adaptive = adaptive, search_file = search_files[2], trace = traces[2],
+                    betweenness_sample = betweenness_sample)
+            if unconstrained:
+                combined_search.result()
+            if indiv_refine:
                 sys.stderr.write("Refining core and accessory separately\n")
-                # optimise core distance boundary
-                start_point, self.core_boundary, core_acc, self.min_move, self.max_move = \
-                  refineFit(X/self.scale,
-                            sample_names, self.start_s, self.mean0, self.mean1, self.max_move, self.min_move,
-                            slope = 0, score_idx = score_idx, no_local = no_local,num_processes = threads)
-                # optimise accessory distance boundary
-                start_point, acc_core, self.accessory_boundary, self.min_move, self.max_move = \
-                  refineFit(X/self.scale,
-                            sample_names, self.start_s,self.mean0, self.mean1, self.max_move, self.min_move,
-                            slope = 1, score_idx = score_idx, no_local = no_local, num_processes = threads)
-                self.indiv_fitted = True
-            except RuntimeError as e:
-                sys.stderr.write("Could not separately refine core and accessory boundaries. "
-                                 "Using joint 2D refinement only.\n")
+                indiv_searches = [executor.submit(refineFit, search_X,
+                            search_names, self.start_s, self.mean0, self.mean1, self.max_move, self.min_move,
+                            slope = slope, score_idx = score_idx, no_local = no_local,
+                            num_processes = indiv_threads,
+                            adaptive = adaptive, search_file = search_files[slope],
+                            trace = traces[slope], betweenness_sample = betweenness_sample)
+                                  for slope in [0, 1]]
+
+            self.start_point, self.optimal_x, self.optimal_y, self.min_move, self.max_move = \
+                combined_search.result()
+            self.fitted = True
+
+            # Try and do a 1D refinement for both core and accessory
+            self.core_boundary = self.optimal_x
+            self.accessory_boundary = self.optimal_y
+            if indiv_refine:
+                try:
+                    # optimise core distance boundary
+                    start_point, self.core_boundary, core_acc, self.min_move, self.max_move = \
+                        indiv_searches[0].result()
+                    # optimise accessory distance boundary
+                    start_point, acc_core, self.accessory_boundary, self.min_move, self.max_move = \
+                        indiv_searches[1].result()
+                    self.indiv_fitted = True
+                except RuntimeError as e:
+                    sys.stderr.write("Could not separately refine core and accessory boundaries. "
+                                     "Using joint 2D refinement only.\n")
+
+        # Record where time went in each search, next to the plot of the fit
+        writeRefineTrace(traces.values(),
+                         self.outPrefix + "/" + os.path.basename(self.outPrefix) + "_refined_fit",
+                         settings = {'samples': len(search_names),
+                                     'distances': search_X.shape[0],
+                                     'score_idx': score_idx,
+                                     'no_local': no_local,
+                                     'unconstrained': unconstrained,
+                                     'adaptive': adaptive,
+                                     'betweenness_sample': betweenness_sample,
+                                     'threads': threads})
+
+        # Check the boundaries found with the subsample against all of the samples
+        if search_names is not sample_names:
+            boundaries = [('refined', self.optimal_x, self.optimal_y, 2)]
+            if self.indiv_fitted:
+                boundaries += [('core', self.core_boundary, 0, 0),
+                               ('accessory', 0, self.accessory_boundary, 1)]
+            for name, x_max, y_max, slope in boundaries:
+                sub_score = boundaryScore(x_max, y_max, search_names,
+                                          search_X, slope, score_idx, threads,
+                                          betweenness_sample = betweenness_sample)
+                full_score = boundaryScore(x_max, y_max, sample_names,
+                                           scaled_X, slope, score_idx, threads,
+                                           betweenness_sample = betweenness_sample)
+                sys.stderr.write("Network score of " + name + " boundary: " + "{:.4f}".format(sub_score) +
+                                 " with subsample, " + "{:.4f}".format(full_score) + " with all samples\n")
 
         y = self.assign(X)
         return y
@@ -687,17 +1074,18 @@ class RefineFit(ClusterFit):
         return y
 
     def save(self):
-        '''Save the model to disk, as an npz and pkl (using outPrefix).'''
+        '''Save the model to disk, as an npz (using outPrefix).'''
         if not self.fitted:
             raise RuntimeError("Trying to save unfitted model")
         else:
-            np.savez(self.outPrefix + "/" + os.path.basename(self.outPrefix) + '_fit.npz',
-             intercept=np.array([self.optimal_x, self.optimal_y]),
-             core_acc_intercepts=np.array([self.core_boundary, self.accessory_boundary]),
-             scale=self.scale,
-             indiv_fitted=self.indiv_fitted)
-            with open(self.outPrefix + "/" + os.path.basename(self.outPrefix) + '_fit.pkl', 'wb') as pickle_file:
-                pickle.dump([None, self.type], pickle_file)
+            search_line = {}
+            if self.mean0 is not None and self.mean1 is not None:
+                search_line = {'mean0': self.mean0, 'mean1': self.mean1}
+            self.save_fit(intercept=np.array([self.optimal_x, self.optimal_y]),
+                          core_acc_intercepts=np.array([self.core_boundary, self.accessory_boundary]),
+                          scale=self.scale,
+                          indiv_fitted=self.indiv_fitted,
+                          **search_line)
 
 
     def load(self, fit_npz, fit_obj):
@@ -706,25 +1094,31 @@ class RefineFit(ClusterFit):
         Args:
             fit_npz (dict)
                 Fit npz opened with :func:`numpy.load`
-            fit_obj (None)
-                The saved fit object (not used)
+            fit_obj (dict or None)
+                The header of the saved model (not used)
         '''
-        self.optimal_x = np.asscalar(fit_npz['intercept'][0])
-        self.optimal_y = np.asscalar(fit_npz['intercept'][1])
-        self.core_boundary = np.asscalar(fit_npz['core_acc_intercepts'][0])
-        self.accessory_boundary = np.asscalar(fit_npz['core_acc_intercepts'][1])
+        self.optimal_x = float(fit_npz['intercept'][0])
+        self.optimal_y = float(fit_npz['intercept'][1])
+        self.core_boundary = float(fit_npz['core_acc_intercepts'][0])
+        self.accessory_boundary = float(fit_npz['core_acc_intercepts'][1])
         self.scale = fit_npz['scale']
         self.fitted = True
         if 'indiv_fitted' in fit_npz:
-            self.indiv_fitted = fit_npz['indiv_fitted']
+            self.indiv_fitted = bool(fit_npz['indiv_fitted'])
         else:
             self.indiv_fitted = False # historical behaviour for backward compatibility
         if np.isnan(self.optimal_y) and np.isnan(self.accessory_boundary):
             self.threshold = True
 
+        # search line, used to update the fit
+        if 'mean0' in fit_npz and 'mean1' in fit_npz:
+            self.mean0 = fit_npz['mean0']
+            self.mean1 = fit_npz['mean1']
+        else:
+            self.mean0 = None
+            self.mean1 = None
+
         # blank values to pass to plot (used in --use-model)
-        self.mean0 = None
-        self.mean1 = None
         self.start_point = None
         self.min_move = None
         self.max_move = None
@@ -746,7 +1140,7 @@ class RefineFit(ClusterFit):
         # Subsamples huge plots to save on memory
         max_points = int(0.5*(5000)**2)
         if X.shape[0] > max_points:
-            plot_X = utils.shuffle(X, random_state=random.randint(1, 10000))[0:max_points, ]
+            plot_X = shuffleRows(X, max_points)
         else:
             plot_X = X
 
@@ -815,7 +1209,9 @@ class LineageFit(ClusterFit):
     def fit(self, X, accessory, threads):
         '''Extends :func:`~ClusterFit.fit`
 
-        Gets assignments by using nearest neigbours.
+        Gets assignments by using nearest neigbours. These are found once at
+        the highest rank with :func:`~PopPUNK.lineage.condensedNeighbours`, and
+        each neighbour stores its rank so lower ranks are a cutoff.
 
         Args:
             X (numpy.array)
@@ -841,19 +1237,10 @@ class LineageFit(ClusterFit):
         else:
             self.dist_col = 0
 
-        self.nn_dists = {}
-        for rank in self.ranks:
-            row, col, data = \
-                pp_sketchlib.sparsifyDists(
-                    pp_sketchlib.longToSquare(X[:, [self.dist_col]], threads),
-                    0,
-                    rank,
-                    threads
-                )
-            data = [epsilon if d < epsilon else d for d in data]
-            self.nn_dists[rank] = coo_matrix((data, (row, col)),
-                                             shape=(sample_size, sample_size),
-                                             dtype = X.dtype)
+        # Neighbours at the highest rank, which contain those at all lower ranks
+        self.n_samples = sample_size
+        self.nn_row, self.nn_col, self.nn_dist, self.nn_rank = \
+            condensedNeighbours(X[:, self.dist_col], sample_size, max(self.ranks), threads)
 
         self.fitted = True
 
@@ -861,32 +1248,66 @@ class LineageFit(ClusterFit):
         return y
 
     def save(self):
-        '''Save the model to disk, as an npz and pkl (using outPrefix).'''
+        '''Save the model to disk, as an npz for each rank and an npz
+        with the header (using outPrefix).'''
         if not self.fitted:
             raise RuntimeError("Trying to save unfitted model")
         else:
+            # Sparse matrix for each rank, used by poppunk_mst
             for rank in self.ranks:
                 scipy.sparse.save_npz(
                     self.outPrefix + "/" + os.path.basename(self.outPrefix) + \
                     rankFile(rank),
-                    self.nn_dists[rank])
-            with open(self.outPrefix + "/" + os.path.basename(self.outPrefix) + \
-                      '_fit.pkl', 'wb') as pickle_file:
-                pickle.dump([[self.ranks, self.dist_col], self.type], pickle_file)
+                    self.nn_dists(rank))
+            self.save_fit({'ranks': self.ranks,
+                           'dist_col': self.dist_col,
+                           'n_samples': self.n_samples},
+                          nn_row=self.nn_row,
+                          nn_col=self.nn_col,
+                          nn_dist=self.nn_dist,
+                          nn_rank=self.nn_rank)
 
     def load(self, fit_npz, fit_obj):
         '''Load the model from disk. Called from :func:`~loadClusterFit`
 
         Args:
             fit_npz (dict)
-                Fit npz opened with :func:`numpy.load`
-            fit_obj (sklearn.mixture.BayesianGaussianMixture)
-                The saved fit object
+                Fit npz opened with :func:`numpy.load`, or the sparse
+                distance matrix for each rank for older models
+            fit_obj (dict)
+                The header of the saved model, with ranks and dist_col
         '''
-        self.ranks, self.dist_col = fit_obj
-        self.nn_dists = fit_npz
+        self.ranks = fit_obj['ranks']
+        self.dist_col = fit_obj['dist_col']
+        if 'n_samples' in fit_obj:
+            self.n_samples = fit_obj['n_samples']
+            self.nn_row = fit_npz['nn_row']
+            self.nn_col = fit_npz['nn_col']
+            self.nn_dist = fit_npz['nn_dist']
+            self.nn_rank = fit_npz['nn_rank']
+        else:
+            max_rank_dists = fit_npz[max(self.ranks)]
+            self.n_samples = max_rank_dists.shape[0]
+            self.nn_row, self.nn_col, self.nn_dist, self.nn_rank = \
+                selectNeighbours(max_rank_dists.row, max_rank_dists.col,
+                                 max_rank_dists.data, max(self.ranks))
         self.fitted = True
 
+    def nn_dists(self, rank):
+        '''Sparse matrix of the nearest neighbour distances at a rank
+
+        Args:
+            rank (int)
+                Rank to get neighbours at
+        Returns:
+            nn_dists (scipy.sparse.coo_matrix)
+                Distances to the neighbours of each sample
+        '''
+        in_rank = self.nn_rank <= rank
+        return coo_matrix((self.nn_dist[in_rank], (self.nn_row[in_rank], self.nn_col[in_rank])),
+                          shape=(self.n_samples, self.n_samples),
+                          dtype = self.nn_dist.dtype)
+
     def plot(self, X):
         '''Extends :func:`~ClusterFit.plot`
 
@@ -899,7 +1320,7 @@ class LineageFit(ClusterFit):
         '''
         ClusterFit.plot(self, X)
         for rank in self.ranks:
-            distHistogram(self.nn_dists[rank].data,
+            distHistogram(self.nn_dist[self.nn_rank <= rank],
                           rank,
                           self.outPrefix + "/" + os.path.basename(self.outPrefix))
 
@@ -912,18 +1333,37 @@ class LineageFit(ClusterFit):
             rank (int)
                 Rank to assign at
         Returns:
-            y (list of tuples)
-                Edges to include in network
+            y (numpy.array)
+                n_edges x 2 array of edges to include in network
         '''
         if not self.fitted:
             raise RuntimeError("Trying to assign using an unfitted model")
         else:
-            y = []
-            for row, col in zip(self.nn_dists[rank].row, self.nn_dists[rank].col):
-                y.append((row, col))
+            in_rank = self.nn_rank <= rank
+            y = np.column_stack((self.nn_row[in_rank], self.nn_col[in_rank]))
 
         return y
 
+    def clusters(self, rank_list = None):
+        '''Get the clusters of the network at each rank, without making
+        the networks, using :func:`~PopPUNK.lineage.lineageClusters`
+
+        Args:
+            rank_list (list)
+                Ranks to cluster at. If None, all fitted ranks
+
+                [default = None]
+        Returns:
+            clusters (dict)
+                Cluster of each sample (numpy.array), keyed by rank
+        '''
+        if not self.fitted:
+            raise RuntimeError("Trying to cluster using an unfitted model")
+        if rank_list is None:
+            rank_list = self.ranks
+        return lineageClusters(self.nn_row, self.nn_col, self.nn_rank,
+                               self.n_samples, rank_list)
+
     def edge_weights(self, rank):
         '''Get the distances for each edge returned by assign
 
@@ -931,62 +1371,67 @@ class LineageFit(ClusterFit):
             rank (int)
                 Rank assigned at
         Returns:
-            weights (list)
+            weights (numpy.array)
                 Distance for each assignment
         '''
         if not self.fitted:
             raise RuntimeError("Trying to get weights from an unfitted model")
         else:
-            return (self.nn_dists[rank].data)
+            return (self.nn_dist[self.nn_rank <= rank])
 
-    def extend(self, qqDists, qrDists):
-        # Reshape qq and qr dist matrices
-        qqSquare = pp_sketchlib.longToSquare(qqDists[:, [self.dist_col]], 1)
-        qqSquare[qqSquare < epsilon] = epsilon
+    def query_pairs(self, qrDists):
+        '''Find which distances between queries are needed to extend the fit,
+        using :func:`~PopPUNK.lineage.queryCandidatePairs`
 
-        n_ref = self.nn_dists[self.ranks[0]].shape[0]
-        n_query = qqSquare.shape[1]
-        qrRect = qrDists[:, [self.dist_col]].reshape(n_query, n_ref)
-        qrRect[qrRect < epsilon] = epsilon
+        Args:
+            qrDists (numpy.array)
+                Long form core and accessory distances from queries to references
+        Returns:
+            pair_i (numpy.array)
+                Index of the first query of each pair
+            pair_j (numpy.array)
+                Index of the second query of each pair
+        '''
+        n_query = qrDists.shape[0] // self.n_samples
+        qrRect = qrDists[:, self.dist_col].reshape(n_query, self.n_samples)
+        return queryCandidatePairs(qrRect, max(self.ranks))
 
-        for rank in self.ranks:
-            # Add the matrices together to make a large square matrix
-            full_mat = bmat([[self.nn_dists[rank], qrRect.transpose()],
-                             [qrRect,              qqSquare]],
-                            format = 'csr',
-                            dtype = self.nn_dists[rank].dtype)
-
-            # Reapply the rank to each row, using sparse matrix functions
-            data = []
-            row = []
-            col = []
-            for row_idx in range(full_mat.shape[0]):
-                sample_row = full_mat.getrow(row_idx)
-                dist_row, dist_col, dist = find(sample_row)
-                dist = [epsilon if d < epsilon else d for d in dist]
-                dist_idx_sort = np.argsort(dist)
-
-                # Identical to C++ code in matrix_ops.cpp:sparsify_dists
-                neighbours = 0
-                prev_val = -1
-                for sort_idx in dist_idx_sort:
-                    if row_idx == dist_col[sort_idx]:
-                        continue
-                    new_val = abs(dist[sort_idx] - prev_val) < epsilon
-                    if (neighbours < rank or new_val):
-                        data.append(dist[sort_idx])
-                        row.append(row_idx)
-                        col.append(dist_col[sort_idx])
-
-                        if not new_val:
-                            neighbours += 1
-                            prev_val = data[-1]
-                    else:
-                        break
-
-            self.nn_dists[rank] = coo_matrix((data, (row, col)),
-                                    shape=(full_mat.shape[0], full_mat.shape[0]),
-                                    dtype = self.nn_dists[rank].dtype)
+    def extend(self, qqDists, qrDists, qq_pairs = None):
+        '''Add new queries to the nearest neighbours of the fit, for all ranks.
+
+        Neighbours are found at the maximum rank with
+        :func:`~PopPUNK.lineage.extendNeighbours` (which only updates reference
+        rows which a query enters), which contains all lower ranks.
+
+        Args:
+            qqDists (numpy.array)
+                Long form core and accessory distances between queries, or
+                distances between the pairs in qq_pairs
+            qrDists (numpy.array)
+                Long form core and accessory distances from queries to references
+            qq_pairs (tuple)
+                Indices of the query pairs in qqDists, from :func:`~LineageFit.query_pairs`.
+                If None, qqDists are between all queries
+
+                [default = None]
+        Returns:
+            y (numpy.array)
+                Edges to include in network, at the lowest rank
+        '''
+        max_rank = max(self.ranks)
+        n_ref = self.n_samples
+        n_query = qrDists.shape[0] // n_ref
+        qrRect = qrDists[:, self.dist_col].reshape(n_query, n_ref)
+        if qq_pairs is None:
+            qqSquare = pp_sketchlib.longToSquare(qqDists[:, [self.dist_col]], 1)
+        else:
+            qqSquare = coo_matrix((qqDists[:, self.dist_col], qq_pairs),
+                                  shape = (n_query, n_query))
+
+        self.nn_row, self.nn_col, self.nn_dist, self.nn_rank = \
+            extendNeighbours(self.nn_row, self.nn_col, self.nn_dist,
+                             qrRect, qqSquare, max_rank)
+        self.n_samples = n_ref + n_query
 
         y = self.assign(min(self.ranks))
         return y
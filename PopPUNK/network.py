@@ -9,25 +9,22 @@ import sys
 import re
 # additional
 import glob
-import operator
 import shutil
 import subprocess
 import numpy as np
 import pandas as pd
 from scipy.stats import rankdata
 from tempfile import mkstemp, mkdtemp
-from collections import defaultdict, Counter
-from functools import partial
-from multiprocessing import Pool
+from collections import defaultdict
 import graph_tool.all as gt
 import dendropy
+import poppunk_refine
 
 from .__main__ import accepted_weights_types
 
 from .sketchlib import addRandom
 
-from .utils import iterDistRows
-from .utils import listDistInts
+from .utils import listDistIntArrays
 from .utils import readIsolateTypeFromCsv
 from .utils import readRfile
 from .utils import setupDBFuncs
@@ -95,49 +92,6 @@ def fetchNetwork(network_dir, model, refList, ref_graph = False,
 
     return (genomeNetwork, cluster_file)
 
-def getCliqueRefs(G, reference_indices = set()):
-    """Recursively prune a network of its cliques. Returns one vertex from
-    a clique at each stage
-
-    Args:
-        G (graph)
-            The graph to get clique representatives from
-        reference_indices (set)
-            The unique list of vertices being kept, to add to
-    """
-    cliques = gt.max_cliques(G)
-    try:
-        # Get the first clique, and see if it has any members already
-        # contained in the vertex list
-        clique = frozenset(next(cliques))
-        if clique.isdisjoint(reference_indices):
-            reference_indices.add(list(clique)[0])
-
-        # Remove the clique, and prune the resulting subgraph (recursively)
-        subgraph = gt.GraphView(G, vfilt=[v not in clique for v in G.vertices()])
-        if subgraph.num_vertices() > 1:
-            getCliqueRefs(subgraph, reference_indices)
-        elif subgraph.num_vertices() == 1:
-            reference_indices.add(subgraph.get_vertices()[0])
-    except StopIteration:
-        pass
-    return reference_indices
-
-def cliquePrune(component, graph, reference_indices, components_list):
-    """Wrapper function around :func:`~getCliqueRefs` so it can be
-       called by a multiprocessing pool
-    """
-    if gt.openmp_enabled():
-        gt.openmp_set_num_threads(1)
-    subgraph = gt.GraphView(graph, vfilt=components_list == component)
-    refs = reference_indices.copy()
-    if subgraph.num_vertices() <= 2:
-        refs.add(subgraph.get_vertices()[0])
-        ref_list = refs
-    else:
-        ref_list = getCliqueRefs(subgraph, refs)
-    return(list(ref_list))
-
 def extractReferences(G, dbOrder, outPrefix, existingRefs = None, threads = 1):
     """Extract references for each cluster based on cliques
 
@@ -167,34 +121,21 @@ def extractReferences(G, dbOrder, outPrefix, existingRefs = None, threads = 1):
         index_lookup = {v:k for k,v in enumerate(dbOrder)}
         reference_indices = set([index_lookup[r] for r in references])
 
-    # Each component is independent, so can be multithreaded
-    components = gt.label_components(G)[0].a
-
-    # Turn gt threading off and on again either side of the parallel loop
-    if gt.openmp_enabled():
-        gt.openmp_set_num_threads(1)
-
+    # Each component is independent, so can be multithreaded (largest first,
+    # each using only its own edges)
     # Cliques are pruned, taking one reference from each, until none remain
-    with Pool(processes=threads) as pool:
-        ref_lists = pool.map(partial(cliquePrune,
-                                        graph=G,
-                                        reference_indices=reference_indices,
-                                        components_list=components),
-                             set(components))
-    # Returns nested lists, which need to be flattened
-    reference_indices = set([entry for sublist in ref_lists for entry in sublist])
-
-    if gt.openmp_enabled():
-        gt.openmp_set_num_threads(threads)
+    components = gt.label_components(G)[0].a
+    edges = G.get_edges()
+    reference_array = poppunk_refine.cliqueCover(edges[:, 0], edges[:, 1],
+                                                 components,
+                                                 np.array(sorted(reference_indices), dtype = np.int64),
+                                                 num_threads = threads)
+    reference_indices = set(reference_array.tolist())
 
     # Use a vertex filter to extract the subgraph of refences
     # as a graphview
     reference_vertex = G.new_vertex_property('bool')
-    for n, vertex in enumerate(G.vertices()):
-        if n in reference_indices:
-            reference_vertex[vertex] = True
-        else:
-            reference_vertex[vertex] = False
+    reference_vertex.a[reference_array] = True
     G_ref = gt.GraphView(G, vfilt = reference_vertex)
     G_ref = gt.Graph(G_ref, prune = True) # https://stackoverflow.com/questions/30839929/graph-tool-graphview-object
 
@@ -206,7 +147,7 @@ def extractReferences(G, dbOrder, outPrefix, existingRefs = None, threads = 1):
         reference_clusters_in_full_graph[clusters_in_full_graph[dbOrder[reference_index]]].add(reference_index)
 
     # Calculate the component membership within the reference graph
-    ref_order = [name for idx, name in enumerate(dbOrder) if idx in frozenset(reference_indices)]
+    ref_order = [dbOrder[idx] for idx in reference_array]
     clusters_in_reference_graph = printClusters(G_ref, ref_order, printCSV=False)
     # Record the components/clusters the references are in the reference graph
     # dict: name: ref_cluster
@@ -288,7 +229,8 @@ def constructNetwork(rlist, qlist, assignments, within_label,
             Whether to calculate and print network summaries with :func:`~networkSummary`
             (default = True)
         edge_list (bool)
-            Whether input is edges, tuples of (v1, v2). Used with lineage assignment
+            Whether input is edges, an n_edges x 2 array (or list of tuples) of
+            (v1, v2). Used with lineage assignment
         weights (numpy.array)
             If passed, the core,accessory distances for each assignment, which will
             be annotated as an edge attribute
@@ -317,36 +259,30 @@ def constructNetwork(rlist, qlist, assignments, within_label,
         sys.stderr.write("Unable to calculate distance type " + str(weights_type) + "; "
                          "accepted types are " + str(accepted_weights_types) + "\n")
         sys.exit(1)
-    if edge_list and sparse_input:
+    if edge_list and sparse_input is not None:
         raise RuntimeError("Cannot construct network from edge list and sparse matrix")
 
     # identify edges
     connections = []
     if edge_list:
+        connections = np.asarray(assignments).reshape(-1, 2)
         if weights is not None:
-            for weight, (ref, query) in zip(weights, assignments):
-                connections.append((ref, query, weight))
-        else:
-            connections = assignments
+            connections = np.column_stack((connections, weights))
     elif sparse_input is not None:
-        for ref, query, weight in zip(sparse_input.row, sparse_input.col, sparse_input.data):
-            connections.append((ref, query, weight))
+        connections = np.column_stack((sparse_input.row, sparse_input.col, sparse_input.data))
     else:
-        for row_idx, (assignment, (ref, query)) in enumerate(zip(assignments,
-                                                                 listDistInts(rlist, qlist,
-                                                                              self = self_comparison))):
-            if assignment == within_label:
-                if weights is not None:
-                    if weights_type == 'euclidean':
-                        dist = np.linalg.norm(weights[row_idx, :])
-                    elif weights_type == 'core':
-                        dist = weights[row_idx, 0]
-                    elif weights_type == 'accessory':
-                        dist = weights[row_idx, 1]
-                    edge_tuple = (ref, query, dist)
-                else:
-                    edge_tuple = (ref, query)
-                connections.append(edge_tuple)
+        rows = np.flatnonzero(np.asarray(assignments) == within_label)
+        ref, query = listDistIntArrays(rows, len(rlist), len(qlist), self = self_comparison)
+        if weights is not None:
+            if weights_type == 'euclidean':
+                dist = np.linalg.norm(weights[rows, :], axis = 1)
+            elif weights_type == 'core':
+                dist = weights[rows, 0]
+            elif weights_type == 'accessory':
+                dist = weights[rows, 1]
+            connections = np.column_stack((ref, query, dist))
+        else:
+            connections = np.column_stack((ref, query))
 
     # build the graph
     G = gt.Graph(directed = False)
@@ -379,7 +315,75 @@ def constructNetwork(rlist, qlist, assignments, within_label,
 
     return G
 
-def networkSummary(G, calc_betweenness=True):
+def boundaryNetwork(model, distMat, rlist, qlist, slope, outPrefix, externalClusterCSV = None):
+    """Construct the network from one of the boundaries of a refined fit,
+    then write its clusters and save it.
+
+    Args:
+        model (RefineFit)
+            The fitted model
+        distMat (numpy.array)
+            n x 2 array of core and accessory distances
+        rlist (list)
+            List of reference sequence labels
+        qlist (list)
+            List of query sequence labels
+        slope (int)
+            Boundary to use. 0 for core, 1 for accessory, 2 for combined
+        outPrefix (str)
+            Prefix for the clusters CSV and network file
+        externalClusterCSV (str)
+            CSV with cluster assignments from any source. Will print a file
+            relating these to new cluster assignments
+
+            [default = None]
+    Returns:
+        G (graph)
+            The network
+        clustering (dict)
+            Dictionary of cluster assignments (keys are sequence names)
+    """
+    assignments = model.assign(distMat, slope)
+    G = constructNetwork(rlist, qlist, assignments, model.within_label)
+    clustering = printClusters(G, rlist, outPrefix,
+                               externalClusterCSV = externalClusterCSV)
+    G.save(outPrefix + '_graph.gt', fmt = 'gt')
+    return G, clustering
+
+def betweennessPivots(G, betweenness_sample, confidence = 0.9, seed = 0):
+    """Choose pivots to estimate betweenness from, so the normalised
+    betweenness of every vertex is within betweenness_sample of its exact
+    value with probability confidence (by a Hoeffding bound)
+
+    Args:
+        G (graph)
+            The network to estimate betweenness in
+        betweenness_sample (float)
+            Maximum error of the estimate. If None, betweenness is exact
+        confidence (float)
+            Probability that no estimate exceeds the error
+
+            (default = 0.9)
+        seed (int)
+            Seed for choosing pivots
+
+            (default = 0)
+
+    Returns:
+        pivots (numpy.array)
+            Vertices to use as pivots in :func:`graph_tool.centrality.betweenness`,
+            or None if all vertices are needed
+    """
+    if betweenness_sample is None:
+        return None
+    vertices = G.get_vertices()
+    num_pivots = int(np.ceil(np.log(2 * vertices.size / (1 - confidence)) /
+                             (2 * betweenness_sample**2)))
+    if num_pivots >= vertices.size:
+        return None
+    return np.random.default_rng(seed).choice(vertices, num_pivots, replace = False)
+
+def networkSummary(G, calc_betweenness=True, betweenness_sample=None):
     """Provides summary values about the network
 
     Args:
@@ -387,6 +391,11 @@ def networkSummary(G, calc_betweenness=True):
             The network of strains from :func:`~constructNetwork`
         calc_betweenness (bool)
             Whether to calculate betweenness stats
+        betweenness_sample (float)
+            Estimate betweenness from pivots chosen by :func:`~betweennessPivots`
+            with this maximum error, rather than exactly
+
+            (default = None)
 
     Returns:
         metrics (list)
@@ -397,7 +406,8 @@ def networkSummary(G, calc_betweenness=True):
     """
     component_assignments, component_frequencies = gt.label_components(G)
     components = len(component_frequencies)
-    density = len(list(G.edges()))/(0.5 * len(list(G.vertices())) * (len(list(G.vertices())) - 1))
+    num_vertices = G.num_vertices()
+    density = G.num_edges()/(0.5 * num_vertices * (num_vertices - 1))
     transitivity = gt.global_clustering(G)[0]
 
     mean_bt = 0
@@ -409,7 +419,9 @@ def networkSummary(G, calc_betweenness=True):
             if size > 3:
                 vfilt = component_assignments.a == component
                 subgraph = gt.GraphView(G, vfilt=vfilt)
-                betweenness.append(max(gt.betweenness(subgraph, norm = True)[0].a))
+                betweenness.append(max(gt.betweenness(subgraph,
+                                                      pivots = betweennessPivots(subgraph, betweenness_sample),
+                                                      norm = True)[0].a))
                 sizes.append(size)
 
         if len(betweenness) > 1:
@@ -421,6 +433,31 @@ def networkSummary(G, calc_betweenness=True):
     scores = [base_score, base_score * (1 - metrics[3]), base_score * (1 - metrics[4])]
     return(metrics, scores)
 
+def queryEdges(vertex1, vertex2, weights = None, rows = None):
+    """Stack edges found by :func:`~addQueryToNetwork` into an array for
+    ``add_edge_list``, with euclidean distances as weights if given
+
+    Args:
+        vertex1 (numpy.array)
+            First vertex of each edge
+        vertex2 (numpy.array)
+            Second vertex of each edge
+        weights (numpy.array)
+            Core and accessory distances, to weight edges by
+
+            (default = None)
+        rows (numpy.array)
+            Rows of weights for each edge
+
+            (default = None)
+    Returns:
+        edges (numpy.array)
+            n_edges x 2 array, or n_edges x 3 with weights
+    """
+    if weights is not None:
+        return np.column_stack((vertex1, vertex2, np.linalg.norm(weights[rows, :], axis = 1)))
+    return np.column_stack((vertex1, vertex2))
+
 def addQueryToNetwork(dbFuncs, rList, qList, G, kmers,
                       assignments, model, queryDB, queryQuery = False,
                       strand_preserved = False, weights = None, threads = 1):
@@ -467,23 +504,18 @@ def addQueryToNetwork(dbFuncs, rList, qList, G, kmers,
 
     # initialise links data structure
     new_edges = []
-    assigned = set()
 
     # These are returned
     qqDistMat = None
 
-    # store links for each query in a list of edge tuples
+    # store links for each query as arrays of edges
+    # query index needs to be adjusted for existing vertices in network
     ref_count = len(rList)
-    for row_idx, (assignment, (ref, query)) in enumerate(zip(assignments, listDistInts(rList, qList, self = False))):
-        if assignment == model.within_label:
-            # query index needs to be adjusted for existing vertices in network
-            if weights is not None:
-                dist = np.linalg.norm(weights[row_idx, :])
-                edge_tuple = (ref, query + ref_count, dist)
-            else:
-                edge_tuple = (ref, query + ref_count)
-            new_edges.append(edge_tuple)
-            assigned.add(qList[query])
+    rows = np.flatnonzero(np.asarray(assignments) == model.within_label)
+    ref, query = listDistIntArrays(rows, ref_count, len(qList), self = False)
+    new_edges.append(queryEdges(ref, query + ref_count, weights, rows))
+    assigned = np.zeros(len(qList), dtype = bool)
+    assigned[query] = True
 
     # Calculate all query-query distances too, if updating database
     if queryQuery:
@@ -499,19 +531,15 @@ def addQueryToNetwork(dbFuncs, rList, qList, G, kmers,
                                                   threads = threads)
 
         queryAssignation = model.assign(qqDistMat)
-        for row_idx, (assignment, (ref, query)) in enumerate(zip(queryAssignation, listDistInts(qList, qList, self = True))):
-            if assignment == model.within_label:
-                if weights is not None:
-                    dist = np.linalg.norm(qqDistMat[row_idx, :])
-                    edge_tuple = (ref + ref_count, query + ref_count, dist)
-                else:
-                    edge_tuple = (ref + ref_count, query + ref_count)
-                new_edges.append(edge_tuple)
+        rows = np.flatnonzero(np.asarray(queryAssignation) == model.within_label)
+        query1, query2 = listDistIntArrays(rows, len(qList))
+        new_edges.append(queryEdges(query1 + ref_count, query2 + ref_count,
+                                    None if weights is None else qqDistMat, rows))
 
     # Otherwise only calculate query-query distances for new clusters
     else:
         # identify potentially new lineages in list: unassigned is a list of queries with no hits
-        unassigned = set(qList).difference(assigned)
+        unassigned = [name for name, hit in zip(qList, assigned) if not hit]
         query_indices = {k:v+ref_count for v,k in enumerate(qList)}
         # process unassigned query sequences, if there are any
         if len(unassigned) > 1:
@@ -519,8 +547,8 @@ def addQueryToNetwork(dbFuncs, rList, qList, G, kmers,
 
             # use database construction methods to find links between unassigned queries
             addRandom(queryDB, qList, kmers, strand_preserved, threads = threads)
-            qlist1, qlist2, qqDistMat = queryDatabase(rNames = list(unassigned),
-                                                    qNames = list(unassigned),
+            qlist1, qlist2, qqDistMat = queryDatabase(rNames = unassigned,
+                                                    qNames = unassigned,
                                                     dbPrefix = queryDB,
                                                     queryPrefix = queryDB,
                                                     klist = kmers,
@@ -530,21 +558,18 @@ def addQueryToNetwork(dbFuncs, rList, qList, G, kmers,
 
             queryAssignation = model.assign(qqDistMat)
 
-            # identify any links between queries and store in the same links dict
-            # links dict now contains lists of links both to original database and new queries
+            # identify any links between queries and store with the links to the database
             # have to use names and link to query list in order to match to node indices
-            for row_idx, (assignment, (query1, query2)) in enumerate(zip(queryAssignation, iterDistRows(qlist1, qlist2, self = True))):
-                if assignment == model.within_label:
-                    if weights is not None:
-                        dist = np.linalg.norm(qqDistMat[row_idx, :])
-                        edge_tuple = (query_indices[query1], query_indices[query2], dist)
-                    else:
-                        edge_tuple = (query_indices[query1], query_indices[query2])
-                    new_edges.append(edge_tuple)
+            rows = np.flatnonzero(np.asarray(queryAssignation) == model.within_label)
+            query1, query2 = listDistIntArrays(rows, len(qlist1))
+            vertex_idx = np.array([query_indices[name] for name in qlist1], dtype = np.int64)
+            new_edges.append(queryEdges(vertex_idx[query1], vertex_idx[query2],
+                                        None if weights is None else qqDistMat, rows))
 
     # finish by updating the network
     G.add_vertex(len(qList))
 
+    new_edges = np.concatenate(new_edges)
     if weights is not None:
         eweight = G.new_ep("float")
         G.add_edge_list(new_edges, eprops = [eweight])
@@ -552,7 +577,9 @@ def addQueryToNetwork(dbFuncs, rList, qList, G, kmers,
     else:
         G.add_edge_list(new_edges)
 
-    # including the vertex ID property map
+    # including the vertex ID property map. String property maps have no
+    # array view, so setting them all at once (e.g. with vals) would still
+    # loop in python, and over the references too; only queries are set here
     for i, q in enumerate(qList):
         G.vp.id[i + len(rList)] = q
 
@@ -601,14 +628,14 @@ def printClusters(G, rlist, outPrefix = "_clusters.csv", oldClusterFile = None,
     # get a sorted list of component assignments
     component_assignments, component_frequencies = gt.label_components(G)
     component_frequency_ranks = len(component_frequencies) - rankdata(component_frequencies, method = 'ordinal').astype(int)
-    newClusters = [set() for rank in range(len(component_frequency_ranks))]
-    for isolate_index, isolate_name in enumerate(rlist):
-        component = component_assignments.a[isolate_index]
-        component_rank = component_frequency_ranks[component]
-        newClusters[component_rank].add(isolate_name)
-
-    oldNames = set()
-
+    num_clusters = len(component_frequency_ranks)
+    # new cluster (by rank) of each isolate, and isolates ordered by cluster
+    new_labels = component_frequency_ranks[component_assignments.a[:len(rlist)]]
+    cluster_order = np.argsort(new_labels, kind = 'stable')
+    rlist = np.array(rlist, dtype = object)
+
+    # old cluster (by order in the file) of each isolate, -1 if not in the file
+    old_labels = np.full(len(rlist), -1, dtype = np.int64)
     if oldClusterFile != None:
         oldAllClusters = readIsolateTypeFromCsv(oldClusterFile, mode = 'external', return_dict = False)
         oldClusters = oldAllClusters[list(oldAllClusters.keys())[0]]
@@ -617,64 +644,53 @@ def printClusters(G, rlist, outPrefix = "_clusters.csv", oldClusterFile = None,
             new_id += 1 # in case clusters have been merged
 
         # Samples in previous clustering
-        for prev_cluster in oldClusters.values():
+        oldClusterNames = list(oldClusters.keys())
+        oldNames = {}
+        for old_idx, prev_cluster in enumerate(oldClusters.values()):
             for prev_sample in prev_cluster:
-                oldNames.add(prev_sample)
+                oldNames[prev_sample] = old_idx
+        old_labels[:] = [oldNames.get(isolate, -1) for isolate in rlist]
 
     # Assign each cluster a name
-    clustering = {}
-    foundOldClusters = []
-
-    for newClsIdx, newCluster in enumerate(newClusters):
-
-        # Ensure consistency with previous labelling
-        if oldClusterFile != None:
-            merge = False
-            cls_id = None
+    cluster_names = []
+    if oldClusterFile != None:
+        # Contingency of new x old clusters, sorted by new then old cluster
+        in_old = np.flatnonzero(old_labels >= 0)
+        overlaps = np.unique(new_labels[in_old] * len(oldClusterNames) + old_labels[in_old])
+        overlap_new, overlap_old = np.divmod(overlaps, len(oldClusterNames))
+        overlap_start = np.searchsorted(overlap_new, np.arange(num_clusters + 1))
+        foundOldClusters = set()
 
-            # Samples in this cluster that are not queries
-            ref_only = oldNames.intersection(newCluster)
+        for newClsIdx in range(num_clusters):
+            # Old clusters with samples in this cluster
+            joins = overlap_old[overlap_start[newClsIdx]:overlap_start[newClsIdx + 1]]
 
             # A cluster with no previous observations
-            if len(ref_only) == 0:
+            if len(joins) == 0:
                 cls_id = str(new_id)    # harmonise data types; string flexibility helpful
                 new_id += 1
             else:
-                # Search through old cluster IDs to find a match
-                for oldClusterName, oldClusterMembers in oldClusters.items():
-                    join = ref_only.intersection(oldClusterMembers)
-                    if len(join) > 0:
-                        # Check cluster is consistent with previous definitions
-                        if oldClusterName in foundOldClusters:
-                            sys.stderr.write("WARNING: Old cluster " + oldClusterName + " split"
-                                             " across multiple new clusters\n")
-                        else:
-                            foundOldClusters.append(oldClusterName)
-
-                        # Query has merged clusters
-                        if len(join) < len(ref_only):
-                            merge = True
-                            if cls_id == None:
-                                cls_id = oldClusterName
-                            else:
-                                cls_id += "_" + oldClusterName
-                        # Exact match -> same name as before
-                        elif len(join) == len(ref_only):
-                            assert merge == False # should not have already been part of a merge
-                            cls_id = oldClusterName
-                            break
-
-            # Report merges
-            if merge:
-                merged_ids = cls_id.split("_")
-                sys.stderr.write("Clusters " + ",".join(merged_ids) + " have merged into " + cls_id + "\n")
-
-        # Otherwise just number sequentially starting from 1
-        else:
-            cls_id = newClsIdx + 1
+                # Check clusters are consistent with previous definitions
+                for old_idx in joins:
+                    if old_idx in foundOldClusters:
+                        sys.stderr.write("WARNING: Old cluster " + oldClusterNames[old_idx] + " split"
+                                         " across multiple new clusters\n")
+                    else:
+                        foundOldClusters.add(old_idx)
 
-        for cluster_member in newCluster:
-            clustering[cluster_member] = cls_id
+                # Exact match -> same name as before
+                # Otherwise query has merged clusters
+                cls_id = "_".join(oldClusterNames[old_idx] for old_idx in joins)
+                if len(joins) > 1:
+                    sys.stderr.write("Clusters " + ",".join(cls_id.split("_")) +
+                                     " have merged into " + cls_id + "\n")
+            cluster_names.append(cls_id)
+
+    # Otherwise just number sequentially starting from 1
+    else:
+        cluster_names = list(range(1, num_clusters + 1))
+
+    clustering = dict(zip(rlist[cluster_order], np.array(cluster_names, dtype = object)[new_labels[cluster_order]]))
 
     # print clustering to file
     if printCSV:
@@ -682,18 +698,28 @@ def printClusters(G, rlist, outPrefix = "_clusters.csv", oldClusterFile = None,
         with open(outFileName, 'w') as cluster_file:
             cluster_file.write("Taxon,Cluster\n")
 
-            # sort the clusters by frequency - define a list with a custom sort order
-            # first line gives tuples e.g. (1, 28), (2, 17) - cluster 1 has 28 members, cluster 2 has 17 members
-            # second line takes first element - the cluster IDs sorted by frequency
-            freq_order = sorted(dict(Counter(clustering.values())).items(), key=operator.itemgetter(1), reverse=True)
-            freq_order = [x[0] for x in freq_order]
-
-            # iterate through cluster dictionary sorting by value using above custom sort order
-            for cluster_member, cluster_name in sorted(clustering.items(), key=lambda i:freq_order.index(i[1])):
-                if printRef or cluster_member not in oldNames:
-                    cluster_file.write(",".join((cluster_member, str(cluster_name))) + "\n")
+            # sort the clusters by frequency - clusters may share a name if an
+            # old cluster has split, so count by name. Ties are in the order
+            # names are first used
+            name_index = {}
+            cluster_name_idx = np.array([name_index.setdefault(name, len(name_index)) for name in cluster_names],
+                                        dtype = np.int64)
+            isolate_name_idx = cluster_name_idx[new_labels[cluster_order]]
+            name_counts = np.bincount(isolate_name_idx, minlength = len(name_index))
+            name_rank = np.empty(len(name_index), dtype = np.int64)
+            name_rank[np.argsort(-name_counts, kind = 'stable')] = np.arange(len(name_index))
+            print_order = cluster_order[np.argsort(name_rank[isolate_name_idx], kind = 'stable')]
+
+            if not printRef:
+                print_order = print_order[old_labels[print_order] < 0]
+            cluster_names = np.array([str(name) for name in cluster_names], dtype = object)
+            for cluster_member, cluster_name in zip(rlist[print_order], cluster_names[new_labels[print_order]]):
+                cluster_file.write(cluster_member + "," + cluster_name + "\n")
 
         if externalClusterCSV is not None:
+            newClusters = np.split(rlist[cluster_order],
+                                   np.searchsorted(new_labels[cluster_order], np.arange(1, num_clusters)))
+            oldNames = set(rlist[old_labels >= 0])
             printExternalClusters(newClusters, externalClusterCSV, outPrefix, oldNames, printRef)
 
     return(clustering)
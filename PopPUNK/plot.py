@@ -6,7 +6,6 @@
 import sys
 import os
 import subprocess
-import random
 import numpy as np
 import matplotlib as mpl
 mpl.use('Agg')
@@ -19,15 +18,11 @@ from shutil import copyfile
 import pandas as pd
 from collections import defaultdict
 from scipy import spatial
-from sklearn import manifold, utils
-try:  # sklearn >= 0.22
-    from sklearn.neighbors import KernelDensity
-except ImportError:
-    from sklearn.neighbors.kde import KernelDensity
 
 from .trees import write_tree, mst_to_phylogeny
 
 from .utils import isolateNameToLabel
+from .utils import shuffleRows
 from .utils import decisionBoundary
 
 def plot_scatter(X, out_prefix, title, kde = True):
@@ -50,7 +45,7 @@ def plot_scatter(X, out_prefix, title, kde = True):
     # Plot results - max 1M for speed
     max_plot_samples = 1000000
     if X.shape[0] > max_plot_samples:
-        X = utils.shuffle(X, random_state=random.randint(1,10000))[0:max_plot_samples,]
+        X = shuffleRows(X, max_plot_samples)
 
     # Kernel estimate uses scaled data 0-1 on each axis
     scale = np.amax(X, axis = 0)
@@ -58,6 +53,7 @@ def plot_scatter(X, out_prefix, title, kde = True):
 
     plt.figure(figsize=(11, 8), dpi= 160, facecolor='w', edgecolor='k')
     if kde:
+        from sklearn.neighbors import KernelDensity
         xx, yy, xy = get_grid(0, 1, 100)
 
         # KDE estimate
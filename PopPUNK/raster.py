@@ -0,0 +1,224 @@
+# vim: set fileencoding=<utf-8> :
+# Copyright 2018-2020 John Lees and Nick Croucher
+
+'''Precomputed assignment of 2D models over a grid'''
+
+# universal
+import sys
+# additional
+import numpy as np
+
+class DecisionRaster:
+    '''A grid of model assignments over the scaled (core, accessory) plane,
+    so that assigning distances is a table lookup.
+
+    The model is evaluated at the corners of every cell. Cells where all
+    four corners agree take that label. Cells which the decision boundary
+    crosses are marked as mixed, and are evaluated again on a finer
+    sub-grid so they can be looked up without the model. A cluster smaller
+    than a cell may not reach any corners, so cells containing a fitted
+    point with a different label are also marked as mixed. If the exact
+    assignment function is available when assigning, it is used for
+    points in mixed cells (and outside of the extent) instead.
+
+    Args:
+        resolution (int)
+            Number of cells along each axis
+
+            [default = 1024]
+        refine (int)
+            Number of sub-cells along each axis of a mixed cell
+
+            [default = 8]
+    '''
+
+    def __init__(self, resolution = 1024, refine = 8):
+        self.resolution = resolution
+        self.refine = refine
+        self.compiled = False
+
+
+    def compile(self, assign_fn, extent, chunk_size = 1000000, points = None):
+        '''Evaluate a model over the grid
+
+        Args:
+            assign_fn (function)
+                Function which takes an n x 2 array of scaled distances
+                and returns an n-vector of integer assignments
+            extent (numpy.array)
+                Upper limit of the grid on each axis (lower limit is zero)
+            chunk_size (int)
+                Maximum number of points to pass to assign_fn at once
+
+                [default = 1000000]
+            points (numpy.array)
+                n x 2 array of scaled distances the model was fitted to.
+                Cells containing a point assigned differently from the
+                cell's corners are marked as mixed
+
+                [default = None]
+        '''
+        self.extent = np.array(extent, dtype = np.float64)
+        self.cell_width = self.extent / self.resolution
+
+        # Labels at cell corners
+        n_corners = self.resolution + 1
+        x_corners = np.linspace(0, self.extent[0], n_corners)
+        y_corners = np.linspace(0, self.extent[1], n_corners)
+        corner_labels = _evaluateGrid(assign_fn, x_corners, y_corners, chunk_size)
+
+        # Cells are pure if their four corners agree
+        self.labels = corner_labels[:-1, :-1].copy()
+        mixed = (self.labels != corner_labels[1:, :-1]) | \
+                (self.labels != corner_labels[:-1, 1:]) | \
+                (self.labels != corner_labels[1:, 1:])
+        if points is not None:
+            points = points[np.all((points >= 0) & (points < self.extent), axis = 1), :]
+            point_labels = np.empty(points.shape[0], dtype = np.int32)
+            for start in range(0, points.shape[0], chunk_size):
+                end = min(start + chunk_size, points.shape[0])
+                point_labels[start:end] = assign_fn(points[start:end, :])
+            point_cells = np.minimum((points / self.cell_width).astype(np.int64), self.resolution - 1)
+            differ = point_labels != self.labels[point_cells[:, 0], point_cells[:, 1]]
+            mixed[point_cells[differ, 0], point_cells[differ, 1]] = True
+        mixed_x, mixed_y = np.nonzero(mixed)
+        self.mixed_idx = np.full(self.labels.shape, -1, dtype = np.int32)
+        self.mixed_idx[mixed_x, mixed_y] = np.arange(mixed_x.size, dtype = np.int32)
+
+        # Evaluate the centres of sub-cells of mixed cells
+        offsets = (np.arange(self.refine) + 0.5) / self.refine
+        sub_x = (mixed_x[:, np.newaxis, np.newaxis] + offsets[:, np.newaxis]) * self.cell_width[0]
+        sub_y = (mixed_y[:, np.newaxis, np.newaxis] + offsets[np.newaxis, :]) * self.cell_width[1]
+        sub_points = np.column_stack((np.broadcast_to(sub_x, (mixed_x.size, self.refine, self.refine)).ravel(),
+                                      np.broadcast_to(sub_y, (mixed_y.size, self.refine, self.refine)).ravel()))
+        self.fine_labels = np.empty(sub_points.shape[0], dtype = np.int32)
+        for start in range(0, sub_points.shape[0], chunk_size):
+            end = min(start + chunk_size, sub_points.shape[0])
+            self.fine_labels[start:end] = assign_fn(sub_points[start:end, :])
+        self.fine_labels = self.fine_labels.reshape(mixed_x.size, self.refine, self.refine)
+
+        sys.stderr.write("Compiled decision raster with " + str(mixed_x.size) +
+                         " boundary cells of " + str(self.labels.size) + "\n")
+        self.compiled = True
+
+
+    def assign(self, X, scale = None, exact_fn = None, outside_label = None,
+               chunk_size = 10000000):
+        '''Assign points by looking up their cell in the grid
+
+        Args:
+            X (numpy.array)
+                n x 2 array of core and accessory distances
+            scale (numpy.array)
+                Scaling of X to the grid, applied in chunks
+
+                [default = None]
+            exact_fn (function)
+                The model's assignment function, used for points in
+                mixed cells or outside of the grid. If None, the sub-grid
+                of mixed cells is used. Is passed scaled distances
+
+                [default = None]
+            outside_label (int)
+                Label of points outside of the grid, if exact_fn is None.
+                If None, these take the label of the nearest cell
+
+                [default = None]
+            chunk_size (int)
+                Number of points to look up at once
+
+                [default = 10000000]
+        Returns:
+            y (numpy.array)
+                Assignment of each point
+        '''
+        if not self.compiled:
+            raise RuntimeError("Trying to assign using an uncompiled raster")
+
+        y = np.empty(X.shape[0], dtype = np.int32)
+        for start in range(0, X.shape[0], chunk_size):
+            end = min(start + chunk_size, X.shape[0])
+            X_chunk = X[start:end, :]
+            if scale is not None:
+                X_chunk = X_chunk / scale
+            cell_pos = X_chunk / self.cell_width
+            outside = np.any((cell_pos >= self.resolution) | (cell_pos < 0), axis = 1)
+            cell_x = np.clip(cell_pos[:, 0].astype(np.int64), 0, self.resolution - 1)
+            cell_y = np.clip(cell_pos[:, 1].astype(np.int64), 0, self.resolution - 1)
+
+            y_chunk = self.labels[cell_x, cell_y]
+            mixed = self.mixed_idx[cell_x, cell_y]
+            in_mixed = mixed >= 0
+            if exact_fn is not None:
+                fallback = in_mixed | outside
+                if np.any(fallback):
+                    y_chunk[fallback] = exact_fn(X_chunk[fallback, :])
+            elif np.any(in_mixed):
+                sub_pos = cell_pos[in_mixed, :] - np.column_stack((cell_x[in_mixed], cell_y[in_mixed]))
+                sub_x = np.clip((sub_pos[:, 0] * self.refine).astype(np.int64), 0, self.refine - 1)
+                sub_y = np.clip((sub_pos[:, 1] * self.refine).astype(np.int64), 0, self.refine - 1)
+                y_chunk[in_mixed] = self.fine_labels[mixed[in_mixed], sub_x, sub_y]
+            if exact_fn is None and outside_label is not None:
+                y_chunk[outside] = outside_label
+            y[start:end] = y_chunk
+
+        return y
+
+
+    def arrays(self, prefix = ''):
+        '''Arrays describing the raster, to be saved in an npz
+
+        Args:
+            prefix (str)
+                Prefix to add to array names
+
+                [default = '']
+        Returns:
+            arrays (dict)
+                Named arrays, read by :func:`~DecisionRaster.load`
+        '''
+        if not self.compiled:
+            raise RuntimeError("Trying to save an uncompiled raster")
+        return {prefix + 'extent': self.extent,
+                prefix + 'refine': self.refine,
+                prefix + 'labels': self.labels,
+                prefix + 'mixed_idx': self.mixed_idx,
+                prefix + 'fine_labels': self.fine_labels}
+
+
+    def load(self, fit_npz, prefix = ''):
+        '''Load a raster from arrays written by :func:`~DecisionRaster.arrays`
+
+        Args:
+            fit_npz (dict)
+                npz opened with :func:`numpy.load`
+            prefix (str)
+                Prefix of array names
+
+                [default = '']
+        '''
+        self.extent = fit_npz[prefix + 'extent']
+        self.refine = int(fit_npz[prefix + 'refine'])
+        self.labels = fit_npz[prefix + 'labels']
+        self.mixed_idx = fit_npz[prefix + 'mixed_idx']
+        self.fine_labels = fit_npz[prefix + 'fine_labels']
+        self.resolution = self.labels.shape[0]
+        self.cell_width = self.extent / self.resolution
+        self.compiled = True
+
+
+def _evaluateGrid(assign_fn, x_points, y_points, chunk_size):
+    '''Evaluate assign_fn at every (x, y) pair, in chunks of rows
+
+    Returns:
+        labels (numpy.array)
+            len(x_points) x len(y_points) array of assignments
+    '''
+    labels = np.empty((x_points.size, y_points.size), dtype = np.int32)
+    rows_per_chunk = max(chunk_size // y_points.size, 1)
+    for start in range(0, x_points.size, rows_per_chunk):
+        end = min(start + rows_per_chunk, x_points.size)
+        grid = np.column_stack((np.repeat(x_points[start:end], y_points.size),
+                                np.tile(y_points, end - start)))
+        labels[start:end, :] = assign_fn(grid).reshape(end - start, y_points.size)
+    return labels
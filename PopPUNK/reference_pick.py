@@ -104,8 +104,10 @@ def main():
     # Copy model fit into new directory
     if args.model is not None and os.path.isdir(args.model):
         sys.stderr.write("Copying model fit into " + args.output + "\n")
-        copyfile(args.model + "/" + os.path.basename(args.model) + "_fit.pkl",
-                 args.output + "/" + os.path.basename(args.output) + "_fit.pkl")
+        # Models from older versions also have a pickle
+        if os.path.isfile(args.model + "/" + os.path.basename(args.model) + "_fit.pkl"):
+            copyfile(args.model + "/" + os.path.basename(args.model) + "_fit.pkl",
+                     args.output + "/" + os.path.basename(args.output) + "_fit.pkl")
         copyfile(args.model + "/" + os.path.basename(args.model) + "_fit.npz",
                  args.output + "/" + os.path.basename(args.output) + "_fit.npz")
         if args.clusters is not None:
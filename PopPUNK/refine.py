@@ -6,20 +6,20 @@
 # universal
 import os
 import sys
+import json
+import time
 # additional
 from itertools import chain
 from functools import partial
 import numpy as np
+import pandas as pd
 import scipy.optimize
-import collections
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from tqdm import tqdm
-try:
-    from multiprocessing import Pool, shared_memory
-    from multiprocessing.managers import SharedMemoryManager
-    NumpyShared = collections.namedtuple('NumpyShared', ('name', 'shape', 'dtype'))
-except ImportError as e:
-    sys.stderr.write("This version of PopPUNK requires python v3.8 or higher\n")
-    sys.exit(0)
+from tempfile import TemporaryDirectory
+from collections import defaultdict
+from multiprocessing import Pool
 import pp_sketchlib
 import poppunk_refine
 import graph_tool.all as gt
@@ -29,10 +29,119 @@ from .network import networkSummary
 
 from .utils import transformLine
 from .utils import decisionBoundary
+from .utils import listDistIntArrays
+from .utils import NumpyMapped
+from .utils import mapNumpy
+from .utils import openMapped
+
+# Adaptive search: number of offsets per level, and maximum number of levels
+adaptive_points = 20
+adaptive_max_levels = 8
+
+class RefineTrace:
+    '''Records where time goes in a boundary search, and the network at each
+    boundary tried, to be written by :func:`~writeRefineTrace`.
+
+    Args:
+        boundary (str)
+            Name of the boundary being searched
+    '''
+
+    def __init__(self, boundary):
+        self.boundary = boundary
+        self.rows = []
+        self.timings = defaultdict(float)
+
+    def time(self, step, start):
+        '''Add the time since start to a step
+
+        Args:
+            step (str)
+                Name of the step
+            start (float)
+                Start time, from :func:`time.perf_counter`
+        Returns:
+            seconds (float)
+                Time taken
+        '''
+        seconds = time.perf_counter() - start
+        self.timings[step] += seconds
+        return(seconds)
+
+    def add(self, stage, offset, edges, components, density, transitivity, score,
+            edges_added = np.nan, y_max = np.nan, seconds = np.nan):
+        '''Record the network at a boundary
+
+        Args:
+            stage (str)
+                Part of the search the boundary was tried in
+            offset (float)
+                Distance of the boundary along the search line (or its
+                x-intercept in the 2D grid)
+            edges (int)
+                Number of edges in the network
+            components (int)
+                Number of components in the network
+            density (float)
+                Density of the network
+            transitivity (float)
+                Transitivity of the network
+            score (float)
+                Network score being optimised
+            edges_added (int)
+                Edges added since the previous boundary in the grid
+            y_max (float)
+                y-intercept of the boundary in the 2D grid
+            seconds (float)
+                Time taken to score this boundary, if known
+        '''
+        self.rows.append({'boundary': self.boundary, 'stage': stage, 'offset': offset,
+                          'y_max': y_max, 'edges_added': edges_added, 'edges': edges,
+                          'components': components, 'density': density,
+                          'transitivity': transitivity, 'score': score,
+                          'seconds': seconds})
+
+
+def writeRefineTrace(traces, outPrefix, settings = None):
+    """Write the networks tried by refine searches as a CSV, and the time taken
+    by each step as JSON, and summarise where time went
+
+    Args:
+        traces (list)
+            :class:`~RefineTrace` of each search
+        outPrefix (str)
+            Prefix for ``_trace.csv`` and ``_trace.json``
+        settings (dict)
+            Options used for the searches, added to the JSON
+
+            [default = None]
+    """
+    pd.DataFrame([row for trace in traces for row in trace.rows],
+                 columns = ['boundary', 'stage', 'offset', 'y_max', 'edges_added', 'edges',
+                            'components', 'density', 'transitivity', 'score', 'seconds']
+                 ).to_csv(outPrefix + "_trace.csv", index = False)
+
+    summary = {'settings': settings if settings is not None else {}}
+    for trace in traces:
+        total = trace.timings.get('total', sum(trace.timings.values()))
+        steps = {step: seconds for step, seconds in trace.timings.items() if step != 'total'}
+        summary[trace.boundary] = {'seconds': total,
+                                   'boundaries_scored': len(trace.rows),
+                                   'steps': steps}
+        sys.stderr.write("Refining " + trace.boundary + " boundary took " +
+                         "{:.1f}".format(total) + "s: " +
+                         ", ".join([step + " " + "{:.1f}".format(seconds) + "s"
+                                    for step, seconds in sorted(steps.items(),
+                                                                key = lambda item: -item[1])]) + "\n")
+    with open(outPrefix + "_trace.json", 'w') as trace_file:
+        json.dump(summary, trace_file, indent = 2)
+
 
 def refineFit(distMat, sample_names, start_s, mean0, mean1,
               max_move, min_move, slope = 2, score_idx = 0,
-              unconstrained = False, no_local = False, num_processes = 1):
+              unconstrained = False, no_local = False, num_processes = 1,
+              adaptive = False, search_file = None, trace = None,
+              betweenness_sample = None):
     """Try to refine a fit by maximising a network score based on transitivity and density.
 
     Iteratively move the decision boundary to do this, using starting point from existing model.
@@ -67,6 +176,25 @@ def refineFit(distMat, sample_names, start_s, mean0, mean1,
             Number of threads to use in the global optimisation step.
 
             (default = 1)
+        adaptive (bool)
+            Use :func:`~adaptiveSearch` rather than a fixed grid and local
+            optimisation. Not used with unconstrained.
+
+            (default = False)
+        search_file (str)
+            CSV to save the adaptive search's score curve to, and resume
+            from if it exists
+
+            (default = None)
+        trace (RefineTrace)
+            Record of timings and networks to add to
+
+            (default = None)
+        betweenness_sample (float)
+            Maximum error of betweenness estimated from a sample of pivots
+            in :func:`~PopPUNK.network.networkSummary` (used if score_idx > 0)
+
+            (default = None)
     Returns:
         start_point (tuple)
             (x, y) co-ordinates of starting point
@@ -75,6 +203,7 @@ def refineFit(distMat, sample_names, start_s, mean0, mean1,
         optimal_y (float)
             y-coordinate of refined fit
     """
+    search_start = time.perf_counter()
     sys.stderr.write("Initial boundary based network construction\n")
     start_point = transformLine(start_s, mean0, mean1)
     sys.stderr.write("Decision boundary starts at (" + "{:.2f}".format(start_point[0])
@@ -102,26 +231,40 @@ def refineFit(distMat, sample_names, start_s, mean0, mean1,
         x_max = np.linspace(x_max_start, x_max_end, global_grid_resolution, dtype=np.float32)
         y_max = np.linspace(y_max_start, y_max_end, global_grid_resolution, dtype=np.float32)
 
-        if gt.openmp_enabled():
-            gt.openmp_set_num_threads(1)
-
-        with SharedMemoryManager() as smm:
-            shm_distMat = smm.SharedMemory(size = distMat.nbytes)
-            distances_shared_array = np.ndarray(distMat.shape, dtype = distMat.dtype, buffer = shm_distMat.buf)
-            distances_shared_array[:] = distMat[:]
-            distances_shared = NumpyShared(name = shm_distMat.name, shape = distMat.shape, dtype = distMat.dtype)
-
-            with Pool(processes = num_processes) as pool:
-                global_s = pool.map(partial(newNetwork2D,
-                                            sample_names = sample_names,
-                                            distMat = distances_shared,
-                                            x_range = x_max,
-                                            y_range = y_max,
-                                            score_idx = score_idx),
-                                    range(global_grid_resolution))
-
-        if gt.openmp_enabled():
-            gt.openmp_set_num_threads(num_processes)
+        if score_idx == 0:
+            # Sweeps and scores are threaded in poppunk_refine, so no graphs are needed
+            global_s = [newNetwork2D(y_idx, sample_names, distMat, x_max, y_max,
+                                     score_idx, num_threads = num_processes, trace = trace)
+                        for y_idx in range(global_grid_resolution)]
+        else:
+            if gt.openmp_enabled():
+                gt_threads = gt.openmp_get_num_threads()
+                gt.openmp_set_num_threads(1)
+
+            # Workers memory map the distances, rather than each receiving a copy
+            # Their steps are not traced separately
+            pool_start = time.perf_counter()
+            with TemporaryDirectory() as tmp_dir:
+                distances_shared = mapNumpy(distMat, tmp_dir)
+
+                with Pool(processes = num_processes) as pool:
+                    global_s = pool.map(partial(newNetwork2D,
+                                                sample_names = sample_names,
+                                                distMat = distances_shared,
+                                                x_range = x_max,
+                                                y_range = y_max,
+                                                score_idx = score_idx,
+                                                betweenness_sample = betweenness_sample),
+                                        range(global_grid_resolution))
+            if trace is not None:
+                trace.time('worker pool', pool_start)
+                for y_idx, y_scores in enumerate(global_s):
+                    for x_idx, x_score in enumerate(y_scores):
+                        trace.add('global 2D', x_max[x_idx], np.nan, np.nan, np.nan, np.nan,
+                                  -x_score, y_max = y_max[y_idx])
+
+            if gt.openmp_enabled():
+                gt.openmp_set_num_threads(gt_threads)
 
         global_s = list(chain.from_iterable(global_s))
         min_idx = np.argmin(np.array(global_s))
@@ -141,14 +284,25 @@ def refineFit(distMat, sample_names, start_s, mean0, mean1,
             start_point = (optimal_x, 0)
             mean1 = (optimal_x + delta, delta * gradient)
 
+    elif adaptive:
+        optimised_s = adaptiveSearch(distMat, sample_names, start_point, mean1,
+                                     min_move, max_move, slope, score_idx,
+                                     num_processes, search_file, trace,
+                                     betweenness_sample)
+        no_local = True
+
     else:
         global_grid_resolution = 40 # Seems to work
         s_range = np.linspace(-min_move, max_move, num = global_grid_resolution)
+        iterate_start = time.perf_counter()
         i_vec, j_vec, idx_vec = \
             poppunk_refine.thresholdIterate1D(distMat, s_range, slope,
                                                   start_point[0], start_point[1],
                                                   mean1[0], mean1[1], num_processes)
-        global_s = growNetwork(sample_names, i_vec, j_vec, idx_vec, s_range, score_idx)
+        if trace is not None:
+            trace.time('thresholdIterate1D', iterate_start)
+        global_s = growNetwork(sample_names, i_vec, j_vec, idx_vec, s_range, score_idx,
+                               trace = trace, betweenness_sample = betweenness_sample)
         min_idx = np.argmin(np.array(global_s))
         if min_idx > 0 and min_idx < len(s_range) - 1:
             bounds = [s_range[min_idx-1], s_range[min_idx+1]]
@@ -162,7 +316,8 @@ def refineFit(distMat, sample_names, start_s, mean0, mean1,
         local_s = scipy.optimize.minimize_scalar(newNetwork,
                         bounds=bounds,
                         method='Bounded', options={'disp': True},
-                        args = (sample_names, distMat, start_point, mean1, gradient, slope, score_idx))
+                        args = (sample_names, distMat, start_point, mean1, gradient, slope, score_idx,
+                                num_processes, trace, betweenness_sample))
         optimised_s = local_s.x
 
     # Convert to x_max, y_max if needed
@@ -177,21 +332,185 @@ def refineFit(distMat, sample_names, start_s, mean0, mean1,
     if optimal_x < 0 or optimal_y < 0:
         raise RuntimeError("Optimisation failed: produced a boundary outside of allowed range\n")
 
+    if trace is not None:
+        trace.time('total', search_start)
+
     return start_point, optimal_x, optimal_y, min_move, max_move
 
 
-def growNetwork(sample_names, i_vec, j_vec, idx_vec, s_range, score_idx, thread_idx = 0):
+def boundaryOffsets(distMat, slope, start_point, mean1):
+    """Offset along the search line at which each distance enters the
+    boundary used by ``poppunk_refine.thresholdIterate1D``.
+
+    Args:
+        distMat (numpy.array)
+            n x 2 array of core and accessory distances
+        slope (int)
+            Set to 0 for a vertical line, 1 for a horizontal line, or
+            2 to use a slope
+        start_point (numpy.array)
+            Point on the search line with offset zero
+        mean1 (numpy.array)
+            End point to define search line
+    Returns:
+        offsets (numpy.array)
+            Smallest offset with each distance within the boundary
+    """
+    gradient = (mean1[1] - start_point[1]) / (mean1[0] - start_point[0])
+    if slope == 2:
+        offsets = (distMat[:, 0] + gradient * distMat[:, 1] -
+                   start_point[0] - gradient * start_point[1]) * \
+                  (np.sqrt(1 + gradient) / (1 + gradient**2))
+    elif slope == 0:
+        offsets = (distMat[:, 0] - start_point[0]) * np.sqrt(1 + gradient)
+    else:
+        offsets = (distMat[:, 1] - start_point[1]) * (np.sqrt(1 + gradient) / gradient)
+    return(offsets)
+
+
+def adaptiveSearch(distMat, sample_names, start_point, mean1, min_move, max_move,
+                   slope = 2, score_idx = 0, num_processes = 1, search_file = None,
+                   trace = None, betweenness_sample = None):
+    """Coarse-to-fine search along the line for the offset with the best network score.
+
+    Offsets are placed at quantiles of the distances' entry points into the
+    boundary, so each step adds a similar number of edges, as well as evenly
+    along the segment, so gaps between peaks are not skipped. The segment either
+    side of the best offset is then searched again in the same way, until it
+    contains fewer distances than offsets, at which point every distinct
+    network in the segment is scored.
+
+    The score curve is written to ``search_file`` after each level. If this
+    already exists, levels with the same offsets are read rather than scored.
+
+    Args:
+        distMat (numpy.array)
+            n x 2 array of core and accessory distances for n samples
+        sample_names (list)
+            List of query sequence labels
+        start_point (numpy.array)
+            Point on the search line with offset zero
+        mean1 (numpy.array)
+            End point to define search line
+        min_move (float)
+            Minimum distance to move away from start point
+        max_move (float)
+            Maximum distance to move away from start point
+        slope (int)
+            Set to 0 for a vertical line, 1 for a horizontal line, or
+            2 to use a slope
+        score_idx (int)
+            Index of score from :func:`~PopPUNK.network.networkSummary` to use
+            [default = 0]
+        num_processes (int)
+            Number of threads to use
+        search_file (str)
+            CSV of the score curve, to write and resume from
+
+            (default = None)
+        trace (RefineTrace)
+            Record of timings and networks to add to
+
+            (default = None)
+        betweenness_sample (float)
+            Maximum error of betweenness estimated from a sample of pivots
+            in :func:`~PopPUNK.network.networkSummary` (used if score_idx > 0)
+
+            (default = None)
+    Returns:
+        optimised_s (float)
+            Offset along the line with the best score
+    """
+    entry = np.sort(boundaryOffsets(distMat, slope, start_point, mean1))
+
+    previous = None
+    curve = []
+    if search_file is not None and os.path.isfile(search_file):
+        previous = pd.read_csv(search_file)
+        this_search = (previous['slope'] == slope) & (previous['score_idx'] == score_idx)
+        curve.append(previous[~this_search])
+        previous = previous[this_search]
+
+    lower, upper = -min_move, max_move
+    best_s, best_score = None, None
+    for level in range(adaptive_max_levels):
+        segment = entry[np.searchsorted(entry, lower, side = 'right'):
+                        np.searchsorted(entry, upper, side = 'right')]
+        if segment.size == 0:
+            break
+        exact = segment.size < adaptive_points
+        if exact:
+            # Score between each distinct entry point, so that no distance
+            # sits on a boundary
+            distinct = np.unique(segment)
+            s_range = np.concatenate(([lower], (distinct[:-1] + distinct[1:]) / 2, [upper]))
+        else:
+            # Evenly spaced offsets are also kept, so that sparse regions
+            # between the peaks of distances are still searched
+            s_range = np.quantile(segment, np.linspace(0, 1, adaptive_points + 1)[1:-1])
+            s_range = np.unique(np.concatenate((np.linspace(lower, upper, adaptive_points + 1),
+                                                s_range)))
+
+        level_curve = None
+        if previous is not None:
+            level_curve = previous[previous['level'] == level]
+            if level_curve.shape[0] != s_range.size or \
+                    not np.allclose(level_curve['offset'].values, s_range):
+                level_curve = None
+                previous = None
+        if level_curve is not None:
+            sys.stderr.write("Read scores for search level " + str(level + 1) + "\n")
+            scores = level_curve['score'].values
+        else:
+            sys.stderr.write("Scoring " + str(s_range.size) + " offsets between " +
+                             "{:.5f}".format(lower) + " and " + "{:.5f}".format(upper) + "\n")
+            iterate_start = time.perf_counter()
+            i_vec, j_vec, idx_vec = \
+                poppunk_refine.thresholdIterate1D(distMat, s_range, slope,
+                                                  start_point[0], start_point[1],
+                                                  mean1[0], mean1[1], num_processes)
+            if trace is not None:
+                trace.time('thresholdIterate1D', iterate_start)
+            scores = np.array(growNetwork(sample_names, i_vec, j_vec, idx_vec,
+                                          s_range, score_idx, trace = trace,
+                                          stage = 'adaptive level ' + str(level + 1),
+                                          betweenness_sample = betweenness_sample))
+
+        curve.append(pd.DataFrame({'slope': slope, 'score_idx': score_idx, 'level': level,
+                                   'offset': s_range, 'score': scores}))
+        if search_file is not None:
+            pd.concat(curve).to_csv(search_file, index = False)
+
+        min_idx = np.argmin(scores)
+        if best_score is None or scores[min_idx] < best_score:
+            best_s, best_score = s_range[min_idx], scores[min_idx]
+        if exact:
+            break
+        lower = s_range[max(min_idx - 1, 0)]
+        upper = s_range[min(min_idx + 1, s_range.size - 1)]
+
+    if best_s is None:
+        raise RuntimeError("No distances to search between boundary offsets")
+    return(best_s)
+
+
+def growNetwork(sample_names, i_vec, j_vec, idx_vec, s_range, score_idx, thread_idx = 0,
+                trace = None, stage = 'global', y_max = np.nan, betweenness_sample = None):
     """Construct a network, then add edges to it iteratively.
-    Input is from ``pp_sketchlib.iterateBoundary1D`` or``pp_sketchlib.iterateBoundary2D``
+    Input is from ``poppunk_refine.thresholdIterate1D`` or ``poppunk_refine.thresholdIterate2D``
+
+    The default score (``score_idx = 0``) is calculated incrementally by
+    ``poppunk_refine.networkScoreIterate``. Scores using betweenness need a
+    graph-tool network.
 
     Args:
         sample_names (list)
             Sample names corresponding to distMat (accessed by iterator)
-        i_vec (list)
+        i_vec (numpy.array)
             Ordered ref vertex index to add
-        j_vec (list)
+        j_vec (numpy.array)
             Ordered query (==ref) vertex index to add
-        idx_vec (list)
+        idx_vec (numpy.array)
             For each i, j tuple, the index of the intercept at which these enter
             the network. These are sorted and increasing
         s_range (list)
@@ -201,63 +520,114 @@ def growNetwork(sample_names, i_vec, j_vec, idx_vec, s_range, score_idx, thread_
             [default = 0]
         thread_idx (int)
             Optional thread idx (if multithreaded) to offset progress bar by
+        trace (RefineTrace)
+            Record of timings and networks to add to
+
+            (default = None)
+        stage (str)
+            Name of the part of the search, for the trace
+
+            (default = 'global')
+        y_max (float)
+            y-intercept of the boundaries, for the trace of a 2D search
+
+            (default = numpy.nan)
+        betweenness_sample (float)
+            Maximum error of betweenness estimated from a sample of pivots
+            in :func:`~PopPUNK.network.networkSummary` (used if score_idx > 0)
+
+            (default = None)
     Returns:
         scores (list)
             -1 * network score for each of x_range.
             Where network score is from :func:`~PopPUNK.network.networkSummary`
     """
+    # The default score is kept up to date as edges are added, without a graph
+    if score_idx == 0:
+        score_start = time.perf_counter()
+        network_scores = poppunk_refine.networkScoreIterate(i_vec, j_vec, idx_vec,
+                                                            len(sample_names), len(s_range))
+        if trace is not None:
+            trace.time('networkScoreIterate', score_start)
+            edges_added = np.bincount(idx_vec, minlength = len(s_range))[:len(s_range)]
+            for offset, added, edges, (components, density, transitivity, score) in \
+                    zip(s_range, edges_added, np.cumsum(edges_added), network_scores):
+                trace.add(stage, offset, edges, components, density, transitivity, score,
+                          edges_added = added, y_max = y_max)
+        return(list(-network_scores[:, 3]))
+
     scores = []
-    edge_list = []
-    prev_idx = 0
-    # Grow a network
-    with tqdm(total=(idx_vec[-1] + 1),
+    # Grow a network, adding the edges which enter at each offset in one go
+    with tqdm(total=len(s_range),
               bar_format="{bar}| {n_fmt}/{total_fmt}",
               ncols=40,
               position=thread_idx) as pbar:
-        for i, j, idx in zip(i_vec, j_vec, idx_vec):
-            if idx > prev_idx:
-                # At first offset, make a new network, otherwise just add the new edges
-                if prev_idx == 0:
-                    G = constructNetwork(sample_names, sample_names, edge_list, -1,
-                                         summarise=False, edge_list=True)
-                else:
-                    G.add_edge_list(edge_list)
-                # Add score into vector for any offsets passed (should usually just be one)
-                for s in range(prev_idx, idx):
-                    scores.append(-networkSummary(G, score_idx > 0)[1][score_idx])
-                    pbar.update(1)
-                prev_idx = idx
-                edge_list = []
-            edge_list.append((i, j))
-
-        # Add score for final offset(s) at end of loop
-        if prev_idx == 0:
-            G = constructNetwork(sample_names, sample_names, edge_list, -1,
-                                 summarise=False, edge_list=True)
-        else:
-            G.add_edge_list(edge_list)
-        for s in range(prev_idx, len(s_range)):
-            scores.append(-networkSummary(G, score_idx > 0)[1][score_idx])
+        G = constructNetwork(sample_names, sample_names, [], -1,
+                             summarise=False, edge_list=True)
+        for offset, (offset_i, offset_j) in zip(s_range, iterateOffsets(i_vec, j_vec, idx_vec, len(s_range))):
+            add_start = time.perf_counter()
+            if offset_i.size > 0:
+                G.add_edge_list(np.column_stack((offset_i, offset_j)))
+            summary_start = time.perf_counter()
+            metrics, network_scores = networkSummary(G, score_idx > 0, betweenness_sample)
+            summary_end = time.perf_counter()
+            scores.append(-network_scores[score_idx])
+            if trace is not None:
+                trace.timings['add_edge_list'] += summary_start - add_start
+                trace.timings['networkSummary'] += summary_end - summary_start
+                trace.add(stage, offset, G.num_edges(), metrics[0], metrics[1], metrics[2],
+                          network_scores[score_idx], edges_added = offset_i.size,
+                          y_max = y_max, seconds = summary_end - add_start)
             pbar.update(1)
 
     return(scores)
 
 
+def iterateOffsets(i_vec, j_vec, idx_vec, n_offsets):
+    """Split the edges from ``poppunk_refine.thresholdIterate1D`` or
+    ``poppunk_refine.thresholdIterate2D`` by the offset at which they
+    enter the network.
+
+    Yields views into the input arrays, so no edges are copied.
+
+    Args:
+        i_vec (numpy.array)
+            Ordered ref vertex index to add
+        j_vec (numpy.array)
+            Ordered query (==ref) vertex index to add
+        idx_vec (numpy.array)
+            For each i, j tuple, the index of the intercept at which these enter
+            the network. These are sorted and increasing
+        n_offsets (int)
+            Number of offsets searched
+    Returns:
+        offset_i, offset_j (numpy.array, numpy.array)
+            For each offset in turn, the edges which are added at it
+    """
+    i_vec = np.asarray(i_vec)
+    j_vec = np.asarray(j_vec)
+    bounds = np.searchsorted(np.asarray(idx_vec), np.arange(n_offsets + 1), side = 'left')
+    bounds[-1] = i_vec.size
+    for offset in range(n_offsets):
+        yield i_vec[bounds[offset]:bounds[offset + 1]], j_vec[bounds[offset]:bounds[offset + 1]]
+
+
 def newNetwork(s, sample_names, distMat, start_point, mean1, gradient,
-               slope=2, score_idx=0, cpus=1):
+               slope=2, score_idx=0, cpus=1, trace=None, betweenness_sample=None):
     """Wrapper function for :func:`~PopPUNK.network.constructNetwork` which is called
     by optimisation functions moving a triangular decision boundary.
 
     Given the boundary parameterisation, constructs the network and returns
-    its score, to be minimised.
+    its score, to be minimised. The default score is calculated by
+    ``poppunk_refine.networkScore`` without constructing a graph.
 
     Args:
         s (float)
             Distance along line between start_point and mean1 from start_point
         sample_names (list)
             Sample names corresponding to distMat (accessed by iterator)
-        distMat (numpy.array or NumpyShared)
-            Core and accessory distances or NumpyShared describing these in sharedmem
+        distMat (numpy.array or NumpyMapped)
+            Core and accessory distances or NumpyMapped describing these in a file
         start_point (numpy.array)
             Initial boundary cutoff
         mean1 (numpy.array)
@@ -273,13 +643,17 @@ def newNetwork(s, sample_names, distMat, start_point, mean1, gradient,
             [default = 0]
         cpus (int)
             Number of CPUs to use for calculating assignment
+        trace (RefineTrace)
+            Record of timings and networks to add to
+        betweenness_sample (float)
+            Maximum error of betweenness estimated from a sample of pivots
+            in :func:`~PopPUNK.network.networkSummary` (used if score_idx > 0)
     Returns:
         score (float)
             -1 * network score. Where network score is from :func:`~PopPUNK.network.networkSummary`
     """
-    if isinstance(distMat, NumpyShared):
-        distMat_shm = shared_memory.SharedMemory(name = distMat.name)
-        distMat = np.ndarray(distMat.shape, dtype = distMat.dtype, buffer = distMat_shm.buf)
+    if isinstance(distMat, NumpyMapped):
+        distMat = openMapped(distMat)
 
     # Set up boundary
     new_intercept = transformLine(s, start_point, mean1)
@@ -292,15 +666,129 @@ def newNetwork(s, sample_names, distMat, start_point, mean1, gradient,
         x_max = 0
         y_max = new_intercept[1]
 
+    return(-boundaryScore(x_max, y_max, sample_names, distMat, slope, score_idx, cpus,
+                          trace, s, betweenness_sample))
+
+def boundaryScore(x_max, y_max, sample_names, distMat, slope=2, score_idx=0, cpus=1,
+                  trace=None, offset=np.nan, betweenness_sample=None):
+    """Score the network made by a decision boundary.
+
+    The default score is calculated by ``poppunk_refine.networkScore``
+    without constructing a graph.
+
+    Args:
+        x_max (float)
+            The x-axis intercept of the boundary
+        y_max (float)
+            The y-axis intercept of the boundary
+        sample_names (list)
+            Sample names corresponding to distMat (accessed by iterator)
+        distMat (numpy.array)
+            Core and accessory distances
+        slope (int)
+            Set to 0 for a vertical line, 1 for a horizontal line, or
+            2 to use a slope
+            [default = 2]
+        score_idx (int)
+            Index of score from :func:`~PopPUNK.network.networkSummary` to use
+            [default = 0]
+        cpus (int)
+            Number of CPUs to use for calculating assignment
+        trace (RefineTrace)
+            Record of timings and networks to add to, as part of the local search
+        offset (float)
+            Distance of the boundary along the search line, for the trace
+        betweenness_sample (float)
+            Maximum error of betweenness estimated from a sample of pivots
+            in :func:`~PopPUNK.network.networkSummary` (used if score_idx > 0)
+    Returns:
+        score (float)
+            Network score from :func:`~PopPUNK.network.networkSummary`
+    """
+    score_start = time.perf_counter()
+    # Score the default directly from the distances, without making a graph
+    if score_idx == 0:
+        components, density, transitivity, score = \
+            poppunk_refine.networkScore(distMat, slope, x_max, y_max, cpus)
+        if trace is not None:
+            n_samples = len(sample_names)
+            trace.add('local', offset, int(round(density * n_samples * (n_samples - 1) / 2)),
+                      components, density, transitivity, score,
+                      seconds = trace.time('networkScore', score_start))
+        return(score)
+
     # Make network
     boundary_assignments = poppunk_refine.assignThreshold(distMat, slope, x_max, y_max, cpus)
+    if trace is not None:
+        trace.time('assignThreshold', score_start)
+    network_start = time.perf_counter()
     G = constructNetwork(sample_names, sample_names, boundary_assignments, -1, summarise = False)
+    if trace is not None:
+        trace.time('constructNetwork', network_start)
 
     # Return score
-    score = networkSummary(G, score_idx > 0)[1][score_idx]
-    return(-score)
+    summary_start = time.perf_counter()
+    metrics, scores = networkSummary(G, score_idx > 0, betweenness_sample)
+    if trace is not None:
+        trace.time('networkSummary', summary_start)
+        trace.add('local', offset, G.num_edges(), metrics[0], metrics[1], metrics[2],
+                  scores[score_idx], seconds = time.perf_counter() - score_start)
+    return(scores[score_idx])
+
+def stratifiedSubsample(distMat, n_samples, n_sub, start_point, mean1, num_threads=1, seed=0):
+    """Choose samples to refine a fit with, stratified by the clusters
+    of the network at the starting boundary.
+
+    Samples are sorted by cluster, in a random order within each cluster,
+    and every ``n_samples / n_sub`` th sample is taken, so each cluster is
+    represented in proportion to its size.
 
-def newNetwork2D(y_idx, sample_names, distMat, x_range, y_range, score_idx=0):
+    Args:
+        distMat (numpy.array)
+            n x 2 array of core and accessory distances for n samples
+        n_samples (int)
+            Number of samples in distMat
+        n_sub (int)
+            Number of samples to choose
+        start_point (numpy.array)
+            Point on the search line where the boundary starts
+        mean1 (numpy.array)
+            End point to define search line
+        num_threads (int)
+            Number of threads to use
+        seed (int)
+            Seed for the random order within clusters
+    Returns:
+        sub_idx (numpy.array)
+            Sorted indices of the chosen samples
+        dist_idx (numpy.array)
+            Rows of distMat between the chosen samples, in the same order
+            as a distance matrix of only these samples
+    """
+    # Boundary normal to the search line at the start point
+    gradient = (mean1[1] - start_point[1]) / (mean1[0] - start_point[0])
+    x_max, y_max = decisionBoundary(start_point, gradient)
+    assignments = poppunk_refine.assignThreshold(distMat, 2, x_max, y_max, num_threads)
+    i_vec, j_vec = listDistIntArrays(np.flatnonzero(assignments == -1), n_samples)
+    start_network = coo_matrix((np.ones(i_vec.size, dtype = np.int8), (i_vec, j_vec)),
+                               shape = (n_samples, n_samples))
+    n_clusters, clusters = connected_components(start_network, directed = False)
+
+    rng = np.random.default_rng(seed)
+    cluster_order = np.lexsort((rng.random(n_samples), clusters))
+    picks = np.floor((np.arange(n_sub) + rng.random()) * (n_samples / n_sub)).astype(np.int64)
+    sub_idx = np.sort(cluster_order[picks])
+    sys.stderr.write("Refining with " + str(n_sub) + " samples from " +
+                     str(n_clusters) + " starting clusters\n")
+
+    sub_i, sub_j = np.triu_indices(n_sub, 1)
+    row = sub_idx[sub_i]
+    col = sub_idx[sub_j]
+    dist_idx = n_samples * row - row * (row + 1) // 2 + col - row - 1
+    return(sub_idx, dist_idx)
+
+def newNetwork2D(y_idx, sample_names, distMat, x_range, y_range, score_idx=0, num_threads=1,
+                 trace=None, betweenness_sample=None):
     """Wrapper function for thresholdIterate2D and :func:`growNetwork`.
 
     For a given y_max, constructs networks across x_range and returns a list
@@ -311,8 +799,8 @@ def newNetwork2D(y_idx, sample_names, distMat, x_range, y_range, score_idx=0):
             Maximum y-intercept of boundary, as index into y_range
         sample_names (list)
             Sample names corresponding to distMat (accessed by iterator)
-        distMat (numpy.array or NumpyShared)
-            Core and accessory distances or NumpyShared describing these in sharedmem
+        distMat (numpy.array or NumpyMapped)
+            Core and accessory distances or NumpyMapped describing these in a file
         x_range (list)
             Sorted list of x-intercepts to search
         y_range (list)
@@ -320,21 +808,35 @@ def newNetwork2D(y_idx, sample_names, distMat, x_range, y_range, score_idx=0):
         score_idx (int)
             Index of score from :func:`~PopPUNK.network.networkSummary` to use
             [default = 0]
+        num_threads (int)
+            Number of threads to use in thresholdIterate2D
+            [default = 1]
+        trace (RefineTrace)
+            Record of timings and networks to add to
+            [default = None]
+        betweenness_sample (float)
+            Maximum error of betweenness estimated from a sample of pivots
+            in :func:`~PopPUNK.network.networkSummary` (used if score_idx > 0)
+            [default = None]
     Returns:
         scores (list)
             -1 * network score for each of x_range.
             Where network score is from :func:`~PopPUNK.network.networkSummary`
     """
-    if gt.openmp_enabled():
+    if gt.openmp_enabled() and num_threads == 1:
         gt.openmp_set_num_threads(1)
-    if isinstance(distMat, NumpyShared):
-        distMat_shm = shared_memory.SharedMemory(name = distMat.name)
-        distMat = np.ndarray(distMat.shape, dtype = distMat.dtype, buffer = distMat_shm.buf)
+    if isinstance(distMat, NumpyMapped):
+        distMat = openMapped(distMat)
 
     y_max = y_range[y_idx]
+    iterate_start = time.perf_counter()
     i_vec, j_vec, idx_vec = \
-            poppunk_refine.thresholdIterate2D(distMat, x_range, y_max)
-    scores = growNetwork(sample_names, i_vec, j_vec, idx_vec, x_range, score_idx, y_idx)
+            poppunk_refine.thresholdIterate2D(distMat, x_range, y_max, num_threads)
+    if trace is not None:
+        trace.time('thresholdIterate2D', iterate_start)
+    scores = growNetwork(sample_names, i_vec, j_vec, idx_vec, x_range, score_idx, y_idx,
+                         trace = trace, stage = 'global 2D', y_max = y_max,
+                         betweenness_sample = betweenness_sample)
     return(scores)
 
 def readManualStart(startFile):
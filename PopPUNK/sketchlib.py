@@ -540,6 +540,69 @@ def queryDatabase(rNames, qNames, dbPrefix, queryPrefix, klist, self = True, num
 
     return(rNames, qNames, distMat)
 
+def queryPairs(names, pair_i, pair_j, dbPrefix, klist, threads = 1, block_size = 256,
+               use_gpu = False, deviceid = 0):
+    """Calculate core and accessory distances between chosen pairs of samples
+    in a database, rather than between all of them.
+
+    Pairs are grouped by their first sample into blocks, and each block is
+    queried against the samples it is paired with.
+
+    Args:
+        names (list)
+            Names of samples in the database
+        pair_i (numpy.array)
+            Index in names of the first sample of each pair
+        pair_j (numpy.array)
+            Index in names of the second sample of each pair
+        dbPrefix (str)
+            Prefix for mash sketch database created by :func:`~constructDatabase`
+        klist (list)
+            K-mer sizes to use in the calculation
+        threads (int)
+            Number of threads to use in the mash process
+            (default = 1)
+        block_size (int)
+            Number of first samples to query at once
+            (default = 256)
+        use_gpu (bool)
+            Use a GPU for querying
+            (default = False)
+        deviceid (int)
+            Index of the CUDA GPU device to use
+            (default = 0)
+
+    Returns:
+         distMat (numpy.array)
+            Core distances (column 0) and accessory distances (column 1) for
+            each pair
+    """
+    db = dbPrefix + "/" + os.path.basename(dbPrefix)
+    distMat = np.zeros((pair_i.size, 2), dtype = np.float32)
+
+    first_samples = np.unique(pair_i)
+    for start in range(0, first_samples.size, block_size):
+        block = first_samples[start:start + block_size]
+        in_block = np.nonzero(np.isin(pair_i, block))[0]
+        partners = np.unique(pair_j[in_block])
+
+        rNames = [names[idx] for idx in partners]
+        qNames = [names[idx] for idx in block]
+        blockDists = pp_sketchlib.queryDatabase(db, db, rNames, qNames, klist,
+                                                True, False, threads, use_gpu, deviceid)
+        if rNames == qNames:
+            # Identical lists are run as a self query, giving each pair once
+            blockDists = np.stack((pp_sketchlib.longToSquare(blockDists[:, [0]], threads),
+                                   pp_sketchlib.longToSquare(blockDists[:, [1]], threads)),
+                                  axis = 2)
+        else:
+            blockDists = blockDists.reshape(block.size, partners.size, 2)
+
+        distMat[in_block, :] = blockDists[np.searchsorted(block, pair_i[in_block]),
+                                          np.searchsorted(partners, pair_j[in_block]), :]
+
+    return distMat
+
 def calculateQueryQueryDistances(dbFuncs, qlist, kmers,
                                  queryDB, threads = 1):
     """Calculates distances between queries.
@@ -9,7 +9,8 @@ import sys
 # additional
 import pickle
 import subprocess
-from collections import defaultdict
+import mmap
+from collections import defaultdict, namedtuple
 from itertools import chain
 from tempfile import mkstemp
 from functools import partial
@@ -51,6 +52,7 @@ def setupDBFuncs(args, min_count, qc_dict):
     from .sketchlib import joinDBs
     from .sketchlib import constructDatabase as constructDatabaseSketchlib
     from .sketchlib import queryDatabase as queryDatabaseSketchlib
+    from .sketchlib import queryPairs as queryPairsSketchlib
     from .sketchlib import readDBParams
     from .sketchlib import getSeqsInDb
 
@@ -67,12 +69,16 @@ def setupDBFuncs(args, min_count, qc_dict):
     queryDatabase = partial(queryDatabaseSketchlib,
                             use_gpu = args.gpu_dist,
                             deviceid = args.deviceid)
+    queryPairs = partial(queryPairsSketchlib,
+                         use_gpu = args.gpu_dist,
+                         deviceid = args.deviceid)
 
     # Dict of DB access functions for assign_query (which is out of scope)
     dbFuncs = {'createDatabaseDir': createDatabaseDir,
                'joinDBs': joinDBs,
                'constructDatabase': constructDatabase,
                'queryDatabase': queryDatabase,
+               'queryPairs': queryPairs,
                'readDBParams': readDBParams,
                'getSeqsInDb': getSeqsInDb,
                'backend': backend,
@@ -103,7 +109,7 @@ def storePickle(rlist, qlist, self, X, pklName):
     np.save(pklName + ".npy", X)
 
 
-def readPickle(pklName, enforce_self = False):
+def readPickle(pklName, enforce_self = False, mmap = False):
     """Loads core and accessory distances saved by :func:`~storePickle`
 
     Called during ``--fit-model``
@@ -115,6 +121,12 @@ def readPickle(pklName, enforce_self = False):
             Error if self == False
 
             [default = True]
+        mmap (bool)
+            Memory map the distances read-only, rather than reading them
+            into memory. These can then be shared with :func:`~mapNumpy`
+            without a copy
+
+            [default = False]
 
     Returns:
         rlist (list)
@@ -131,10 +143,58 @@ def readPickle(pklName, enforce_self = False):
         if enforce_self and not self:
             sys.stderr.write("Old distances " + pklName + ".npy not complete\n")
             sys.stderr.exit(1)
-    X = np.load(pklName + ".npy")
+    X = np.load(pklName + ".npy", mmap_mode = 'r' if mmap else None)
     return rlist, qlist, self, X
 
 
+# A numpy array in shared memory, which processes can attach to by name
+NumpyShared = namedtuple('NumpyShared', ('name', 'shape', 'dtype'))
+
+# A numpy array in a file, which processes can memory map
+NumpyMapped = namedtuple('NumpyMapped', ('filename', 'offset', 'shape', 'dtype'))
+
+def mapNumpy(array, tmp_dir):
+    """Share an array with worker processes through a file they can
+    memory map read-only with :func:`~openMapped`.
+
+    Arrays which are already memory mapped from the whole of a file
+    (e.g. from :func:`~readPickle`) are shared without a copy. Otherwise
+    the array is written to a file in tmp_dir.
+
+    Args:
+        array (numpy.array)
+            Array to share
+        tmp_dir (str)
+            Directory to write the array to, if needed
+    Returns:
+        mapped (NumpyMapped)
+            Description of the array to pass to workers
+    """
+    if isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap) \
+            and array.mode == 'r' and array.flags['C_CONTIGUOUS']:
+        return NumpyMapped(filename = array.filename, offset = array.offset,
+                           shape = array.shape, dtype = array.dtype)
+
+    filename = os.path.join(tmp_dir, str(len(os.listdir(tmp_dir))) + '.npy')
+    np.save(filename, np.ascontiguousarray(array))
+    mapped = np.load(filename, mmap_mode = 'r')
+    return NumpyMapped(filename = filename, offset = mapped.offset,
+                       shape = mapped.shape, dtype = mapped.dtype)
+
+def openMapped(mapped):
+    """Memory map an array shared by :func:`~mapNumpy`
+
+    Args:
+        mapped (NumpyMapped)
+            Description of the array
+    Returns:
+        array (numpy.memmap)
+            The read-only array
+    """
+    return np.memmap(mapped.filename, dtype = mapped.dtype, mode = 'r',
+                     offset = mapped.offset, shape = mapped.shape)
+
+
 def iterDistRows(refSeqs, querySeqs, self=True):
     """Gets the ref and query ID for each row of the distance matrix
 
@@ -199,6 +259,45 @@ def listDistInts(refSeqs, querySeqs, self=True):
         return comparisons
 
 
+def listDistIntArrays(rows, num_ref, num_query = None, self = True):
+    """Gets the ref and query ID for selected rows of the distance matrix.
+
+    Array version of :func:`~listDistInts`, which converts many rows at once.
+
+    Args:
+        rows (numpy.array)
+            Rows of the distance matrix
+        num_ref (int)
+            Number of reference sequences
+        num_query (int)
+            Number of query sequences. Not needed if self = True
+
+            Default is None
+        self (bool)
+            Whether a self-comparison, used when constructing a database.
+            Default is True
+    Returns:
+        ref, query (numpy.array, numpy.array)
+            The ref and query IDs of each row
+    """
+    rows = np.asarray(rows, dtype = np.int64)
+    if self:
+        # Row i of the upper triangle starts at n*i - i*(i+1)/2, invert this
+        n = num_ref
+        i = np.floor(((2 * n - 1) - np.sqrt(np.maximum((2 * n - 1)**2 - 8 * rows.astype(np.float64), 0))) / 2)
+        i = np.clip(i.astype(np.int64), 0, max(n - 2, 0))
+        # Correct any floating point error
+        row_start = n * i - i * (i + 1) // 2
+        i -= row_start > rows
+        row_start = n * i - i * (i + 1) // 2
+        i += rows >= row_start + (n - i - 1)
+        row_start = n * i - i * (i + 1) // 2
+        j = rows - row_start + i + 1
+        return j, i
+    else:
+        return rows % num_ref, rows // num_ref
+
+
 def qcDistMat(distMat, refList, queryList, a_max):
     """Checks distance matrix for outliers. At the moment
     just a threshold for accessory distance
@@ -231,6 +330,98 @@ def qcDistMat(distMat, refList, queryList, a_max):
     return passed
 
 
+def distanceCoreset(X, max_points = 100000, chunk_size = 10000000):
+    """Summarises the core and accessory distances as a weighted set of points,
+    used in place of a random subsample when fitting models.
+
+    Makes a single chunked pass over the distances to build a 2D histogram,
+    and returns the centroid of each occupied bin weighted by the number of
+    distances it contains. Bin edges along each axis are a union of evenly
+    spaced edges (so sparse tails of the distribution keep their own bins)
+    and quantile edges from a strided sample (so dense regions near the
+    origin are resolved).
+
+    Args:
+        X (numpy.array or numpy.memmap)
+            n x 2 array of core and accessory distances for n samples
+        max_points (int)
+            Maximum number of points to return
+
+            (default = 100000)
+        chunk_size (int)
+            Number of rows of X to read at a time
+
+            (default = 10000000)
+
+    Returns:
+        points (numpy.array)
+            k x 2 array of bin centroids, with k <= max_points
+        weights (numpy.array)
+            Number of distances in each bin
+        widths (numpy.array)
+            k x 2 array of the widths of each bin
+        maxima (numpy.array)
+            Maximum core and accessory distances
+    """
+    n_rows = X.shape[0]
+    chunk_size = max(int(chunk_size), 1)
+
+    # First pass for the range of the histogram
+    maxima = np.zeros(2, dtype = X.dtype)
+    for start in range(0, n_rows, chunk_size):
+        maxima = np.maximum(maxima, np.amax(X[start:(start + chunk_size), :], axis = 0))
+    maxima[maxima == 0] = 1
+
+    # Half the edges evenly spaced, half placed at quantiles
+    bins_per_axis = max(int(np.floor(np.sqrt(max_points))) - 1, 2)
+    stride = max(int(np.ceil(n_rows / max_points)), 1)
+    strided_sample = np.asarray(X[::stride, :])
+    edges = []
+    for dim in range(2):
+        linear_edges = np.linspace(0, maxima[dim], bins_per_axis // 2 + 1)
+        quantile_edges = np.quantile(strided_sample[:, dim],
+                                     np.linspace(0, 1, bins_per_axis - bins_per_axis // 2 + 1))
+        dim_edges = np.unique(np.concatenate((linear_edges, quantile_edges)))
+        dim_edges[-1] = maxima[dim]
+        edges.append(dim_edges)
+
+    # Second pass to count and sum the points in each bin
+    counts = np.zeros((edges[0].size - 1, edges[1].size - 1), dtype = np.float64)
+    sums = np.zeros((2, edges[0].size - 1, edges[1].size - 1), dtype = np.float64)
+    for start in range(0, n_rows, chunk_size):
+        chunk = np.asarray(X[start:(start + chunk_size), :], dtype = np.float64)
+        counts += np.histogram2d(chunk[:, 0], chunk[:, 1], bins = edges)[0]
+        for dim in range(2):
+            sums[dim] += np.histogram2d(chunk[:, 0], chunk[:, 1], bins = edges,
+                                        weights = chunk[:, dim])[0]
+
+    occupied = np.nonzero(counts)
+    weights = counts[occupied]
+    points = np.column_stack((sums[0][occupied] / weights,
+                              sums[1][occupied] / weights)).astype(X.dtype)
+    widths = np.column_stack((np.diff(edges[0])[occupied[0]],
+                              np.diff(edges[1])[occupied[1]])).astype(X.dtype)
+
+    return points, weights, widths, maxima
+
+
+def shuffleRows(X, max_rows):
+    """Random subsample of the rows of X, in a random order
+
+    Args:
+        X (numpy.array)
+            Array to sample rows from
+        max_rows (int)
+            Number of rows to sample (all rows if X has fewer)
+
+    Returns:
+        X_sample (numpy.array)
+            Sampled rows of X
+    """
+    n_rows = min(max_rows, X.shape[0])
+    return X[np.random.default_rng().choice(X.shape[0], n_rows, replace = False), ]
+
+
 def readIsolateTypeFromCsv(clustCSV, mode = 'clusters', return_dict = False):
     """Read cluster definitions from CSV file.
 
@@ -58,46 +58,20 @@ std::vector<long> sort_indexes(const T &v, const uint32_t n_threads)
     return idx;
 }
 
-// Unnormalised (signed_ distance between a point (x0, y0) and a line defined
-// by the two points (xmax, 0) and (0, ymax)
-// Divide by 1/sqrt(xmax^2 + ymax^2) to get distance
-inline float line_dist(const float x0,
-                       const float y0,
-                       const float x_max,
-                       const float y_max,
-                       const int slope)
+std::vector<int8_t> assign_threshold(const DistMatrix &distMat,
+                                     const int slope,
+                                     const float x_max,
+                                     const float y_max,
+                                     unsigned int num_threads)
 {
-    float boundary_side = 0;
-    if (slope == 2)
-    {
-        boundary_side = y0 * x_max + x0 * y_max - x_max * y_max;
-    }
-    else if (slope == 0)
-    {
-        boundary_side = x0 - x_max;
-    }
-    else if (slope == 1)
-    {
-        boundary_side = y0 - y_max;
-    }
-
-    return boundary_side;
-}
-
-Eigen::VectorXf assign_threshold(const NumpyMatrix &distMat,
-                                 const int slope,
-                                 const float x_max,
-                                 const float y_max,
-                                 unsigned int num_threads)
-{
-    Eigen::VectorXf boundary_test(distMat.rows());
+    std::vector<int8_t> boundary_test(distMat.rows());
 
 #pragma omp parallel for schedule(static) num_threads(num_threads)
     for (long row_idx = 0; row_idx < distMat.rows(); row_idx++)
     {
         float in_tri = line_dist(distMat(row_idx, 0), distMat(row_idx, 1),
                                  x_max, y_max, slope);
-        float boundary_side;
+        int8_t boundary_side;
         if (in_tri == 0)
         {
             boundary_side = 0;
@@ -117,7 +91,7 @@ Eigen::VectorXf assign_threshold(const NumpyMatrix &distMat,
 
 // Line defined between (x0, y0) and (x1, y1)
 // Offset is distance along this line, starting at (x0, y0)
-network_coo threshold_iterate_1D(const NumpyMatrix &distMat,
+network_coo threshold_iterate_1D(const DistMatrix &distMat,
                                  const std::vector<double> &offsets,
                                  const int slope,
                                  const float x0,
@@ -185,29 +159,80 @@ network_coo threshold_iterate_1D(const NumpyMatrix &distMat,
     return (std::make_tuple(i_vec, j_vec, offset_idx));
 }
 
-network_coo threshold_iterate_2D(const NumpyMatrix &distMat,
+// Each row enters the network at the first x_max offset where it is within
+// the boundary, which is found by binary search as moving x_max outwards
+// only adds rows. Rows are then counting sorted by this offset, keeping
+// their order within each offset
+network_coo threshold_iterate_2D(const DistMatrix &distMat,
                                  const std::vector<float> &x_max,
-                                 const float y_max)
+                                 const float y_max,
+                                 const int num_threads)
 {
-    std::vector<long> i_vec;
-    std::vector<long> j_vec;
-    std::vector<long> offset_idx;
     const size_t n_samples = rows_to_samples(distMat);
+    const long n_offsets = x_max.size();
+    const long n_rows = distMat.rows();
+
+    // Offset at which each row enters (n_offsets if never)
+    std::vector<long> entry(n_rows);
+#pragma omp parallel for schedule(static) num_threads(num_threads)
+    for (long row_idx = 0; row_idx < n_rows; row_idx++)
+    {
+        long low = 0;
+        long high = n_offsets;
+        while (low < high)
+        {
+            const long mid = (low + high) / 2;
+            if (line_dist(distMat(row_idx, 0), distMat(row_idx, 1), x_max[mid], y_max, 2) <= 0)
+            {
+                high = mid;
+            }
+            else
+            {
+                low = mid + 1;
+            }
+        }
+        entry[row_idx] = low;
+    }
 
-    for (int offset_nr = 0; offset_nr < x_max.size(); ++offset_nr)
+    // Counting sort, with each thread taking a contiguous block of rows
+    const long n_blocks = std::max(1, num_threads);
+    const long block_size = (n_rows + n_blocks - 1) / n_blocks;
+    std::vector<long> block_counts(n_blocks * (n_offsets + 1), 0);
+#pragma omp parallel for schedule(static) num_threads(num_threads)
+    for (long block = 0; block < n_blocks; block++)
+    {
+        const long block_end = std::min(n_rows, (block + 1) * block_size);
+        for (long row_idx = block * block_size; row_idx < block_end; row_idx++)
+        {
+            block_counts[entry[row_idx] * n_blocks + block]++;
+        }
+    }
+    // Start of each (offset, block) in the output, offset-major
+    long n_edges = 0;
+    for (long count_idx = 0; count_idx < n_offsets * n_blocks; count_idx++)
+    {
+        const long count = block_counts[count_idx];
+        block_counts[count_idx] = n_edges;
+        n_edges += count;
+    }
+
+    std::vector<long> i_vec(n_edges);
+    std::vector<long> j_vec(n_edges);
+    std::vector<long> offset_idx(n_edges);
+#pragma omp parallel for schedule(static) num_threads(num_threads)
+    for (long block = 0; block < n_blocks; block++)
     {
-        for (long row_idx = 0; row_idx < distMat.rows(); row_idx++)
+        const long block_end = std::min(n_rows, (block + 1) * block_size);
+        for (long row_idx = block * block_size; row_idx < block_end; row_idx++)
         {
-            if (line_dist(distMat(row_idx, 0), distMat(row_idx, 1), x_max[offset_nr], y_max, 2) <= 0)
+            const long offset_nr = entry[row_idx];
+            if (offset_nr < n_offsets)
             {
-                if (offset_nr == 0 || (line_dist(distMat(row_idx, 0), distMat(row_idx, 1), x_max[offset_nr - 1], y_max, 2) > 0))
-                {
-                    long i = calc_row_idx(row_idx, n_samples);
-                    long j = calc_col_idx(row_idx, i, n_samples);
-                    i_vec.push_back(i);
-                    j_vec.push_back(j);
-                    offset_idx.push_back(offset_nr);
-                }
+                const long out_idx = block_counts[offset_nr * n_blocks + block]++;
+                const long i = calc_row_idx(row_idx, n_samples);
+                i_vec[out_idx] = i;
+                j_vec[out_idx] = calc_col_idx(row_idx, i, n_samples);
+                offset_idx[out_idx] = offset_nr;
             }
         }
     }
@@ -14,15 +14,43 @@
 #include <Eigen/Dense>
 
 typedef Eigen::Matrix<float, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor> NumpyMatrix;
+// Read-only view of the distances, which may be a memory mapped file
+typedef Eigen::Ref<const NumpyMatrix> DistMatrix;
 typedef std::tuple<std::vector<long>, std::vector<long>, std::vector<long>> network_coo;
 
-Eigen::VectorXf assign_threshold(const NumpyMatrix &distMat,
-                                 const int slope,
-                                 const float x_max,
-                                 const float y_max,
-                                 unsigned int num_threads);
+// Unnormalised (signed_ distance between a point (x0, y0) and a line defined
+// by the two points (xmax, 0) and (0, ymax)
+// Divide by 1/sqrt(xmax^2 + ymax^2) to get distance
+inline float line_dist(const float x0,
+                       const float y0,
+                       const float x_max,
+                       const float y_max,
+                       const int slope)
+{
+    float boundary_side = 0;
+    if (slope == 2)
+    {
+        boundary_side = y0 * x_max + x0 * y_max - x_max * y_max;
+    }
+    else if (slope == 0)
+    {
+        boundary_side = x0 - x_max;
+    }
+    else if (slope == 1)
+    {
+        boundary_side = y0 - y_max;
+    }
+
+    return boundary_side;
+}
 
-network_coo threshold_iterate_1D(const NumpyMatrix &distMat,
+std::vector<int8_t> assign_threshold(const DistMatrix &distMat,
+                                     const int slope,
+                                     const float x_max,
+                                     const float y_max,
+                                     unsigned int num_threads);
+
+network_coo threshold_iterate_1D(const DistMatrix &distMat,
                                  const std::vector<double> &offsets,
                                  const int slope,
                                  const float x0,
@@ -31,6 +59,7 @@ network_coo threshold_iterate_1D(const NumpyMatrix &distMat,
                                  const float y1,
                                  const int num_threads = 1);
 
-network_coo threshold_iterate_2D(const NumpyMatrix &distMat,
+network_coo threshold_iterate_2D(const DistMatrix &distMat,
                                  const std::vector<float> &x_max,
-                                 const float y_max);
+                                 const float y_max,
+                                 const int num_threads = 1);
@@ -0,0 +1,248 @@
+/*
+ *
+ * clique_cover.cpp
+ * Pick references by covering each component of a network with cliques
+ *
+ */
+#include <cstddef> // size_t
+#include <cstdint>
+#include <vector>
+#include <numeric>
+#include <algorithm>
+
+#include "clique_cover.hpp"
+
+// Sorted, unique adjacency lists of an undirected network
+struct Adjacency
+{
+    std::vector<size_t> row_start;
+    std::vector<size_t> row_end;
+    std::vector<long> neighbours;
+};
+
+Adjacency build_adjacency(const std::vector<long> &i_vec,
+                          const std::vector<long> &j_vec,
+                          const size_t n_samples)
+{
+    Adjacency adj;
+    adj.row_start.resize(n_samples + 1, 0);
+    for (size_t edge_idx = 0; edge_idx < i_vec.size(); ++edge_idx)
+    {
+        if (i_vec[edge_idx] != j_vec[edge_idx])
+        {
+            adj.row_start[i_vec[edge_idx] + 1]++;
+            adj.row_start[j_vec[edge_idx] + 1]++;
+        }
+    }
+    std::partial_sum(adj.row_start.begin(), adj.row_start.end(),
+                     adj.row_start.begin());
+
+    adj.neighbours.resize(adj.row_start[n_samples]);
+    std::vector<size_t> fill(adj.row_start.begin(), adj.row_start.end() - 1);
+    for (size_t edge_idx = 0; edge_idx < i_vec.size(); ++edge_idx)
+    {
+        const long i = i_vec[edge_idx];
+        const long j = j_vec[edge_idx];
+        if (i != j)
+        {
+            adj.neighbours[fill[i]++] = j;
+            adj.neighbours[fill[j]++] = i;
+        }
+    }
+
+    // Duplicate edges are dropped from the end of each row
+    adj.row_end.resize(n_samples);
+    for (size_t v = 0; v < n_samples; ++v)
+    {
+        auto row_begin = adj.neighbours.begin() + adj.row_start[v];
+        auto row_end = adj.neighbours.begin() + adj.row_start[v + 1];
+        std::sort(row_begin, row_end);
+        adj.row_end[v] = std::unique(row_begin, row_end) - adj.neighbours.begin();
+    }
+    return adj;
+}
+
+// Greedily removes cliques from one component until no vertices remain,
+// keeping one vertex of each clique which has no existing reference.
+// Cliques are seeded from the vertex with the highest degree, and grown by
+// adding the candidate linked to the most other candidates (the pivot
+// choice of Bron-Kerbosch). These counts are updated as candidates are
+// removed, so each clique costs the sum of its candidates' degrees
+void cover_component(const Adjacency &adj,
+                     const std::vector<char> &is_ref,
+                     std::vector<long> &refs)
+{
+    const size_t n_samples = is_ref.size();
+    std::vector<char> removed(n_samples, 0);
+    std::vector<char> is_candidate(n_samples, 0);
+    std::vector<long> links(n_samples, 0);
+
+    std::vector<long> seeds(n_samples);
+    std::iota(seeds.begin(), seeds.end(), 0);
+    std::stable_sort(seeds.begin(), seeds.end(),
+                     [&adj](const long a, const long b)
+                     {
+                         return adj.row_end[a] - adj.row_start[a] >
+                                adj.row_end[b] - adj.row_start[b];
+                     });
+
+    std::vector<long> clique, candidates, next_candidates, dropped;
+    for (const long seed : seeds)
+    {
+        if (removed[seed])
+        {
+            continue;
+        }
+
+        clique.assign(1, seed);
+        candidates.clear();
+        for (size_t idx = adj.row_start[seed]; idx < adj.row_end[seed]; ++idx)
+        {
+            if (!removed[adj.neighbours[idx]])
+            {
+                candidates.push_back(adj.neighbours[idx]);
+                is_candidate[adj.neighbours[idx]] = 1;
+            }
+        }
+        for (const long v : candidates)
+        {
+            links[v] = 0;
+            for (size_t idx = adj.row_start[v]; idx < adj.row_end[v]; ++idx)
+            {
+                links[v] += is_candidate[adj.neighbours[idx]];
+            }
+        }
+
+        while (!candidates.empty())
+        {
+            const long next = *std::max_element(candidates.begin(), candidates.end(),
+                                                [&links](const long a, const long b)
+                                                { return links[a] < links[b]; });
+            clique.push_back(next);
+            next_candidates.clear();
+            dropped.clear();
+            std::set_intersection(candidates.begin(), candidates.end(),
+                                  adj.neighbours.begin() + adj.row_start[next],
+                                  adj.neighbours.begin() + adj.row_end[next],
+                                  std::back_inserter(next_candidates));
+            std::set_difference(candidates.begin(), candidates.end(),
+                                next_candidates.begin(), next_candidates.end(),
+                                std::back_inserter(dropped));
+            for (const long v : dropped)
+            {
+                is_candidate[v] = 0;
+            }
+            for (const long v : dropped)
+            {
+                for (size_t idx = adj.row_start[v]; idx < adj.row_end[v]; ++idx)
+                {
+                    links[adj.neighbours[idx]] -= is_candidate[adj.neighbours[idx]];
+                }
+            }
+            std::swap(candidates, next_candidates);
+        }
+
+        if (std::none_of(clique.begin(), clique.end(),
+                         [&is_ref](const long v) { return is_ref[v]; }))
+        {
+            refs.push_back(seed);
+        }
+        for (const long v : clique)
+        {
+            removed[v] = 1;
+        }
+    }
+}
+
+// Returns the sorted indices of references, which are existing_refs and one
+// vertex from every clique which does not contain one of them. The edge
+// arrays have n_edges entries, and components has n_samples
+std::vector<long> clique_cover(const long *i_vec,
+                               const long *j_vec,
+                               const size_t n_edges,
+                               const long *components,
+                               const size_t n_samples,
+                               const long *existing_refs,
+                               const size_t n_refs,
+                               const int num_threads)
+{
+    std::vector<char> is_ref(n_samples, 0);
+    for (size_t ref_idx = 0; ref_idx < n_refs; ++ref_idx)
+    {
+        is_ref[existing_refs[ref_idx]] = 1;
+    }
+
+    // Vertices of each component, and their index within it
+    const size_t n_components =
+        n_samples > 0 ? *std::max_element(components, components + n_samples) + 1 : 0;
+    std::vector<std::vector<long>> component_vertices(n_components);
+    std::vector<long> local_idx(n_samples);
+    for (size_t v = 0; v < n_samples; ++v)
+    {
+        local_idx[v] = component_vertices[components[v]].size();
+        component_vertices[components[v]].push_back(v);
+    }
+
+    // Edges of each component
+    std::vector<size_t> edge_start(n_components + 1, 0);
+    for (size_t edge_idx = 0; edge_idx < n_edges; ++edge_idx)
+    {
+        edge_start[components[i_vec[edge_idx]] + 1]++;
+    }
+    std::partial_sum(edge_start.begin(), edge_start.end(), edge_start.begin());
+    std::vector<size_t> component_edges(n_edges);
+    std::vector<size_t> fill(edge_start.begin(), edge_start.end() - 1);
+    for (size_t edge_idx = 0; edge_idx < n_edges; ++edge_idx)
+    {
+        component_edges[fill[components[i_vec[edge_idx]]]++] = edge_idx;
+    }
+
+    // Largest components first, so a giant component does not start last
+    std::vector<size_t> component_order(n_components);
+    std::iota(component_order.begin(), component_order.end(), 0);
+    std::stable_sort(component_order.begin(), component_order.end(),
+                     [&component_vertices](const size_t a, const size_t b)
+                     {
+                         return component_vertices[a].size() >
+                                component_vertices[b].size();
+                     });
+
+    // Each component is covered using only its own edges and vertices,
+    // indexed from zero
+    std::vector<std::vector<long>> component_refs(n_components);
+#pragma omp parallel for schedule(dynamic, 1) num_threads(num_threads)
+    for (size_t order_idx = 0; order_idx < n_components; ++order_idx)
+    {
+        const size_t component = component_order[order_idx];
+        const std::vector<long> &vertices = component_vertices[component];
+        std::vector<long> local_i, local_j;
+        local_i.reserve(edge_start[component + 1] - edge_start[component]);
+        local_j.reserve(edge_start[component + 1] - edge_start[component]);
+        for (size_t idx = edge_start[component]; idx < edge_start[component + 1]; ++idx)
+        {
+            local_i.push_back(local_idx[i_vec[component_edges[idx]]]);
+            local_j.push_back(local_idx[j_vec[component_edges[idx]]]);
+        }
+        std::vector<char> local_ref(vertices.size());
+        for (size_t v = 0; v < vertices.size(); ++v)
+        {
+            local_ref[v] = is_ref[vertices[v]];
+        }
+
+        const Adjacency adj = build_adjacency(local_i, local_j, vertices.size());
+        cover_component(adj, local_ref, component_refs[component]);
+        for (long &ref : component_refs[component])
+        {
+            ref = vertices[ref];
+        }
+    }
+
+    std::vector<long> refs(existing_refs, existing_refs + n_refs);
+    for (const auto &new_refs : component_refs)
+    {
+        refs.insert(refs.end(), new_refs.begin(), new_refs.end());
+    }
+    std::sort(refs.begin(), refs.end());
+    refs.erase(std::unique(refs.begin(), refs.end()), refs.end());
+    return refs;
+}
@@ -0,0 +1,20 @@
+/*
+ *
+ * clique_cover.hpp
+ * functions in clique_cover.cpp
+ *
+ */
+#pragma once
+
+#include <vector>
+#include <cstdint>
+#include <cstddef>
+
+std::vector<long> clique_cover(const long *i_vec,
+                               const long *j_vec,
+                               const size_t n_edges,
+                               const long *components,
+                               const size_t n_samples,
+                               const long *existing_refs,
+                               const size_t n_refs,
+                               const int num_threads = 1);
@@ -0,0 +1,242 @@
+/*
+ *
+ * network_score.cpp
+ * Network summaries and scores without graph-tool
+ *
+ */
+#include <cstddef> // size_t
+#include <cstdint>
+#include <vector>
+#include <numeric>
+#include <algorithm>
+#include <cmath>
+
+#include "network_score.hpp"
+
+// Disjoint sets, for counting components as edges are added
+class UnionFind
+{
+public:
+    UnionFind(const size_t n_samples) : _parent(n_samples), _components(n_samples)
+    {
+        std::iota(_parent.begin(), _parent.end(), 0);
+    }
+
+    size_t find(size_t v)
+    {
+        while (_parent[v] != v)
+        {
+            _parent[v] = _parent[_parent[v]];
+            v = _parent[v];
+        }
+        return v;
+    }
+
+    void unite(const size_t u, const size_t v)
+    {
+        size_t root_u = find(u);
+        size_t root_v = find(v);
+        if (root_u != root_v)
+        {
+            _parent[std::max(root_u, root_v)] = std::min(root_u, root_v);
+            _components--;
+        }
+    }
+
+    size_t components() const { return _components; }
+
+private:
+    std::vector<size_t> _parent;
+    size_t _components;
+};
+
+// Same summary as networkSummary() in network.py
+// Transitivity is 3 * triangles / connected triples
+inline network_summary summarise(const size_t components,
+                                 const uint64_t edges,
+                                 const uint64_t triangles,
+                                 const uint64_t triples,
+                                 const size_t n_samples)
+{
+    double density = 0;
+    if (n_samples > 1)
+    {
+        density = edges / (0.5 * n_samples * (n_samples - 1));
+    }
+    double transitivity = 0;
+    if (triples > 0)
+    {
+        transitivity = 3 * static_cast<double>(triangles) / triples;
+    }
+    return std::make_tuple(components, density, transitivity,
+                           transitivity * (1 - density));
+}
+
+// Edges are added in order of offset_idx (which must be sorted)
+// The counts are updated for each new edge, so each offset only costs
+// time for the edges it adds. The edge arrays have n_edges entries
+ScoreMatrix score_network_iterate(const long *i_vec,
+                                  const long *j_vec,
+                                  const long *offset_idx,
+                                  const size_t n_edges,
+                                  const size_t n_samples,
+                                  const size_t n_offsets)
+{
+    ScoreMatrix scores(n_offsets, 4);
+    std::vector<std::vector<long>> neighbours(n_samples);
+    std::vector<char> is_neighbour(n_samples, 0);
+    UnionFind components(n_samples);
+    uint64_t edges = 0, triangles = 0, triples = 0;
+
+    size_t edge_idx = 0;
+    for (size_t offset_nr = 0; offset_nr < n_offsets; ++offset_nr)
+    {
+        while (edge_idx < n_edges &&
+               offset_idx[edge_idx] <= static_cast<long>(offset_nr))
+        {
+            const long i = i_vec[edge_idx];
+            const long j = j_vec[edge_idx];
+            edge_idx++;
+            if (i == j)
+            {
+                continue;
+            }
+
+            // Triangles closed by this edge are common neighbours of its ends
+            for (const long k : neighbours[i])
+            {
+                is_neighbour[k] = 1;
+            }
+            const bool duplicate = is_neighbour[j];
+            uint64_t common = 0;
+            if (!duplicate)
+            {
+                for (const long k : neighbours[j])
+                {
+                    common += is_neighbour[k];
+                }
+            }
+            for (const long k : neighbours[i])
+            {
+                is_neighbour[k] = 0;
+            }
+            if (duplicate)
+            {
+                continue;
+            }
+
+            // Each end is the centre of a new triple with each of its neighbours
+            triangles += common;
+            triples += neighbours[i].size() + neighbours[j].size();
+
+            neighbours[i].push_back(j);
+            neighbours[j].push_back(i);
+            components.unite(i, j);
+            edges++;
+        }
+        network_summary summary = summarise(components.components(), edges,
+                                            triangles, triples, n_samples);
+        scores(offset_nr, 0) = std::get<0>(summary);
+        scores(offset_nr, 1) = std::get<1>(summary);
+        scores(offset_nr, 2) = std::get<2>(summary);
+        scores(offset_nr, 3) = std::get<3>(summary);
+    }
+    return scores;
+}
+
+// Edges are distances strictly within the boundary, as in assign_threshold
+// The network is stored as CSR, with sorted neighbours, so triangles can
+// be counted by merging the neighbours of the ends of each edge
+network_summary score_network(const DistMatrix &distMat,
+                              const int slope,
+                              const float x_max,
+                              const float y_max,
+                              const int num_threads)
+{
+    const size_t n_samples = 0.5 * (1 + std::sqrt(1 + 8 * (distMat.rows())));
+
+    // Edges from each row of the square matrix
+    std::vector<std::vector<long>> row_edges(n_samples);
+#pragma omp parallel for schedule(dynamic, 64) num_threads(num_threads)
+    for (long i = 0; i < static_cast<long>(n_samples); ++i)
+    {
+        size_t dist_idx = n_samples * i - ((i * (i + 1)) >> 1);
+        for (long j = i + 1; j < static_cast<long>(n_samples); ++j, ++dist_idx)
+        {
+            if (line_dist(distMat(dist_idx, 0), distMat(dist_idx, 1),
+                          x_max, y_max, slope) < 0)
+            {
+                row_edges[i].push_back(j);
+            }
+        }
+    }
+
+    // Build CSR of both directions
+    std::vector<size_t> degree(n_samples, 0);
+    uint64_t edges = 0;
+    for (size_t i = 0; i < n_samples; ++i)
+    {
+        degree[i] += row_edges[i].size();
+        for (const long j : row_edges[i])
+        {
+            degree[j]++;
+        }
+        edges += row_edges[i].size();
+    }
+    std::vector<size_t> indptr(n_samples + 1, 0);
+    std::partial_sum(degree.begin(), degree.end(), indptr.begin() + 1);
+    std::vector<long> indices(indptr[n_samples]);
+    std::vector<size_t> fill(indptr.begin(), indptr.end() - 1);
+    UnionFind components(n_samples);
+    for (size_t i = 0; i < n_samples; ++i)
+    {
+        for (const long j : row_edges[i])
+        {
+            indices[fill[i]++] = j;
+            indices[fill[j]++] = i;
+            components.unite(i, j);
+        }
+    }
+    row_edges.clear();
+    // Neighbours are added in increasing order, so each row is already sorted
+
+    // Count each triangle u < v < w once, from its edge (u, v)
+    uint64_t triangles = 0, triples = 0;
+#pragma omp parallel for schedule(dynamic, 64) reduction(+:triangles, triples) num_threads(num_threads)
+    for (long u = 0; u < static_cast<long>(n_samples); ++u)
+    {
+        if (degree[u] > 1)
+        {
+            triples += degree[u] * (degree[u] - 1) / 2;
+        }
+        const long *u_begin = indices.data() + indptr[u];
+        const long *u_end = indices.data() + indptr[u + 1];
+        for (const long *v_ptr = std::upper_bound(u_begin, u_end, u); v_ptr < u_end; ++v_ptr)
+        {
+            const long v = *v_ptr;
+            const long *a = v_ptr + 1;
+            const long *b = std::upper_bound(indices.data() + indptr[v],
+                                             indices.data() + indptr[v + 1], v);
+            const long *b_end = indices.data() + indptr[v + 1];
+            while (a < u_end && b < b_end)
+            {
+                if (*a < *b)
+                {
+                    ++a;
+                }
+                else if (*b < *a)
+                {
+                    ++b;
+                }
+                else
+                {
+                    triangles++;
+                    ++a;
+                    ++b;
+                }
+            }
+        }
+    }
+
+    return summarise(components.components(), edges, triangles, triples, n_samples);
+}
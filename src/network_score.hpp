@@ -0,0 +1,36 @@
+/*
+ *
+ * network_score.hpp
+ * functions in network_score.cpp
+ *
+ */
+#pragma once
+
+#include <vector>
+#include <cstdint>
+#include <cstddef>
+
+#include <tuple>
+
+#include <Eigen/Dense>
+
+#include "boundary.hpp"
+
+// Components, density, transitivity and score of a network
+typedef std::tuple<size_t, double, double, double> network_summary;
+
+// Columns are components, density, transitivity and score
+typedef Eigen::Matrix<double, Eigen::Dynamic, 4, Eigen::RowMajor> ScoreMatrix;
+
+ScoreMatrix score_network_iterate(const long *i_vec,
+                                  const long *j_vec,
+                                  const long *offset_idx,
+                                  const size_t n_edges,
+                                  const size_t n_samples,
+                                  const size_t n_offsets);
+
+network_summary score_network(const DistMatrix &distMat,
+                              const int slope,
+                              const float x_max,
+                              const float y_max,
+                              const int num_threads = 1);
@@ -8,27 +8,51 @@
 #include <pybind11/pybind11.h>
 #include <pybind11/stl.h>
 #include <pybind11/eigen.h>
+#include <pybind11/numpy.h>
 
 namespace py = pybind11;
 
 #include "boundary.hpp"
+#include "network_score.hpp"
+#include "clique_cover.hpp"
 
-// Wrapper which makes a ref to the python/numpy array
-Eigen::VectorXf assignThreshold(const Eigen::Ref<NumpyMatrix> &distMat,
-                                const int slope,
-                                const double x_max,
-                                const double y_max,
-                                const unsigned int num_threads = 1)
+typedef py::array_t<long, py::array::c_style | py::array::forcecast> IndexArray;
+
+// Moves a vector into a numpy array which owns it, without copying
+template <typename T>
+py::array_t<T> vector_to_numpy(std::vector<T> &&vec)
+{
+  std::vector<T> *owned = new std::vector<T>(std::move(vec));
+  py::capsule free_when_done(owned, [](void *ptr) {
+    delete reinterpret_cast<std::vector<T> *>(ptr);
+  });
+  return py::array_t<T>(owned->size(), owned->data(), free_when_done);
+}
+
+inline py::tuple coo_to_numpy(network_coo &&add_idx)
 {
-  Eigen::VectorXf assigned = assign_threshold(distMat,
-                                              slope,
-                                              x_max,
-                                              y_max,
-                                              num_threads);
-  return (assigned);
+  return py::make_tuple(vector_to_numpy(std::move(std::get<0>(add_idx))),
+                        vector_to_numpy(std::move(std::get<1>(add_idx))),
+                        vector_to_numpy(std::move(std::get<2>(add_idx))));
 }
 
-network_coo thresholdIterate1D(const Eigen::Ref<NumpyMatrix> &distMat,
+// Wrappers make a ref to the python/numpy array, and release the GIL
+// while running, so searches can run in parallel threads
+py::array_t<int8_t> assignThreshold(const DistMatrix &distMat,
+                                    const int slope,
+                                    const double x_max,
+                                    const double y_max,
+                                    const unsigned int num_threads = 1)
+{
+  std::vector<int8_t> assigned;
+  {
+    py::gil_scoped_release release;
+    assigned = assign_threshold(distMat, slope, x_max, y_max, num_threads);
+  }
+  return (vector_to_numpy(std::move(assigned)));
+}
+
+py::tuple thresholdIterate1D(const DistMatrix &distMat,
                  const std::vector<double> &offsets,
                  const int slope,
                  const double x0,
@@ -41,22 +65,118 @@ network_coo thresholdIterate1D(const Eigen::Ref<NumpyMatrix> &distMat,
   {
     throw std::runtime_error("Offsets to thresholdIterate1D must be sorted");
   }
-  std::tuple<std::vector<long>, std::vector<long>, std::vector<long>> add_idx =
-      threshold_iterate_1D(distMat, offsets, slope, x0, y0, x1, y1, num_threads);
-  return (add_idx);
+  network_coo add_idx;
+  {
+    py::gil_scoped_release release;
+    add_idx = threshold_iterate_1D(distMat, offsets, slope, x0, y0, x1, y1, num_threads);
+  }
+  return (coo_to_numpy(std::move(add_idx)));
 }
 
-network_coo thresholdIterate2D(const Eigen::Ref<NumpyMatrix> &distMat,
+py::tuple thresholdIterate2D(const DistMatrix &distMat,
                  const std::vector<float> &x_max,
-                 const float y_max)
+                 const float y_max,
+                 const int num_threads)
 {
   if (!std::is_sorted(x_max.begin(), x_max.end()))
   {
     throw std::runtime_error("x_max range to thresholdIterate2D must be sorted");
   }
-  std::tuple<std::vector<long>, std::vector<long>, std::vector<long>> add_idx =
-      threshold_iterate_2D(distMat, x_max, y_max);
-  return (add_idx);
+  network_coo add_idx;
+  {
+    py::gil_scoped_release release;
+    add_idx = threshold_iterate_2D(distMat, x_max, y_max, num_threads);
+  }
+  return (coo_to_numpy(std::move(add_idx)));
+}
+
+ScoreMatrix networkScoreIterate(const IndexArray &i_array,
+                                const IndexArray &j_array,
+                                const IndexArray &idx_array,
+                                const size_t n_samples,
+                                const size_t n_offsets)
+{
+  // The arrays are read in place, without copying
+  const long *i_vec = i_array.data();
+  const long *j_vec = j_array.data();
+  const long *idx_vec = idx_array.data();
+  const size_t n_edges = i_array.size();
+  if (j_array.size() != i_array.size() || idx_array.size() != i_array.size())
+  {
+    throw std::runtime_error("Edge vectors to networkScoreIterate must be the same length");
+  }
+  if (!std::is_sorted(idx_vec, idx_vec + n_edges))
+  {
+    throw std::runtime_error("Offset indices to networkScoreIterate must be sorted");
+  }
+  for (size_t edge_idx = 0; edge_idx < n_edges; ++edge_idx)
+  {
+    if (i_vec[edge_idx] < 0 || i_vec[edge_idx] >= static_cast<long>(n_samples) ||
+        j_vec[edge_idx] < 0 || j_vec[edge_idx] >= static_cast<long>(n_samples))
+    {
+      throw std::runtime_error("Edge to networkScoreIterate is outside of the network");
+    }
+  }
+  py::gil_scoped_release release;
+  ScoreMatrix scores = score_network_iterate(i_vec, j_vec, idx_vec, n_edges,
+                                             n_samples, n_offsets);
+  return (scores);
+}
+
+network_summary networkScore(const DistMatrix &distMat,
+                             const int slope,
+                             const double x_max,
+                             const double y_max,
+                             const int num_threads = 1)
+{
+  py::gil_scoped_release release;
+  network_summary summary = score_network(distMat, slope, x_max, y_max,
+                                          num_threads);
+  return (summary);
+}
+
+py::array_t<long> cliqueCover(const IndexArray &i_array,
+                              const IndexArray &j_array,
+                              const IndexArray &components_array,
+                              const IndexArray &existing_refs_array,
+                              const int num_threads = 1)
+{
+  // The arrays are read in place, without copying
+  const long *i_vec = i_array.data();
+  const long *j_vec = j_array.data();
+  const long *components = components_array.data();
+  const long *existing_refs = existing_refs_array.data();
+  const size_t n_edges = i_array.size();
+  const size_t n_refs = existing_refs_array.size();
+  if (j_array.size() != i_array.size())
+  {
+    throw std::runtime_error("Edge vectors to cliqueCover have different lengths");
+  }
+  const long n_samples = components_array.size();
+  for (size_t edge_idx = 0; edge_idx < n_edges; ++edge_idx)
+  {
+    if (i_vec[edge_idx] < 0 || i_vec[edge_idx] >= n_samples ||
+        j_vec[edge_idx] < 0 || j_vec[edge_idx] >= n_samples ||
+        components[i_vec[edge_idx]] != components[j_vec[edge_idx]])
+    {
+      throw std::runtime_error("Edge to cliqueCover is outside of the network or its component");
+    }
+  }
+  if (std::any_of(components, components + n_samples,
+                  [](const long c) { return c < 0; }) ||
+      std::any_of(existing_refs, existing_refs + n_refs,
+                  [n_samples](const long v) { return v < 0 || v >= n_samples; }))
+  {
+    throw std::runtime_error("Component labels and references to cliqueCover must be valid indices");
+  }
+
+  std::vector<long> refs;
+  {
+    py::gil_scoped_release release;
+    refs = clique_cover(i_vec, j_vec, n_edges, components, n_samples,
+                        existing_refs, n_refs, num_threads);
+  }
+  return (vector_to_numpy(std::move(refs)));
 }
 
 PYBIND11_MODULE(poppunk_refine, m)
@@ -84,5 +204,27 @@ PYBIND11_MODULE(poppunk_refine, m)
   m.def("thresholdIterate2D", &thresholdIterate2D, py::return_value_policy::reference_internal, "Move a 2D boundary to grow a network by adding edges at each offset",
         py::arg("distMat").noconvert(),
         py::arg("x_max"),
-        py::arg("y_max"));
+        py::arg("y_max"),
+        py::arg("num_threads") = 1);
+
+  m.def("networkScoreIterate", &networkScoreIterate, py::return_value_policy::reference_internal, "Score a network as edges are added at each offset, returning components, density, transitivity and score",
+        py::arg("i_vec"),
+        py::arg("j_vec"),
+        py::arg("idx_vec"),
+        py::arg("n_samples"),
+        py::arg("n_offsets"));
+
+  m.def("networkScore", &networkScore, py::return_value_policy::reference_internal, "Score the network of distances within a 2D boundary, returning components, density, transitivity and score",
+        py::arg("distMat").noconvert(),
+        py::arg("slope"),
+        py::arg("x_max"),
+        py::arg("y_max"),
+        py::arg("num_threads") = 1);
+
+  m.def("cliqueCover", &cliqueCover, py::return_value_policy::reference_internal, "Cover each component of a network with cliques, returning the sorted indices of one reference from each",
+        py::arg("i_vec"),
+        py::arg("j_vec"),
+        py::arg("components"),
+        py::arg("existing_refs"),
+        py::arg("num_threads") = 1);
 }
@@ -21,7 +21,13 @@ with open("references.txt", 'r') as ref_file:
 outputDirs = [
     "example_db",
     "example_qc",
+    "example_bgmm_sweep",
+    "example_bgmm_update",
+    "example_refine_update",
+    "example_refine_adaptive",
+    "example_refine_subsample",
     "example_dbscan",
+    "example_dbscan_load",
     "example_refine",
     "example_threshold",
     "example_lineages",
@@ -30,6 +36,7 @@ outputDirs = [
     "example_single_query",
     "example_query_update",
     "example_lineage_query",
+    "example_lineage_query_pruned",
     "example_viz",
     "example_viz_subset",
     "example_viz_query",
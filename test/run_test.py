@@ -22,10 +22,13 @@ subprocess.run("python ../poppunk-runner.py --create-db --r-files references.txt
 #fit GMM
 sys.stderr.write("Running GMM model fit (--fit-model gmm)\n")
 subprocess.run("python ../poppunk-runner.py --fit-model bgmm --ref-db example_db --K 4 --overwrite", shell=True, check=True)
+subprocess.run("python ../poppunk-runner.py --fit-model bgmm --ref-db example_db --output example_bgmm_sweep --K-sweep 2,3,4 --threads 2 --overwrite", shell=True, check=True)
+subprocess.run("python ../poppunk-runner.py --fit-model bgmm --ref-db example_db --output example_bgmm_update --update-fit --overwrite", shell=True, check=True)
 
 #fit dbscan
 sys.stderr.write("Running DBSCAN model fit (--fit-model dbscan)\n")
 subprocess.run("python ../poppunk-runner.py --fit-model dbscan --ref-db example_db --output example_dbscan --overwrite --graph-weights", shell=True, check=True)
+subprocess.run("python test-dbscan-load.py", shell=True, check=True)
 
 #refine model with GMM
 sys.stderr.write("Running model refinement (--fit-model refine)\n")
@@ -33,6 +36,11 @@ subprocess.run("python ../poppunk-runner.py --fit-model refine --ref-db example_
 subprocess.run("python ../poppunk-runner.py --fit-model refine --ref-db example_db --output example_refine --neg-shift 0.8 --overwrite --indiv-refine both", shell=True, check=True)
 subprocess.run("python ../poppunk-runner.py --fit-model refine --ref-db example_db --output example_refine --neg-shift 0.8 --overwrite --score-idx 1", shell=True, check=True)
 subprocess.run("python ../poppunk-runner.py --fit-model refine --ref-db example_db --output example_refine --neg-shift 0.8 --overwrite --score-idx 2", shell=True, check=True)
+subprocess.run("python ../poppunk-runner.py --fit-model refine --ref-db example_db --output example_refine --neg-shift 0.8 --overwrite --score-idx 1 --betweenness-sample 0.1", shell=True, check=True)
+subprocess.run("python ../poppunk-runner.py --fit-model refine --ref-db example_db --output example_refine --neg-shift 0.8 --overwrite --unconstrained --score-idx 1", shell=True, check=True)
+subprocess.run("python ../poppunk-runner.py --fit-model refine --ref-db example_db --model-dir example_refine --output example_refine_update --update-fit --overwrite", shell=True, check=True)
+subprocess.run("python ../poppunk-runner.py --fit-model refine --ref-db example_db --output example_refine_adaptive --neg-shift 0.8 --overwrite --adaptive-refine --indiv-refine both", shell=True, check=True)
+subprocess.run("python ../poppunk-runner.py --fit-model refine --ref-db example_db --output example_refine_subsample --neg-shift 0.8 --overwrite --refine-subsample 20", shell=True, check=True)
 subprocess.run("python ../poppunk-runner.py --fit-model threshold --threshold 0.003 --ref-db example_db --output example_threshold", shell=True, check=True)
 
 # lineage clustering
@@ -46,6 +54,8 @@ subprocess.run("python ../poppunk-runner.py --use-model --ref-db example_db --mo
 # tests of other command line programs
 sys.stderr.write("Testing C++ extension\n")
 subprocess.run("python test-refine.py", shell=True, check=True)
+subprocess.run("python test-raster.py", shell=True, check=True)
+subprocess.run("python test-lineage.py", shell=True, check=True)
 
 #assign query
 sys.stderr.write("Running query assignment\n")
@@ -53,6 +63,7 @@ subprocess.run("python ../poppunk_assign-runner.py --query some_queries.txt --db
 subprocess.run("python ../poppunk_assign-runner.py --query some_queries.txt --db example_db --output example_query_update --update-db --graph-weights --overwrite", shell=True, check=True)
 subprocess.run("python ../poppunk_assign-runner.py --query single_query.txt --db example_db --output example_single_query --update-db --overwrite", shell=True, check=True)
 subprocess.run("python ../poppunk_assign-runner.py --query some_queries.txt --db example_db --model-dir example_lineages --output example_lineage_query --overwrite", shell=True, check=True)
+subprocess.run("python ../poppunk_assign-runner.py --query some_queries.txt --db example_db --model-dir example_lineages --output example_lineage_query_pruned --prune-query-pairs --overwrite", shell=True, check=True)
 
 # viz
 sys.stderr.write("Running visualisations (poppunk_visualise)\n")
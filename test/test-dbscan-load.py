@@ -0,0 +1,20 @@
+import os, sys
+import numpy as np
+
+# testing without install
+sys.path.insert(0, '..')
+from PopPUNK.models import loadClusterFit
+from PopPUNK.utils import readPickle
+
+# A DBSCAN model saved in the npz format has no hdbscan object, so
+# plotting after loading must not need its labels
+model = loadClusterFit("example_dbscan/example_dbscan_fit.pkl",
+                       "example_dbscan/example_dbscan_fit.npz",
+                       "example_dbscan_load")
+if model.type != 'dbscan' or model.hdb is not None:
+  raise RuntimeError("Expected a DBSCAN model saved without the hdbscan object")
+
+refList, queryList, self, distMat = readPickle("example_db/example_db.dists", enforce_self = True)
+model.plot(distMat)
+if not os.path.isfile("example_dbscan_load/example_dbscan_load_dbscan.png"):
+  raise RuntimeError("Loaded DBSCAN model was not plotted")
@@ -0,0 +1,31 @@
+import os, sys
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.spatial.distance import cdist
+
+# testing without install
+sys.path.insert(0, '..')
+from PopPUNK.lineage import queryNeighbours, queryCandidatePairs
+
+# Euclidean points are a metric, so pruning query pairs through the
+# references must not lose any neighbours
+np.random.seed(0)
+refs = np.random.rand(200, 5)
+queries = np.random.rand(100, 5)
+qrRect = cdist(queries, refs)
+qqSquare = cdist(queries, queries)
+
+for max_rank in [1, 3, 10]:
+  full = queryNeighbours(qrRect, qqSquare, max_rank)
+
+  pair_i, pair_j = queryCandidatePairs(qrRect, max_rank)
+  if pair_i.size >= queries.shape[0] * (queries.shape[0] - 1) // 2:
+    raise RuntimeError("No query pairs were pruned")
+  # upper triangle only, as in LineageFit.extend
+  qqPairs = coo_matrix((qqSquare[pair_i, pair_j], (pair_i, pair_j)),
+                       shape = qqSquare.shape)
+  pruned = queryNeighbours(qrRect, qqPairs, max_rank)
+
+  for full_arr, pruned_arr in zip(full, pruned):
+    if not np.array_equal(full_arr, pruned_arr):
+      raise RuntimeError("Pruned query pairs give different neighbours at rank " + str(max_rank))
@@ -0,0 +1,38 @@
+import os, sys
+import numpy as np
+
+# testing without install
+sys.path.insert(0, '..')
+from PopPUNK.raster import DecisionRaster
+
+# A model with a disc, a stripe between the corners of one column of cells,
+# and noise
+stripe_x = 179.5 / 256
+def assign_fn(X):
+  y = np.full(X.shape[0], -1, dtype=np.int32)
+  y[np.sum((X - 0.3)**2, axis=1) < 0.04] = 0
+  y[np.abs(X[:, 0] - stripe_x) < 0.0015] = 1
+  return y
+
+np.random.seed(0)
+fit_points = np.column_stack((np.full(2000, stripe_x), np.random.rand(2000)))
+fit_points = np.vstack((fit_points, np.random.rand(2000, 2)))
+raster = DecisionRaster(resolution = 256)
+raster.compile(assign_fn, np.ones(2), points = fit_points)
+
+# held-out points, including some in the stripe and outside of the extent
+held_out = np.vstack((np.random.rand(20000, 2),
+                      np.column_stack((stripe_x + 0.0007 * np.random.randn(500), np.random.rand(500))),
+                      1 + np.random.rand(500, 2)))
+exact = assign_fn(held_out)
+
+if not np.array_equal(raster.assign(held_out, exact_fn = assign_fn), exact):
+  raise RuntimeError("Raster with exact fallback does not match the model")
+
+inside = np.all(held_out < 1, axis=1)
+looked_up = raster.assign(held_out, outside_label = -2)
+if not np.all(looked_up[~inside] == -2):
+  raise RuntimeError("Raster did not label points outside of the grid")
+stripe = inside & (exact == 1)
+if np.mean(looked_up[stripe] == 1) < 0.9 or np.mean(looked_up[inside] == exact[inside]) < 0.99:
+  raise RuntimeError("Raster lookup does not match the model")
@@ -44,6 +44,8 @@ assign2_res = withinBoundary(distMat, 0.5, 0.5, 2)
 check_res(assign0, assign0_res)
 check_res(assign1, assign1_res)
 check_res(assign2, assign2_res)
+if assign0.dtype != np.int8:
+  raise RuntimeError("Assignments not returned as int8")
 
 # move boundary 1D
 # example is symmetrical at points (0.1, 0.1); (0.2, 0.2); (0.3, 0.3)
@@ -81,6 +83,9 @@ for offset_idx, offset in enumerate(offsets):
 offsets = [0.1, 0.2, 0.3]
 y_max = 0.2
 i_vec, j_vec, idx_vec = poppunk_refine.thresholdIterate2D(distMat, offsets, y_max)
+threaded_vecs = poppunk_refine.thresholdIterate2D(distMat, offsets, y_max, 2)
+if not all(np.array_equal(serial, threaded) for serial, threaded in zip((i_vec, j_vec, idx_vec), threaded_vecs)):
+  raise RuntimeError("Threshold 2D iterate differs when threaded")
 sketchlib_i = []
 sketchlib_j = []
 for offset_idx, offset in enumerate(offsets):
@@ -104,3 +109,73 @@ for offset_idx, offset in enumerate(offsets):
   if set(zip(py_i, py_j)) != set(zip(sketchlib_i, sketchlib_j)):
     raise RuntimeError("Threshold 2D iterate mismatch at offset " + str(offset))
 
+
+# incremental network scores
+# compare with a dense adjacency matrix at each offset
+samples = 30
+n_offsets = 5
+i_idx, j_idx = np.triu_indices(samples, 1)
+edges = np.random.choice(i_idx.size, 150, replace=False)
+i_vec = i_idx[edges]
+j_vec = j_idx[edges]
+idx_vec = np.sort(np.random.randint(0, n_offsets, edges.size))
+scores = poppunk_refine.networkScoreIterate(i_vec, j_vec, idx_vec, samples, n_offsets)
+for offset_idx in range(n_offsets):
+  adj = np.zeros((samples, samples))
+  added = idx_vec <= offset_idx
+  adj[i_vec[added], j_vec[added]] = 1
+  adj += adj.T
+  triangles = np.trace(adj @ adj @ adj) / 6
+  degrees = adj.sum(axis=1)
+  triples = np.sum(degrees * (degrees - 1) / 2)
+  transitivity = 3 * triangles / triples if triples > 0 else 0
+  density = np.sum(added) / (0.5 * samples * (samples - 1))
+  if not np.allclose(scores[offset_idx, 1:], [density, transitivity, transitivity * (1 - density)]):
+    raise RuntimeError("Incremental network score mismatch at offset " + str(offset_idx))
+
+# network score from a boundary
+# compare with a dense adjacency matrix of the assigned edges
+distMat = np.random.rand(int(0.5 * samples * (samples - 1)), 2)
+distMat = np.array(distMat, dtype = np.float32)
+components, density, transitivity, score = poppunk_refine.networkScore(distMat, 2, 0.5, 0.5, 2)
+assign = poppunk_refine.assignThreshold(distMat, 2, 0.5, 0.5, 1)
+adj = np.zeros((samples, samples))
+adj[i_idx[assign < 0], j_idx[assign < 0]] = 1
+adj += adj.T
+triangles = np.trace(adj @ adj @ adj) / 6
+degrees = adj.sum(axis=1)
+triples = np.sum(degrees * (degrees - 1) / 2)
+expected_transitivity = 3 * triangles / triples if triples > 0 else 0
+expected_density = np.sum(assign < 0) / (0.5 * samples * (samples - 1))
+if not np.allclose([density, transitivity, score],
+                   [expected_density, expected_transitivity,
+                    expected_transitivity * (1 - expected_density)]):
+  raise RuntimeError("Network score mismatch")
+
+# clique cover
+# every sample must be a reference or linked to one
+components = np.sort(np.random.randint(0, 5, samples))
+i_idx, j_idx = np.triu_indices(samples, 1)
+same = components[i_idx] == components[j_idx]
+edges = np.random.choice(np.flatnonzero(same), int(0.6 * np.sum(same)), replace=False)
+i_vec = i_idx[edges]
+j_vec = j_idx[edges]
+existing = np.array([0], dtype=np.int64)
+refs = poppunk_refine.cliqueCover(i_vec, j_vec, components, existing, 2)
+adj = np.zeros((samples, samples), dtype=bool)
+adj[i_vec, j_vec] = True
+adj |= adj.T
+np.fill_diagonal(adj, True)
+if not np.all(np.diff(refs) > 0) or 0 not in refs:
+  raise RuntimeError("Clique cover references are not sorted or lack existing references")
+if not np.all(adj[:, refs].any(axis=1)):
+  raise RuntimeError("Clique cover leaves samples without a reference")
+
+# two cliques joined by an edge, one with an existing reference, and a singleton
+i_vec, j_vec = np.triu_indices(4, 1)
+i_vec = np.concatenate((i_vec, i_vec + 4, [3]))
+j_vec = np.concatenate((j_vec, j_vec + 4, [4]))
+components = np.array([0] * 8 + [1])
+refs = poppunk_refine.cliqueCover(i_vec, j_vec, components, np.array([6]), 1)
+if refs.size != 3 or 6 not in refs or 8 not in refs or np.sum(refs < 4) != 1:
+  raise RuntimeError("Clique cover mismatch")